@@ -0,0 +1,2 @@
+# Modules shared by all subprojects. The entry points in the subprojects' src/ directories put the repository root
+# on sys.path (src/common_path.py) and import them as agdn_common.<module>.
@@ -0,0 +1,652 @@
+import dgl.function as fn
+import dgl.ops
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from dgl.base import DGLError
+from dgl.utils import expand_as_pair
+
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
+# One AGDN operator for all subprojects, benchmark/agdn_equivalence.py compares it against every legacy AGDNConv.
+
+
+class AGDNConfig(object):
+    """Options of AGDNOp, the union of what the AGDNConv variants of the subprojects support.
+
+    Hops: the input projection is hop 0, hops 1..K are diffused. include_self aggregates hop 0 as well (arxiv,
+    heterophily, ogbl_no_sampling); otherwise the hop attention query is the transformed hop 0 when self_query
+    (ogbn-proteins, ogbl_sampling_methods) or the first diffused hop (ogbn-products).
+    """
+
+    DEFAULTS = dict(
+        K=3,
+        num_heads=1,
+        feat_drop=0.0,
+        attn_drop=0.0,
+        edge_drop=0.0,
+        diffusion_drop=0.0,
+        hop_attn_drop=0.0,
+        # a new attention dropout mask for every hop instead of one for all hops
+        attn_drop_per_hop=False,
+        negative_slope=0.2,
+        # gat (softmax over in-edges), gat_col (over out-edges), gat_sym, gcn, sage / row, col
+        transition_matrix="gat",
+        # none, adj or avg: gat attention combined with the gcn norms of the graph (gat_adj is gat + adj)
+        norm="none",
+        # prefix of the precomputed norm edata keys, e.g. "sub_" for the ogbn-products partitions
+        norm_prefix="",
+        # attention logits from linear maps of the input instead of vectors on the projected features
+        attn_input=False,
+        # separate, shared (attn_r is attn_l) or none
+        attn_dst="separate",
+        pre_act=False,
+        # > 0: edge features are projected to one attention logit per head
+        edge_feats=0,
+        # edge features are scalar weights averaged into the transition matrix instead
+        edge_weight=False,
+        propagate_first=False,
+        share_weights=True,
+        include_self=True,
+        self_query=True,
+        hop_norm=False,
+        batch_norm=False,
+        position_emb=True,
+        # HA, HC, HA+HC, mean, sum, max_pool
+        weight_style="HA",
+        HA_activation="leakyrelu",
+        # learnable per-head temperature exp(beta) of the hop attention
+        hop_attn_scale=False,
+        # none, linear, shared (with the input projection) or identity
+        residual="none",
+        residual_bias=False,
+        bias=True,
+        allow_zero_in_degree=True,
+    )
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.DEFAULTS)
+        if unknown:
+            raise TypeError(f"Unknown AGDN options: {sorted(unknown)}")
+        for key, value in self.DEFAULTS.items():
+            setattr(self, key, kwargs.get(key, value))
+        if self.transition_matrix == "row":
+            self.transition_matrix = "sage"
+        if self.weight_style == "mean_pool":
+            self.weight_style = "mean"
+        assert self.transition_matrix in ["gat", "gat_col", "gat_sym", "gcn", "sage", "col"], self.transition_matrix
+        assert self.weight_style in ["HA", "HC", "HA+HC", "mean", "sum", "max_pool"], self.weight_style
+        assert self.residual in ["none", "linear", "shared", "identity"], self.residual
+
+    def replace(self, **kwargs):
+        return AGDNConfig(**dict(self.as_dict(), **kwargs))
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.DEFAULTS}
+
+    def __repr__(self):
+        changed = ", ".join(f"{k}={v!r}" for k, v in self.as_dict().items() if v != self.DEFAULTS[k])
+        return f"AGDNConfig({changed})"
+
+    @property
+    def n_hops(self):
+        # number of hop transforms (position embeddings, batch norm parameters)
+        return self.K + 1 if self.include_self or self.self_query else self.K
+
+    @property
+    def n_aggregated(self):
+        # number of hops in the weighted sum
+        return self.K + 1 if self.include_self else self.K
+
+
+def structural_norm(graph, key):
+    """gcn / sage / col edge norms of graph, computed from the degrees on first use and then kept in its edata.
+
+    Precomputed norms (utils.py of the node property subprojects) are used as they are.
+    """
+    if key in graph.edata:
+        return graph.edata[key]
+    deg_dst = graph.in_degrees().float()
+    # sources of a block are not its destinations, their in-degrees are unknown
+    deg_src = graph.out_degrees().float() if graph.is_block else deg_dst
+    src, dst = graph.edges()
+
+    def power(deg, p):
+        return torch.where(deg > 0, deg.clamp(min=1).pow(p), torch.zeros_like(deg))
+
+    if key.endswith("gcn_norm"):
+        norm = power(deg_src, -0.5)[src] * power(deg_dst, -0.5)[dst]
+    elif key.endswith("gcn_norm_adjust"):
+        norm = power(deg_src, -0.5)[src] * power(deg_dst, 0.5)[dst]
+    elif key.endswith("sage_norm"):
+        norm = power(deg_dst, -1)[dst]
+    elif key.endswith("col_norm"):
+        norm = power(graph.out_degrees().float(), -1)[src]
+    else:
+        raise KeyError(key)
+    graph.edata[key] = norm
+    return norm
+
+
+class AGDNOp(nn.Module):
+    """Adaptive graph diffusion convolution configured by an AGDNConfig.
+
+    All hops are kept in one N x heads x hops x features tensor, so the hop transforms and the hop weighting are a
+    few batched ops whatever K is. Edge dropout only gathers and scatters the kept edges when it is active, and
+    structural norms are computed once per graph (see structural_norm).
+    """
+
+    def __init__(self, in_feats, out_feats, config=None, activation=None):
+        super(AGDNOp, self).__init__()
+        config = config or AGDNConfig()
+        self.config = config
+        self._in_src_feats, self._in_dst_feats = expand_as_pair(in_feats)
+        self._out_feats = out_feats
+        self._num_heads = H = config.num_heads
+        self.activation = activation
+
+        self.fc = nn.Linear(self._in_src_feats, out_feats * H, bias=False)
+        if isinstance(in_feats, tuple) or not config.share_weights:
+            self.fc_dst = nn.Linear(self._in_dst_feats, out_feats * H, bias=False)
+        else:
+            self.register_buffer("fc_dst", None)
+
+        # features the attention and the hop transforms see
+        feats = self._in_src_feats if config.propagate_first else out_feats
+        self.attn_l = self.attn_r = self.attn = None
+        self.attn_src_fc = self.attn_dst_fc = None
+        if config.transition_matrix.startswith("gat"):
+            if config.pre_act:
+                self.attn = nn.Parameter(torch.FloatTensor(size=(1, H, feats)))
+            elif config.attn_input:
+                self.attn_src_fc = nn.Linear(self._in_src_feats, H, bias=False)
+                if config.attn_dst == "separate":
+                    self.attn_dst_fc = nn.Linear(self._in_dst_feats, H, bias=False)
+                elif config.attn_dst == "shared":
+                    self.attn_dst_fc = self.attn_src_fc
+            else:
+                self.attn_l = nn.Parameter(torch.FloatTensor(size=(1, H, feats)))
+                if config.attn_dst == "separate":
+                    self.attn_r = nn.Parameter(torch.FloatTensor(size=(1, H, feats)))
+                elif config.attn_dst == "shared":
+                    self.attn_r = self.attn_l
+        if config.edge_feats > 0:
+            self.attn_edge_fc = nn.Linear(config.edge_feats, H, bias=False)
+        else:
+            self.attn_edge_fc = None
+
+        R, A = config.n_hops, config.n_aggregated
+        if config.batch_norm:
+            self.hop_scale = nn.Parameter(torch.ones(size=(1, H, R, feats)))
+            self.hop_offset = nn.Parameter(torch.zeros(size=(1, H, R, feats)))
+        if config.position_emb:
+            self.position_emb = nn.Parameter(torch.FloatTensor(size=(1, H, R, feats)))
+        if config.weight_style in ["HA", "HA+HC"]:
+            self.hop_attn_l = nn.Parameter(torch.FloatTensor(size=(1, H, 1, feats)))
+            self.hop_attn_r = nn.Parameter(torch.FloatTensor(size=(1, H, 1, feats)))
+            if config.hop_attn_scale:
+                self.beta = nn.Parameter(torch.FloatTensor(size=(H,)))
+        if config.weight_style in ["HC", "HA+HC"]:
+            self.weights = nn.Parameter(torch.FloatTensor(size=(1, H, A, feats)))
+
+        self.feat_drop = nn.Dropout(config.feat_drop)
+        self.attn_drop = nn.Dropout(config.attn_drop)
+        self.hop_attn_drop = nn.Dropout(config.hop_attn_drop)
+        self.leaky_relu = nn.LeakyReLU(config.negative_slope)
+        if config.residual == "linear":
+            self.res_fc = nn.Linear(self._in_dst_feats, out_feats * H, bias=config.residual_bias)
+        else:
+            self.register_buffer("res_fc", None)
+        if config.bias:
+            self.bias = nn.Parameter(torch.FloatTensor(size=(1, H, out_feats)))
+        else:
+            self.register_buffer("bias", None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        gain = nn.init.calculate_gain("relu")
+        for linear in [self.fc, self.fc_dst, self.attn_src_fc, self.attn_dst_fc, self.attn_edge_fc, self.res_fc]:
+            if linear is not None:
+                nn.init.xavier_normal_(linear.weight, gain=gain)
+                if linear.bias is not None:
+                    nn.init.zeros_(linear.bias)
+        for param in [self.attn, self.attn_l, self.attn_r]:
+            if param is not None:
+                nn.init.xavier_normal_(param, gain=gain)
+        if self.config.batch_norm:
+            nn.init.ones_(self.hop_scale)
+            nn.init.zeros_(self.hop_offset)
+        if self.config.position_emb:
+            nn.init.xavier_normal_(self.position_emb, gain=gain)
+        if self.config.weight_style in ["HA", "HA+HC"]:
+            nn.init.xavier_normal_(self.hop_attn_l, gain=gain)
+            nn.init.xavier_normal_(self.hop_attn_r, gain=gain)
+            if self.config.hop_attn_scale:
+                nn.init.uniform_(self.beta)
+        if self.config.weight_style in ["HC", "HA+HC"]:
+            nn.init.ones_(self.weights)
+        if self.bias is not None:
+            nn.init.zeros_(self.bias)
+
+    def set_allow_zero_in_degree(self, set_value):
+        self.config.allow_zero_in_degree = set_value
+
+    def kept_edges(self, graph):
+        # None when no edge is dropped, so that the common path never gathers / scatters edge tensors
+        p = self.config.edge_drop
+        if not self.training or p <= 0:
+            return None
+        n_edges = graph.number_of_edges()
+        return torch.randperm(n_edges, device=graph.device)[int(n_edges * p) :]
+
+    def edge_logits(self, graph, h_src, h_dst, feat_src, feat_dst, edge_feat, attn_edge):
+        config = self.config
+        if config.pre_act:
+            graph.srcdata["el"] = feat_src
+            graph.dstdata["er"] = feat_dst
+            graph.apply_edges(fn.u_add_v("el", "er", "e"))
+        else:
+            if config.attn_input:
+                el = self.attn_src_fc(h_src).view(-1, self._num_heads, 1)
+                er = self.attn_dst_fc(h_dst).view(-1, self._num_heads, 1) if self.attn_dst_fc is not None else None
+            else:
+                el = (feat_src * self.attn_l).sum(dim=-1, keepdim=True)
+                er = (feat_dst * self.attn_r).sum(dim=-1, keepdim=True) if self.attn_r is not None else None
+            graph.srcdata["el"] = el
+            if er is not None:
+                graph.dstdata["er"] = er
+                graph.apply_edges(fn.u_add_v("el", "er", "e"))
+            else:
+                graph.apply_edges(fn.copy_u("el", "e"))
+        e = graph.edata.pop("e")
+        # attn_edge may be precomputed for all layers at once (ogbn-proteins)
+        if attn_edge is None and edge_feat is not None and self.attn_edge_fc is not None:
+            attn_edge = self.attn_edge_fc(edge_feat).view(-1, self._num_heads, 1)
+        if attn_edge is not None:
+            e = e + attn_edge
+        e = self.leaky_relu(e)
+        if config.pre_act:
+            e = (e * self.attn).sum(dim=-1, keepdim=True)
+        return e
+
+    def transition(self, graph, norms, h_src, h_dst, feat_src, feat_dst, edge_feat, attn_edge):
+        """Edge weights of the diffusion, E x heads x 1 (E x 1 x 1 for structural ones)."""
+        config = self.config
+        eids = self.kept_edges(graph)
+        kwargs = {} if eids is None else {"eids": eids}
+
+        def kept(x):
+            return x if eids is None else x[eids]
+
+        if config.transition_matrix.startswith("gat"):
+            e = kept(self.edge_logits(graph, h_src, h_dst, feat_src, feat_dst, edge_feat, attn_edge))
+            if config.transition_matrix == "gat_sym":
+                a = torch.sqrt(
+                    edge_softmax(graph, e, norm_by="dst", **kwargs).clamp(min=1e-9)
+                    * edge_softmax(graph, e, norm_by="src", **kwargs).clamp(min=1e-9)
+                )
+            elif config.transition_matrix == "gat_col":
+                a = edge_softmax(graph, e, norm_by="src", **kwargs)
+            else:
+                a = edge_softmax(graph, e, norm_by="dst", **kwargs)
+            if config.norm == "adj":
+                a = a * kept(norms["gcn_norm_adjust"]).view(-1, 1, 1)
+            elif config.norm == "avg":
+                a = (a + kept(norms["gcn_norm"]).view(-1, 1, 1)) / 2
+            if config.edge_weight and edge_feat is not None:
+                w_in = dgl.ops.copy_e_sum(graph, edge_feat)
+                src, dst = graph.edges()
+                w = edge_feat / torch.sqrt(w_in[src] * w_in[dst])
+                a = (a + kept(w).unsqueeze(1)) / 2
+        else:
+            a = kept(norms[config.transition_matrix + "_norm"]).view(-1, 1, 1)
+
+        if not config.attn_drop_per_hop:
+            a = self.attn_drop(a)
+        if eids is not None:
+            a = a.new_zeros((graph.number_of_edges(),) + a.shape[1:]).index_copy_(0, eids, a)
+        return a
+
+    def hop_transform(self, hstack):
+        config = self.config
+        if config.hop_norm:
+            hstack = F.normalize(hstack, p=2, dim=-1)
+        if config.batch_norm:
+            mean = hstack.mean(dim=-1, keepdim=True)
+            var = hstack.var(dim=-1, unbiased=False, keepdim=True) + 1e-9
+            hstack = (hstack - mean) * self.hop_scale * torch.rsqrt(var) + self.hop_offset
+        if config.position_emb:
+            hstack = hstack + self.position_emb
+        return hstack
+
+    def hop_attention(self, query, hstack):
+        config = self.config
+        a = (query * self.hop_attn_l).sum(dim=-1, keepdim=True) + (hstack * self.hop_attn_r).sum(dim=-1, keepdim=True)
+        if config.HA_activation == "sigmoid":
+            a = torch.sigmoid(a)
+        elif config.HA_activation == "leakyrelu":
+            a = self.leaky_relu(a)
+        elif config.HA_activation == "relu":
+            a = F.relu(a)
+        elif config.HA_activation == "standardize":
+            a_min, a_max = a.min(dim=2, keepdim=True)[0], a.max(dim=2, keepdim=True)[0]
+            a = (a - a_min) / (a_max - a_min).clamp(min=1e-9)
+        a = F.softmax(a.float(), dim=2)
+        if config.hop_attn_scale:
+            a = a * torch.exp(self.beta.view(1, -1, 1, 1))
+        return self.hop_attn_drop(a)
+
+    def aggregate(self, hstack):
+        config = self.config
+        # hstack: N x heads x hops x features, hop 0 first
+        query = hstack[:, :, :1]
+        if config.self_query and not config.include_self:
+            hstack = hstack[:, :, 1:]
+        if config.weight_style in ["HA", "HA+HC"]:
+            a = self.hop_attention(query, hstack)
+            if not self.training:
+                self.hop_a = a.squeeze(-1)
+            if config.weight_style == "HA+HC":
+                hstack = hstack * self.weights
+            return (hstack * a).sum(dim=2)
+        if config.weight_style == "HC":
+            return (hstack * self.hop_attn_drop(self.weights)).sum(dim=2)
+        if config.weight_style == "mean":
+            return hstack.mean(dim=2)
+        if config.weight_style == "sum":
+            return hstack.sum(dim=2)
+        return hstack.max(dim=2)[0]
+
+    def forward(self, graph, feat, edge_feat=None, attn_edge=None):
+        config = self.config
+        H, F_out = self._num_heads, self._out_feats
+
+        # outside of the local scope, so that computed norms stay on the graph
+        norms = {}
+        if not config.transition_matrix.startswith("gat"):
+            key = config.transition_matrix + "_norm"
+            norms[key] = structural_norm(graph, config.norm_prefix + key)
+        elif config.norm != "none":
+            key = "gcn_norm_adjust" if config.norm == "adj" else "gcn_norm"
+            norms[key] = structural_norm(graph, config.norm_prefix + key)
+
+        with graph.local_scope():
+            if not config.allow_zero_in_degree and (graph.in_degrees() == 0).any():
+                raise DGLError(
+                    "There are 0-in-degree nodes in the graph, add self-loops or set allow_zero_in_degree "
+                    "to suppress the check."
+                )
+            n_dst = graph.number_of_dst_nodes()
+            if isinstance(feat, tuple):
+                h_src, h_dst = self.feat_drop(feat[0]), self.feat_drop(feat[1])
+            else:
+                h_src = self.feat_drop(feat)
+                h_dst = h_src[:n_dst]
+
+            if config.propagate_first:
+                feat_src, feat_dst = h_src.view(h_src.shape[0], 1, -1), h_dst.view(h_dst.shape[0], 1, -1)
+            else:
+                feat_src = self.fc(h_src).view(h_src.shape[0], H, F_out)
+                if isinstance(feat, tuple) or self.fc_dst is not None:
+                    fc_dst = self.fc_dst if self.fc_dst is not None else self.fc
+                    feat_dst = fc_dst(h_dst).view(h_dst.shape[0], H, F_out)
+                else:
+                    feat_dst = feat_src[:n_dst]
+
+            instrument.begin("attention")
+            a = self.transition(graph, norms, h_src, h_dst, feat_src, feat_dst, edge_feat, attn_edge)
+            instrument.end()
+
+            graph.srcdata["ft"] = feat_src
+            hops = [feat_src[:n_dst]] if config.include_self or config.self_query else []
+            for k in range(1, config.K + 1):
+                instrument.begin("hop", k)
+                if config.diffusion_drop > 0:
+                    graph.srcdata["ft"] = F.dropout(graph.srcdata["ft"], config.diffusion_drop, training=self.training)
+                # message passing needs the attention in the dtype of the features, see precision.py
+                graph.edata["a"] = (self.attn_drop(a) if config.attn_drop_per_hop else a).to(feat_src.dtype)
+                graph.update_all(fn.u_mul_e("ft", "a", "m"), fn.sum("m", "ft"))
+                hops.append(graph.dstdata["ft"])
+                instrument.end()
+
+            instrument.begin("hop_aggregation")
+            rst = self.aggregate(self.hop_transform(torch.stack(hops, dim=2)))
+            instrument.end()
+
+            if config.propagate_first:
+                rst = self.fc(rst).view(rst.shape[0], -1, F_out)
+            if config.residual == "linear":
+                rst = rst + self.res_fc(h_dst).view(h_dst.shape[0], -1, F_out)
+            elif config.residual == "shared":
+                if isinstance(feat, tuple) or config.propagate_first:
+                    rst = rst + self.fc(h_dst).view(h_dst.shape[0], -1, F_out)
+                else:
+                    rst = rst + feat_src[:n_dst]
+            elif config.residual == "identity":
+                rst = rst + h_dst.view(h_dst.shape[0], -1, F_out)
+            if self.bias is not None:
+                rst = rst + self.bias
+            if self.activation is not None:
+                rst = self.activation(rst)
+            return rst
+
+
+def _copy(param, value):
+    with torch.no_grad():
+        param.copy_(value.reshape(param.shape))
+
+
+def _stack_hops(params, n):
+    # legacy per-hop ParameterLists / K x heads x features tensors -> 1 x heads x n x features
+    if isinstance(params, nn.ParameterList):
+        return torch.stack(list(params)[:n], dim=2)
+    if params.dim() == 3:
+        return params[:n].permute(1, 0, 2).unsqueeze(0)
+    return params[:, :, :n]
+
+
+def _attn_dst(attn_l, attn_r):
+    if attn_r is None:
+        return "none"
+    return "shared" if attn_r is attn_l else "separate"
+
+
+def from_legacy(conv):
+    """AGDNOp with the configuration and a copy of the parameters of a subproject's AGDNConv.
+
+    The outputs match the legacy forward up to floating point error, except where a variant's dropout was
+    applied differently (hop attention dropout in ogbn-proteins): AGDNOp has a single definition of each option.
+    """
+    H = conv._num_heads if hasattr(conv, "_num_heads") else conv._n_heads
+    params = {}
+    if hasattr(conv, "attn_src_fc"):
+        # ogbn-products / ogbn-proteins: attention from the input, symmetric softmax, hops 1..K
+        proteins = hasattr(conv, "attn_edge_fc")
+        weight_style = conv._weight_style if proteins else "HA"
+        if conv.dst_fc is conv.src_fc:
+            residual = "shared"
+        else:
+            residual = "linear" if conv.dst_fc is not None else "none"
+        config = AGDNConfig(
+            K=conv._K,
+            num_heads=H,
+            attn_drop=conv.attn_drop.p,
+            edge_drop=conv.edge_drop,
+            hop_attn_drop=conv.hop_attn_drop if proteins else 0.0,
+            negative_slope=conv.leaky_relu.negative_slope,
+            transition_matrix="gat_sym",
+            norm=conv._norm,
+            norm_prefix="" if proteins else "sub_",
+            attn_input=True,
+            attn_dst="separate" if conv.attn_dst_fc is not None else "none",
+            edge_feats=conv.attn_edge_fc.in_features if proteins and conv.attn_edge_fc is not None else 0,
+            include_self=False,
+            self_query=proteins,
+            batch_norm=conv._batch_norm,
+            weight_style=weight_style,
+            residual=residual,
+            residual_bias=True,
+            bias=residual == "none",
+            allow_zero_in_degree=conv._allow_zero_in_degree,
+        )
+        in_feats = conv._in_src_feats
+        params.update(fc=conv.src_fc.weight, attn_src_fc=conv.attn_src_fc.weight, position_emb=conv.position_emb)
+        if conv.attn_dst_fc is not None:
+            params["attn_dst_fc"] = conv.attn_dst_fc.weight
+        if config.edge_feats > 0:
+            params["attn_edge_fc"] = conv.attn_edge_fc.weight
+        if residual == "linear":
+            params.update(res_fc=conv.dst_fc.weight, res_fc_bias=conv.dst_fc.bias)
+        elif residual == "none":
+            params["bias"] = conv.bias
+    elif hasattr(conv, "_pre_act"):
+        # ogbl_no_sampling
+        if conv._weight_style == "lstm":
+            raise ValueError("AGDNOp has no lstm hop weighting")
+        tm = conv._transition_matrix
+        if tm.startswith("gat") and tm not in ["gat_sym", "gat_col"]:
+            tm = "gat"
+        separate_dst = conv.fc_dst is not conv.fc_src
+        config = AGDNConfig(
+            K=conv._K,
+            num_heads=H,
+            feat_drop=conv.feat_drop.p,
+            attn_drop=conv.attn_drop.p,
+            diffusion_drop=conv.diffusion_drop.p,
+            hop_attn_drop=conv.attn_drop.p if conv._weight_style == "HC" else 0.0,
+            attn_drop_per_hop=True,
+            negative_slope=conv.leaky_relu.negative_slope,
+            transition_matrix=tm,
+            attn_dst="shared" if tm.startswith("gat") and not conv._pre_act and conv.attn_r is conv.attn_l else "separate",
+            pre_act=conv._pre_act,
+            edge_weight=True,
+            share_weights=not separate_dst,
+            hop_norm=conv._hop_norm,
+            position_emb=conv._pos_emb,
+            weight_style=conv._weight_style,
+            hop_attn_scale=conv._weight_style in ["HA", "HA+HC"],
+            residual="linear" if conv.res_fc is not None else "none",
+            bias=conv.bias is not None,
+            allow_zero_in_degree=conv._allow_zero_in_degree,
+        )
+        in_feats = (conv._in_src_feats, conv._in_dst_feats) if separate_dst else conv._in_src_feats
+        params["fc"] = conv.fc_src.weight
+        if separate_dst:
+            params["fc_dst"] = conv.fc_dst.weight
+        if tm.startswith("gat"):
+            if conv._pre_act:
+                params["attn"] = conv.attn
+            else:
+                params.update(attn_l=conv.attn_l, attn_r=conv.attn_r)
+        if conv._pos_emb:
+            params["position_emb"] = conv.position_emb
+        if conv._weight_style in ["HA", "HA+HC"]:
+            params["beta"] = conv.beta
+    elif hasattr(conv, "scales"):
+        # ogbl_sampling_methods: batch norm hop transform, self query, hops 1..K
+        if conv._weight_style != "HA":
+            raise ValueError(f"The ogbl_sampling_methods AGDNConv has no parameters for {conv._weight_style}")
+        if isinstance(conv.res_fc, nn.Linear):
+            residual = "linear"
+        else:
+            residual = "identity" if conv.res_fc is not None else "none"
+        config = AGDNConfig(
+            K=conv._K,
+            num_heads=H,
+            feat_drop=conv.feat_drop.p,
+            attn_drop=conv.attn_drop.p,
+            hop_attn_drop=conv.attn_drop.p,
+            negative_slope=conv.leaky_relu.negative_slope,
+            transition_matrix="gat_sym",
+            edge_feats=conv.attn_e.shape[-1] if conv.attn_e is not None else 0,
+            include_self=False,
+            batch_norm=True,
+            position_emb=conv._pos_emb,
+            residual=residual,
+            bias=conv.bias is not None,
+            allow_zero_in_degree=conv._allow_zero_in_degree,
+        )
+        in_feats = (conv._in_src_feats, conv._in_dst_feats) if hasattr(conv, "fc_src") else conv._in_src_feats
+        if hasattr(conv, "fc_src"):
+            params.update(fc=conv.fc_src.weight, fc_dst=conv.fc_dst.weight)
+        else:
+            params["fc"] = conv.fc.weight
+        params.update(attn_l=conv.attn_l, attn_r=conv.attn_r)
+        if conv.attn_e is not None:
+            params["attn_edge_fc"] = conv.attn_e
+        if conv._pos_emb:
+            params["position_emb"] = conv.position_emb
+    elif hasattr(conv, "_propagate_first"):
+        # ogbn-arxiv / heterophily_datasets
+        if not isinstance(conv.fc, nn.Linear):
+            raise ValueError("Replicated AGDNConv (n_replicas > 1) is not supported")
+        tm = conv._transition_matrix
+        gat = tm.startswith("gat")
+        config = AGDNConfig(
+            K=conv._K,
+            num_heads=H,
+            feat_drop=conv.feat_drop.p,
+            attn_drop=conv.attn_drop.p,
+            edge_drop=conv.edge_drop,
+            diffusion_drop=conv.diffusion_drop,
+            negative_slope=conv.leaky_relu.negative_slope,
+            transition_matrix="gat" if tm == "gat_adj" else tm,
+            norm="adj" if tm == "gat_adj" else "none",
+            attn_dst=_attn_dst(conv.attn_l, conv.attn_r) if gat else "separate",
+            propagate_first=conv._propagate_first,
+            batch_norm=conv._batch_norm,
+            position_emb=conv._position_emb,
+            weight_style=conv._weight_style,
+            HA_activation=conv._HA_activation,
+            residual="linear" if conv.res_fc is not None else "none",
+            bias=conv.bias is not None,
+            allow_zero_in_degree=conv._allow_zero_in_degree,
+        )
+        in_feats = conv._in_src_feats
+        params["fc"] = conv.fc.weight
+        if gat:
+            params["attn_l"] = conv.attn_l
+            if config.attn_dst == "separate":
+                params["attn_r"] = conv.attn_r
+        if conv._position_emb:
+            params["position_emb"] = conv.position_emb
+    else:
+        raise ValueError(f"Unknown AGDNConv variant: {type(conv).__module__}.{type(conv).__name__}")
+
+    # parameters with the same meaning everywhere
+    if config.weight_style in ["HA", "HA+HC"]:
+        params.update(hop_attn_l=conv.hop_attn_l, hop_attn_r=conv.hop_attn_r)
+    if config.weight_style in ["HC", "HA+HC"]:
+        params["weights"] = conv.weights
+    if config.batch_norm:
+        params.update(hop_scale=conv.scale, hop_offset=conv.offset)
+    if config.residual == "linear" and "res_fc" not in params:
+        params["res_fc"] = conv.res_fc.weight
+    if config.bias and "bias" not in params:
+        params["bias"] = conv.bias
+
+    # ogbn-arxiv / heterophily_datasets keep the activation in _activation
+    activation = conv.activation if hasattr(conv, "activation") else conv._activation
+    op = AGDNOp(in_feats, conv._out_feats, config, activation=activation)
+    for name, value in params.items():
+        if name in ["position_emb", "hop_scale", "hop_offset"]:
+            # legacy layouts put the hops first (K x heads x features) or keep one parameter per hop
+            value = _stack_hops(value, config.n_hops)
+        if name == "res_fc_bias":
+            _copy(op.res_fc.bias, value)
+        elif name in ["fc", "fc_dst", "attn_src_fc", "attn_dst_fc", "attn_edge_fc", "res_fc"]:
+            _copy(getattr(op, name).weight, value)
+        else:
+            _copy(getattr(op, name), value)
+    op.train(conv.training)
+    return op.to(next(conv.parameters()).device)
+
+
+def convert(model):
+    """Swap every AGDNConv of model for the equivalent AGDNOp, in place. Returns model."""
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child).__name__ == "AGDNConv":
+                setattr(module, name, from_legacy(child))
+    return model
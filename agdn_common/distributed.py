@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# CPU data-parallel training with the gloo backend. Every host runs the script once; launch() spawns n_procs
+# workers there, which join one process group with all other hosts' workers. Everything below is a no-op (or the
+# single-process answer) when no process group is initialized, so training code can call it unconditionally.
+
+
+# cluster assignments are drawn from their own generator, so that the global numpy state (e.g. label masks) stays
+# the same on all workers
+_rng = np.random.default_rng(0)
+
+
+def seed(value):
+    global _rng
+    _rng = np.random.default_rng(value)
+
+
+def enabled():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if enabled() else 0
+
+
+def world_size():
+    return dist.get_world_size() if enabled() else 1
+
+
+def is_coordinator():
+    return rank() == 0
+
+
+def share_graph(graph):
+    """Builds all sparse formats and moves the features to shared memory before the graph goes to the workers.
+
+    Passing the graph to spawned workers then maps the same memory: DGL registers reductions that send the
+    graph structure through shared memory and torch.multiprocessing does the same for the feature tensors.
+    """
+    graph.create_formats_()
+    for frame in [graph.ndata, graph.edata]:
+        for key in list(frame.keys()):
+            frame[key].share_memory_()
+    return graph
+
+
+def _worker(local_rank, fn, n_procs, n_hosts, host_rank, init_method, n_threads, args):
+    dist.init_process_group(
+        "gloo", init_method=init_method, rank=host_rank * n_procs + local_rank, world_size=n_hosts * n_procs
+    )
+    torch.set_num_threads(n_threads)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, args, n_procs, n_hosts=1, host_rank=0, init_method="tcp://127.0.0.1:29500", n_threads=0):
+    """Runs fn(*args) in n_procs workers on this host, ranks host_rank * n_procs ... (host_rank + 1) * n_procs - 1.
+
+    Workers are spawned, i.e. they import the main module afresh and fn has to restore any global state. With
+    n_threads <= 0 the cores of this host are split evenly between the workers.
+    """
+    if n_threads <= 0:
+        n_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        n_threads = max(1, n_cores // n_procs)
+    mp.spawn(_worker, args=(fn, n_procs, n_hosts, host_rank, init_method, n_threads, args), nprocs=n_procs, join=True)
+
+
+def barrier():
+    if enabled():
+        dist.barrier()
+
+
+def broadcast_parameters(model):
+    # the same seed gives the same initialization everywhere, this makes sure of it
+    if enabled():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, 0)
+
+
+def broadcast_value(value):
+    """value of the coordinator, e.g. a validation score only it computed."""
+    if not enabled():
+        return value
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.broadcast(tensor, 0)
+    return tensor.item()
+
+
+def all_reduce_sum(*values):
+    if not enabled():
+        return values
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tuple(tensor.tolist())
+
+
+def partitions(partition_fn, num_clusters, graph):
+    """This worker's share of an epoch of random partitions: an iterator of (batch_nodes, subgraph), or None for
+    padding steps.
+
+    The coordinator draws the cluster of every node and broadcasts it, worker r takes partitions r, r + P, ... of
+    the P workers. Workers that run out of partitions yield None, so that every worker takes the same number of
+    steps (and all-reduces). partition_fn is random_partition_v2 of the calling subproject. The broadcast runs
+    here, in the calling thread; the returned iterator only builds subgraphs and may run in a pipeline.Prefetcher.
+    """
+    n_nodes = graph.num_nodes()
+    if is_coordinator():
+        cluster_id = torch.from_numpy(_rng.integers(low=0, high=num_clusters, size=n_nodes, dtype=np.int64))
+    else:
+        cluster_id = torch.empty(n_nodes, dtype=torch.int64)
+    dist.broadcast(cluster_id, 0)
+
+    parts = list(range(rank(), num_clusters, world_size()))
+    n_steps = (num_clusters + world_size() - 1) // world_size()
+    return _partitions(partition_fn(num_clusters, graph, cluster_id=cluster_id.numpy(), parts=parts), n_steps - len(parts))
+
+
+def _partitions(own, n_padding):
+    yield from own
+    for _ in range(n_padding):
+        yield None
+
+
+def shard(ids):
+    """This worker's share ids[rank::world_size], cut to the same length on all workers so that they all take the
+    same number of steps (at most world_size - 1 ids are dropped)."""
+    if not enabled():
+        return ids
+    return ids[rank() :: world_size()][: len(ids) // world_size()]
+
+
+def all_reduce_gradients(parameters, weight):
+    """Replaces the gradients by their weighted average over all workers, in a single all-reduce.
+
+    weight is this worker's share of the step, e.g. the number of nodes its loss is averaged over, so that the
+    result is the gradient of the loss over the union of all workers' nodes. Workers with weight 0 (padding steps,
+    partitions without training nodes) contribute nothing but still receive the average.
+    """
+    params = [p for p in parameters if p.requires_grad]
+    if weight > 0:
+        grads = [(p.grad if p.grad is not None else torch.zeros_like(p)).flatten() * weight for p in params]
+    else:
+        grads = [torch.zeros(p.numel(), dtype=p.dtype, device=p.device) for p in params]
+    flat = torch.cat(grads + [torch.tensor([float(weight)], dtype=params[0].dtype, device=params[0].device)])
+    dist.all_reduce(flat)
+    flat = flat[:-1] / flat[-1].clamp(min=1e-12)
+    offset = 0
+    for p in params:
+        p.grad = flat[offset : offset + p.numel()].view_as(p)
+        offset += p.numel()
+
+
+def all_reduce_rows(param, index, weight):
+    """all_reduce_gradients for a table whose gradient is zero outside of rows index, e.g. the embeddings of a
+    batch's input nodes. Only those rows are exchanged (all-gathered) and summed into a dense gradient."""
+    index = torch.unique(index.to(param.device))
+    if weight > 0 and param.grad is not None:
+        rows = param.grad[index] * weight
+    else:
+        index, rows = index[:0], param.new_zeros((0,) + param.shape[1:])
+
+    (total,) = all_reduce_sum(weight)
+    grad = torch.zeros_like(param)
+    grad.index_add_(0, torch.cat(all_gather_rows(index)), torch.cat(all_gather_rows(rows)))
+    param.grad = grad / max(total, 1e-12)
+
+
+def all_gather_rows(tensor):
+    """Every worker's tensor, in rank order. The tensors may differ in their first dimension only."""
+    if not enabled():
+        return [tensor]
+    sizes = [torch.zeros(1, dtype=torch.int64) for _ in range(world_size())]
+    dist.all_gather(sizes, torch.tensor([len(tensor)], dtype=torch.int64))
+    max_size = max(int(size) for size in sizes)
+    padded = tensor.new_zeros((max_size,) + tensor.shape[1:])
+    padded[: len(tensor)] = tensor
+    gathered = [torch.empty_like(padded) for _ in range(world_size())]
+    dist.all_gather(gathered, padded)
+    return [rows[: int(size)] for size, rows in zip(sizes, gathered)]
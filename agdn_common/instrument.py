@@ -0,0 +1,156 @@
+import contextlib
+import json
+import os
+import resource
+import time
+
+import torch
+
+# Opt-in stage timing. All functions below are no-ops until enable() is called, so the hooks can stay in the
+# model and training code: a disabled begin()/end() pair costs one global lookup and a comparison.
+_tracer = None
+_null_stage = contextlib.nullcontext()
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def memory_bytes(cuda):
+    """Allocated CUDA memory, or the resident set size of the process on CPU."""
+    if cuda:
+        return torch.cuda.memory_allocated()
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _page_size
+    except OSError:
+        # peak instead of current RSS where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Tracer(object):
+    """Records wall time and memory of named, possibly nested, stages.
+
+    Stats are aggregated per stage name and written as one JSON line per epoch_end() call. With chrome_path every
+    stage is also kept as a complete event and dumped in Chrome trace format (chrome://tracing, Perfetto) on close().
+    On cuda devices memory is the allocated CUDA memory and, with sync, the stream is synchronized at stage
+    boundaries, otherwise GPU times are only launch times.
+    """
+
+    def __init__(self, path, chrome_path=None, cuda=False, sync=True):
+        self.file = open(path, "w")
+        self.chrome_path = chrome_path
+        self.cuda = cuda
+        self.sync = sync
+        self.stack = []
+        self.stats = {}
+        self.events = []
+        self.t0 = time.perf_counter()
+        self.pid = os.getpid()
+
+    def begin(self, name):
+        if self.cuda and self.sync:
+            torch.cuda.synchronize()
+        self.stack.append((name, time.perf_counter()))
+
+    def end(self):
+        if self.cuda and self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        mem = memory_bytes(self.cuda)
+        # count, seconds, max memory at the end of the stage
+        stat = self.stats.setdefault(name, [0, 0.0, 0])
+        stat[0] += 1
+        stat[1] += now - start
+        stat[2] = max(stat[2], mem)
+        if self.chrome_path:
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.t0) * 1e6,
+                    "dur": (now - start) * 1e6,
+                    "pid": self.pid,
+                    "tid": len(self.stack),
+                    "args": {"memory": mem},
+                }
+            )
+
+    def epoch_end(self, epoch, **info):
+        record = dict(epoch=epoch, **info)
+        record["stages"] = {
+            name: {"count": count, "time": seconds, "max_memory": mem} for name, (count, seconds, mem) in self.stats.items()
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.stats = {}
+
+    def close(self):
+        self.file.close()
+        if self.chrome_path:
+            with open(self.chrome_path, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def enable(path, chrome_path=None, cuda=False, sync=True):
+    global _tracer
+    _tracer = Tracer(path, chrome_path, cuda, sync)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def begin(name, index=None):
+    # index is appended to the name (e.g. hop 3 -> "hop3") only when tracing, so disabled calls never format strings
+    if _tracer is not None:
+        _tracer.begin(name if index is None else f"{name}{index}")
+
+
+def end():
+    if _tracer is not None:
+        _tracer.end()
+
+
+@contextlib.contextmanager
+def _stage(name):
+    _tracer.begin(name)
+    try:
+        yield
+    finally:
+        _tracer.end()
+
+
+def stage(name):
+    return _stage(name) if _tracer is not None else _null_stage
+
+
+def iterate(iterable, name="sampling"):
+    """Yields from iterable and times every next() as stage name, i.e. the time spent waiting for the batch."""
+    if _tracer is None:
+        return iterable
+    return _traced(iterable, name)
+
+
+def _traced(iterable, name):
+    it = iter(iterable)
+    while True:
+        _tracer.begin(name)
+        try:
+            item = next(it)
+        except StopIteration:
+            _tracer.end()
+            return
+        _tracer.end()
+        yield item
+
+
+def epoch_end(epoch, **info):
+    if _tracer is not None:
+        _tracer.epoch_end(epoch, **info)
+
+
+def close():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
@@ -0,0 +1,179 @@
+import threading
+import time
+
+import torch
+
+from agdn_common import instrument
+
+GB = 2 ** 30
+# int64 src, dst and edge ids of the COO / CSR formats DGL builds for message passing
+STRUCTURE_BYTES_PER_EDGE = 3 * 8
+# weighting styles that keep a transformed copy of every hop for the hop attention / concatenation
+HOP_WISE_STYLES = ["HA", "HC", "HA+HC", "HA1", "lstm"]
+
+
+class AGDNMemoryModel(object):
+    """Rough activation memory of a stack of AGDN layers on a graph of a given size.
+
+    Per layer and node autograd keeps the K + 1 hops, a transformed copy of them for HA / HC weighting and a few
+    node-sized tensors (residual, norm, activation, dropout masks); per layer and edge the attention logits,
+    softmax, dropout mask and the per-hop transition values of every head. Backward adds about one more layer on
+    top. Without autograd only about two layers are alive at a time. Graph structure and the input node / edge
+    features are counted once.
+    """
+
+    def __init__(self, n_layers, n_hidden, n_heads=1, K=1, weight_style="HA", n_node_feats=0, n_edge_feats=0, value_bytes=4):
+        self.n_layers = n_layers
+        self.n_hidden = n_hidden
+        self.n_heads = n_heads
+        self.K = K
+        self.weight_style = weight_style
+        self.n_node_feats = n_node_feats
+        self.n_edge_feats = n_edge_feats
+        self.value_bytes = value_bytes
+
+    def __repr__(self):
+        return (
+            f"layers: {self.n_layers}, hidden: {self.n_hidden}, heads: {self.n_heads}, K: {self.K}, "
+            f"weight style: {self.weight_style}, node feats: {self.n_node_feats}, edge feats: {self.n_edge_feats}"
+        )
+
+    def layer_node_values(self):
+        hidden = self.n_heads * self.n_hidden
+        values = hidden * (self.K + 1) + 5 * hidden
+        if self.weight_style in HOP_WISE_STYLES:
+            values += hidden * (self.K + 1) + 2 * self.n_heads * (self.K + 1)
+        return values
+
+    def layer_edge_values(self):
+        values = self.n_heads * (4 + self.K)
+        if self.n_edge_feats > 0:
+            # edge features projected to one attention logit per head
+            values += self.n_heads
+        return values
+
+    def activation_bytes(self, n_nodes, n_edges, training=True):
+        n_layers = self.n_layers + 1 if training else min(self.n_layers, 2)
+        values = n_nodes * (self.n_node_feats + n_layers * self.layer_node_values())
+        values += n_edges * (self.n_edge_feats + n_layers * self.layer_edge_values())
+        return values * self.value_bytes + n_edges * STRUCTURE_BYTES_PER_EDGE
+
+
+def partition_size(n_nodes, n_edges, n_partitions):
+    # random_partition_v2 assigns every node to a uniformly random cluster and keeps the edges inside a cluster,
+    # i.e. 1 / n_partitions of the nodes and 1 / n_partitions ** 2 of the edges per partition
+    return n_nodes / n_partitions, n_edges / n_partitions ** 2
+
+
+def optimizer_state_bytes(parameters, n_states=2):
+    # Adam(W) allocates exp_avg and exp_avg_sq on the first step, after any probe
+    return n_states * sum(p.numel() * p.element_size() for p in parameters if p.requires_grad)
+
+
+class PeakMemory(object):
+    """Peak allocated CUDA memory, or peak RSS sampled in a background thread on CPU, inside the with block.
+
+    RSS includes everything the process holds (dataset, allocator caches), so on CPU the budget is one for the
+    whole process.
+    """
+
+    def __init__(self, cuda=False, interval=0.001):
+        self.cuda = cuda
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, instrument.memory_bytes(False))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self.peak = instrument.memory_bytes(False)
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            torch.cuda.synchronize()
+            self.peak = torch.cuda.max_memory_allocated()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, instrument.memory_bytes(False))
+
+
+def is_out_of_memory(e):
+    # CUDA and CPU allocators raise RuntimeError, Python MemoryError
+    return isinstance(e, MemoryError) or "out of memory" in str(e) or "can't allocate memory" in str(e)
+
+
+def plan(estimate, budget, candidates, probe, reserve=0, cuda=False, max_probes=3, name="candidate"):
+    """Pick the first of candidates whose estimated peak fits into budget bytes and check it with probe steps.
+
+    estimate(c) is the activation memory of candidate c and probe(c) runs one step with it. Memory already in use
+    plus reserve (e.g. optimizer state that only the first real step allocates) counts against the budget. After
+    every probe the estimate is rescaled by measured / estimated activations and the choice is redone, until it
+    picks a candidate that was already probed or max_probes is reached. A probe that runs out of memory counts as
+    over budget and at least doubles the scale, past the budget for that candidate. Returns the first candidate
+    whose probe fitted, or the last candidate if none did.
+    """
+    baseline = instrument.memory_bytes(cuda) + reserve
+    scale = 1.0
+    probed = {}
+    for _ in range(max_probes):
+        choice = next((c for c in candidates if baseline + scale * estimate(c) <= budget), candidates[-1])
+        if choice in probed:
+            break
+        expected = baseline + scale * estimate(choice)
+        out_of_memory = False
+        try:
+            with PeakMemory(cuda) as peak:
+                probe(choice)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e):
+                raise
+            out_of_memory = True
+        if out_of_memory:
+            # outside of the except block, so that the traceback no longer holds the probe's tensors
+            if cuda:
+                torch.cuda.empty_cache()
+            probed[choice] = float("inf")
+            print(f"Memory probe, {name}: {choice}, estimated {expected / GB:.2f} GB, out of memory")
+            scale = 2 * max(scale, (budget - baseline) / max(estimate(choice), 1))
+            continue
+        probed[choice] = peak.peak + reserve
+        print(f"Memory probe, {name}: {choice}, estimated {expected / GB:.2f} GB, measured {probed[choice] / GB:.2f} GB")
+        scale = max(probed[choice] - baseline, 1) / max(estimate(choice), 1)
+
+    fitting = [c for c in candidates if c in probed and probed[c] <= budget]
+    if fitting:
+        return fitting[0]
+    print(f"No probed {name} fits into {budget / GB:.2f} GB, using {candidates[-1]}")
+    return candidates[-1]
+
+
+def plan_partitions(memory_model, n_nodes, n_edges, budget, probe, training=True, reserve=0, cuda=False, max_partitions=256):
+    """Smallest number of random partitions whose training (or inference) step fits into budget bytes."""
+    candidates = list(range(1, max_partitions + 1))
+    estimate = lambda n: memory_model.activation_bytes(*partition_size(n_nodes, n_edges, n), training=training)
+    name = "train partitions" if training else "eval partitions"
+    return plan(estimate, budget, candidates, probe, reserve=reserve, cuda=cuda, name=name)
+
+
+def plan_batch_size(memory_model, n_nodes, n_edges, n_pairs, pair_values, budget, probe, reserve=0, cuda=False, granularity=1024):
+    """Largest multiple of granularity (up to n_pairs) whose full-graph step fits into budget bytes.
+
+    The encoder runs on the full graph for every batch, so only the pair-wise part (pair_values floats per
+    training pair, e.g. gathered embeddings and predictor activations) grows with the batch size.
+    """
+    top = max((n_pairs + granularity - 1) // granularity, 1) * granularity
+    candidates = list(range(top, 0, -granularity))
+    graph_bytes = memory_model.activation_bytes(n_nodes, n_edges)
+    estimate = lambda batch_size: graph_bytes + batch_size * pair_values * memory_model.value_bytes
+    return plan(estimate, budget, candidates, probe, reserve=reserve, cuda=cuda, name="batch size")
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+
+from agdn_common import instrument
+
+# Pipelined training batches: a background thread takes the next item from the sampler and runs prepare on it
+# (feature gathering, label injection, .to(device)) while the training loop computes on the previous ones. The
+# time the loop waits for a ready batch is accumulated as stall time, with or without the thread.
+_stall = 0.0
+_n_batches = 0
+_END = object()
+
+
+def pop_stats():
+    """(stall seconds, batches) since the last call, e.g. per epoch."""
+    global _stall, _n_batches
+    stats = (_stall, _n_batches)
+    _stall, _n_batches = 0.0, 0
+    return stats
+
+
+class Prefetcher(object):
+    """Iterates prepare(item) for the items of iterable, up to depth prepared items ahead of the consumer.
+
+    With depth <= 0 sampling and prepare run in the loop as before, traced as stage name and "h2d", and all of it
+    counts as stall time. Otherwise they run in a daemon thread, which overlaps them with the model's compute
+    (also on CPU, where sampling and gathering are C++ that releases the GIL), and only waiting for the queue is
+    traced, as "stall". Neither prepare nor iterating iterable may use instrument (the tracer is not thread-safe)
+    or collectives, and copies go through the default stream of the device, so on GPUs the overlap is that of
+    the host side.
+    """
+
+    def __init__(self, iterable, prepare=None, depth=1, name="sampling"):
+        self.iterable = iterable
+        self.prepare = prepare
+        self.depth = depth
+        self.name = name
+
+    def __iter__(self):
+        return self._pipelined() if self.depth > 0 else self._sequential()
+
+    def _sequential(self):
+        global _stall, _n_batches
+        it = iter(instrument.iterate(self.iterable, self.name))
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            if self.prepare is not None:
+                with instrument.stage("h2d"):
+                    item = self.prepare(item)
+            _stall += time.perf_counter() - start
+            _n_batches += 1
+            yield item
+
+    def _produce(self, items, stop):
+        def put(entry):
+            # gives up when the consumer has stopped, e.g. after a break out of the training loop
+            while not stop.is_set():
+                try:
+                    items.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for item in self.iterable:
+                if not put((self.prepare(item) if self.prepare is not None else item, None)):
+                    return
+        except BaseException as e:
+            put((None, e))
+            return
+        put((_END, None))
+
+    def _pipelined(self):
+        global _stall, _n_batches
+        items = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(items, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                with instrument.stage("stall"):
+                    item, error = items.get()
+                _stall += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                if item is _END:
+                    return
+                _n_batches += 1
+                yield item
+        finally:
+            stop.set()
+            thread.join()
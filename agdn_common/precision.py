@@ -0,0 +1,74 @@
+import contextlib
+import functools
+
+import dgl
+import dgl.function as fn
+import torch
+from dgl.ops import edge_softmax as _edge_softmax
+
+# --precision bf16 runs forward passes under torch.autocast with bfloat16: projections (linear / matmul) and what is
+# computed from them, i.e. attention logits, edge attention and the diffused hops, are bfloat16, which halves
+# activation and hop memory. Softmax normalizers are computed in float32 (edge_softmax below, the hop attention
+# softmax in the convs) and so are hop attention scores and weighted hop sums, which mix in float32 parameters.
+PRECISIONS = ["fp32", "bf16"]
+DTYPES = {"bf16": torch.bfloat16}
+
+
+def autocast(precision, device_type="cpu"):
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=DTYPES[precision])
+
+
+def supported(precision, device):
+    """Whether torch has autocast for device (torch>=1.10) and the DGL build bfloat16 message passing kernels."""
+    if precision == "fp32":
+        return True
+    if not hasattr(torch, "autocast"):
+        return False
+    try:
+        graph = dgl.graph(([0, 1], [1, 1])).to(device)
+        graph.srcdata["h"] = torch.ones(2, 1, dtype=DTYPES[precision], device=device)
+        graph.edata["a"] = torch.ones(2, 1, dtype=DTYPES[precision], device=device)
+        graph.update_all(fn.u_mul_e("h", "a", "m"), fn.sum("m", "h"))
+    except (RuntimeError, dgl.DGLError):
+        return False
+    return True
+
+
+def _autocast_enabled():
+    # torch.is_autocast_cpu_enabled only exists since torch 1.10
+    return torch.is_autocast_enabled() or getattr(torch, "is_autocast_cpu_enabled", lambda: False)()
+
+
+def apply(model, precision):
+    """Runs model's forward under autocast on the device of its parameters and returns a tensor output as float32,
+    so that losses, evaluators and prediction buffers are unchanged. A no-op for fp32."""
+    if precision == "fp32":
+        return model
+    forward = model.forward
+
+    @functools.wraps(forward)
+    def autocast_forward(*args, **kwargs):
+        with autocast(precision, next(model.parameters()).device.type):
+            rst = forward(*args, **kwargs)
+        return rst.float() if torch.is_tensor(rst) else rst
+
+    model.forward = autocast_forward
+    return model
+
+
+def edge_softmax(graph, logits, **kwargs):
+    """dgl.ops.edge_softmax with the max / sum normalizers in float32, cast back to the dtype of logits."""
+    if logits.dtype == torch.float32 and not _autocast_enabled():
+        return _edge_softmax(graph, logits, **kwargs)
+    with torch.autocast(device_type=logits.device.type, enabled=False):
+        return _edge_softmax(graph, logits.float(), **kwargs).to(logits.dtype)
+
+
+def fp32_matmul(a, b):
+    """torch.matmul in float32, also under autocast, e.g. for sums weighted by hop attention."""
+    if a.dtype == b.dtype == torch.float32 and not _autocast_enabled():
+        return torch.matmul(a, b)
+    with torch.autocast(device_type=a.device.type, enabled=False):
+        return torch.matmul(a.float(), b.float())
@@ -0,0 +1,129 @@
+import gc
+import itertools
+import os
+import time
+
+import torch
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+# cores and intra-op threads of the process before any plan narrowed them
+_initial_cores = available_cores()
+_initial_threads = torch.get_num_threads()
+
+
+def restore():
+    """Undoes ResourcePlan.apply: the process' initial affinity and thread count."""
+    torch.set_num_threads(_initial_threads)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, _initial_cores)
+
+
+class ResourcePlan(object):
+    """How the available cores are split between sampler workers and the main process.
+
+    n_workers < 0 keeps the loader's own default worker count, main_threads <= 0
+    keeps PyTorch's default intra-op thread count. With pin=True the main process
+    is bound to the first main_threads cores and every sampler worker to its own
+    slice of the remaining ones.
+    """
+
+    def __init__(self, n_workers=-1, worker_threads=1, main_threads=0, pin=False, cores=None):
+        self.n_workers = n_workers
+        self.worker_threads = worker_threads
+        self.main_threads = main_threads
+        self.pin = pin
+        self.cores = cores if cores is not None else _initial_cores
+
+    def __repr__(self):
+        return (
+            f"workers: {self.n_workers}, worker threads: {self.worker_threads}, "
+            f"main threads: {self.main_threads if self.main_threads > 0 else torch.get_num_threads()}, pin: {self.pin}"
+        )
+
+    def num_workers(self, default):
+        return self.n_workers if self.n_workers >= 0 else default
+
+    def main_cores(self):
+        if self.main_threads <= 0:
+            return self.cores
+        return self.cores[: self.main_threads]
+
+    def worker_cores(self, worker_id):
+        cores = self.cores[self.main_threads :] if 0 < self.main_threads < len(self.cores) else self.cores
+        start = (worker_id * self.worker_threads) % len(cores)
+        return [cores[(start + i) % len(cores)] for i in range(self.worker_threads)]
+
+    def apply(self):
+        restore()
+        if self.main_threads > 0:
+            torch.set_num_threads(self.main_threads)
+        if self.pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.main_cores())
+
+    def worker_init_fn(self, worker_id):
+        torch.set_num_threads(self.worker_threads)
+        if self.pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.worker_cores(worker_id))
+
+
+def candidate_plans(cores=None):
+    cores = cores if cores is not None else _initial_cores
+    n_cores = len(cores)
+    plans = [ResourcePlan(0, 1, n_cores, pin=True, cores=cores)]
+    for n_workers in sorted({2, 4, 8, 10, n_cores // 2, n_cores - 1}):
+        if n_workers <= 0 or n_workers >= n_cores:
+            continue
+        # one thread per worker, the rest to the main process
+        plans.append(ResourcePlan(n_workers, 1, n_cores - n_workers, pin=True, cores=cores))
+        # half of the cores to the main process, the other half shared by the workers
+        if n_workers < n_cores // 2:
+            worker_threads = max(1, (n_cores - n_cores // 2) // n_workers)
+            plans.append(ResourcePlan(n_workers, worker_threads, n_cores // 2, pin=True, cores=cores))
+    return plans
+
+
+def tune_resources(make_loader, n_batches=20, step=None, plans=None, warmup=2):
+    """Benchmark n_batches of make_loader(plan) for every candidate plan.
+
+    step(batch) optionally runs the model on each batch, so that sampling and
+    compute compete for the cores as they do during training. The first warmup
+    batches of every plan run but are not timed, so that starting the loader
+    and its worker processes does not count, and the loader is shut down before
+    the next plan starts its own. Every plan starts from the process' initial
+    affinity and thread count, and so does the best one, which is applied and
+    returned together with all (plan, batches per second) results. The
+    throughput of every plan is printed.
+    """
+    plans = plans if plans is not None else candidate_plans()
+    results = []
+    for plan in plans:
+        plan.apply()
+        batches = iter(make_loader(plan))
+        for batch in itertools.islice(batches, warmup):
+            if step is not None:
+                step(batch)
+        tic = time.time()
+        n = 0
+        for batch in itertools.islice(batches, n_batches):
+            if step is not None:
+                step(batch)
+            n += 1
+        throughput = n / max(time.time() - tic, 1e-9)
+        print(f"{plan}, throughput: {throughput:.2f} batches/s")
+        results.append((plan, throughput))
+        # the last reference to the loader iterator, deleting it shuts its worker processes down
+        batch = None
+        del batches
+        gc.collect()
+
+    best_plan = max(results, key=lambda x: x[1])[0]
+    best_plan.apply()
+    print(f"Selected resource plan: {best_plan}")
+    return best_plan, results
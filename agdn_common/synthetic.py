@@ -0,0 +1,215 @@
+import dgl
+import torch
+
+SYNTHETIC_PREFIX = "synthetic-"
+
+# Sizes of the real datasets at scale 1. Edge counts are the number of distinct (undirected) pairs; undirected
+# graphs store both directions like the OGB loaders do. gamma is the exponent of the power-law the expected
+# degrees follow (Chung-Lu), larger values give flatter degree distributions.
+NODE_PROFILES = {
+    "ogbn-arxiv": dict(n_nodes=169343, n_edges=1166243, directed=True, gamma=2.6, n_feats=128, n_classes=40,
+                       split=(0.537, 0.176, 0.287)),
+    "ogbn-proteins": dict(n_nodes=132534, n_edges=39561252 // 2, directed=False, gamma=5.0, n_edge_feats=8, n_tasks=112,
+                          n_species=8, split=(0.654, 0.160, 0.186)),
+    "ogbn-products": dict(n_nodes=2449029, n_edges=61859140, directed=False, gamma=2.4, n_feats=100, n_classes=47,
+                          split=(0.080, 0.016, 0.904)),
+}
+
+LINK_PROFILES = {
+    "ogbl-collab": dict(n_nodes=235868, n_edges=(1179052, 60084, 46329), directed=False, gamma=2.5, n_feats=128,
+                        n_neg=(100000, 100000)),
+    "ogbl-ppa": dict(n_nodes=576289, n_edges=(21231931, 3000000, 3000000), directed=False, gamma=2.3, n_feats=58,
+                     n_neg=(3000000, 3000000)),
+    "ogbl-ddi": dict(n_nodes=4267, n_edges=(1067911, 133489, 133489), directed=False, gamma=4.0,
+                     n_neg=(101882, 95599)),
+    "ogbl-citation2": dict(n_nodes=2927963, n_edges=(30387995, 86956, 86956), directed=True, gamma=2.5, n_feats=128,
+                           n_target_neg=1000),
+}
+
+
+def split_synthetic(name):
+    """'synthetic-ogbl-collab' -> ('ogbl-collab', True), any other name -> (name, False)."""
+    if name.startswith(SYNTHETIC_PREFIX):
+        return name[len(SYNTHETIC_PREFIX) :], True
+    return name, False
+
+
+def scaled(n, scale, minimum=1):
+    return max(int(round(n * scale)), minimum)
+
+
+def expected_degrees(n_nodes, gamma, generator):
+    # w_i ~ (i + 1)^(-1 / (gamma - 1)) gives a degree distribution with tail P(d) ~ d^-gamma
+    w = torch.arange(1, n_nodes + 1, dtype=torch.float64).pow(-1.0 / (gamma - 1))
+    return w[torch.randperm(n_nodes, generator=generator)]
+
+
+def sample_nodes(cdf, n, generator):
+    return torch.searchsorted(cdf, torch.rand(n, dtype=torch.float64, generator=generator) * cdf[-1]).clamp(max=len(cdf) - 1)
+
+
+def chung_lu_edges(n_nodes, n_edges, gamma, directed, generator):
+    """n_edges distinct pairs without self-loops whose endpoints are drawn proportionally to power-law weights.
+
+    For directed graphs only the destinations (the cited side) are skewed, the sources are uniform. Undirected
+    pairs are returned with src < dst.
+    """
+    n_edges = min(n_edges, n_nodes * (n_nodes - 1) // (1 if directed else 2))
+    cdf_dst = torch.cumsum(expected_degrees(n_nodes, gamma, generator), 0)
+    cdf_src = torch.arange(1, n_nodes + 1, dtype=torch.float64) if directed else cdf_dst
+
+    keys = torch.empty(0, dtype=torch.int64)
+    while len(keys) < n_edges:
+        # oversample a little, duplicates and self-loops are dropped below
+        n = int((n_edges - len(keys)) * 1.1) + 16
+        src, dst = sample_nodes(cdf_src, n, generator), sample_nodes(cdf_dst, n, generator)
+        if not directed:
+            src, dst = torch.min(src, dst), torch.max(src, dst)
+        mask = src != dst
+        keys = torch.unique(torch.cat([keys, src[mask] * n_nodes + dst[mask]]))
+    keys = keys[torch.randperm(len(keys), generator=generator)[:n_edges]]
+    return keys // n_nodes, keys % n_nodes
+
+
+def label_features(labels, n_feats, generator, noise=1.0):
+    # class centroids plus noise, so that the features are informative about the labels
+    centroids = torch.randn(int(labels.max()) + 1, n_feats, generator=generator)
+    return centroids[labels] + noise * torch.randn(len(labels), n_feats, generator=generator)
+
+
+def random_split(n, fractions, generator):
+    perm = torch.randperm(n, generator=generator)
+    n_train, n_valid = int(n * fractions[0]), int(n * fractions[1])
+    return {"train": perm[:n_train], "valid": perm[n_train : n_train + n_valid], "test": perm[n_train + n_valid :]}
+
+
+def to_graph(src, dst, n_nodes, directed):
+    if directed:
+        return dgl.graph((src, dst), num_nodes=n_nodes)
+    return dgl.graph((torch.cat([src, dst]), torch.cat([dst, src])), num_nodes=n_nodes)
+
+
+class SyntheticNodePropPredDataset(object):
+    """Drop-in for DglNodePropPredDataset with random data of the same schema.
+
+    Node and edge counts are multiplied by scale, so that the average degree stays the same as in the real
+    dataset. The same (name, scale, seed) always gives the same graph.
+    """
+
+    def __init__(self, name, scale=1.0, seed=0):
+        assert name in NODE_PROFILES, f"No synthetic version of {name}, choose from {list(NODE_PROFILES)}"
+        self.name = name
+        profile = NODE_PROFILES[name]
+        generator = torch.Generator().manual_seed(seed)
+        n_nodes = scaled(profile["n_nodes"], scale, minimum=16)
+        src, dst = chung_lu_edges(n_nodes, scaled(profile["n_edges"], scale), profile["gamma"], profile["directed"], generator)
+        self.graph = to_graph(src, dst, n_nodes, profile["directed"])
+
+        if name == "ogbn-proteins":
+            self.num_tasks = profile["n_tasks"]
+            self.labels = (torch.rand(n_nodes, self.num_tasks, generator=generator) < 0.15).long()
+            n_edges = self.graph.number_of_edges()
+            # both directions of an edge share its features
+            feat = torch.rand(n_edges // 2, profile["n_edge_feats"], generator=generator) * (
+                torch.rand(n_edges // 2, 1, generator=generator) < 0.3
+            )
+            self.graph.edata["feat"] = torch.cat([feat, feat])
+            # species decide the split like in the real dataset: the first ones are train, then valid, then test
+            species = torch.randint(profile["n_species"], (n_nodes,), generator=generator)
+            n_valid_species = n_test_species = 1
+            n_train_species = profile["n_species"] - n_valid_species - n_test_species
+            self.graph.ndata["species"] = (species + 1).view(-1, 1) * 1000
+            self.split = {
+                "train": torch.nonzero(species < n_train_species, as_tuple=True)[0],
+                "valid": torch.nonzero(species == n_train_species, as_tuple=True)[0],
+                "test": torch.nonzero(species > n_train_species, as_tuple=True)[0],
+            }
+        else:
+            self.num_tasks = 1
+            self.labels = torch.randint(profile["n_classes"], (n_nodes,), generator=generator)
+            self.graph.ndata["feat"] = label_features(self.labels, profile["n_feats"], generator)
+            self.labels = self.labels.view(-1, 1)
+            self.split = random_split(n_nodes, profile["split"], generator)
+            if name == "ogbn-arxiv":
+                # time-based split: train until 2017, valid 2018, test 2019 and 2020
+                year = torch.empty(n_nodes, dtype=torch.int64)
+                year[self.split["train"]] = torch.randint(1971, 2018, (len(self.split["train"]),), generator=generator)
+                year[self.split["valid"]] = 2018
+                year[self.split["test"]] = torch.randint(2019, 2021, (len(self.split["test"]),), generator=generator)
+                self.graph.ndata["year"] = year.view(-1, 1)
+
+    def __getitem__(self, idx):
+        assert idx == 0, "This dataset has only one graph"
+        return self.graph, self.labels
+
+    def __len__(self):
+        return 1
+
+    def get_idx_split(self):
+        return self.split
+
+
+class SyntheticLinkPropPredDataset(object):
+    """Drop-in for DglLinkPropPredDataset with random data of the same schema, see SyntheticNodePropPredDataset."""
+
+    def __init__(self, name, scale=1.0, seed=0):
+        assert name in LINK_PROFILES, f"No synthetic version of {name}, choose from {list(LINK_PROFILES)}"
+        self.name = name
+        profile = LINK_PROFILES[name]
+        generator = torch.Generator().manual_seed(seed)
+        n_nodes = scaled(profile["n_nodes"], scale, minimum=16)
+        n_edges = [scaled(n, scale) for n in profile["n_edges"]]
+        src, dst = chung_lu_edges(n_nodes, sum(n_edges), profile["gamma"], profile["directed"], generator)
+        # the pairs come out shuffled, so consecutive slices are random train / valid / test edges
+        n_train = min(n_edges[0], len(src) - 2)
+        n_valid = max(min(n_edges[1], (len(src) - n_train) // 2), 1)
+        parts = {
+            "train": (src[:n_train], dst[:n_train]),
+            "valid": (src[n_train : n_train + n_valid], dst[n_train : n_train + n_valid]),
+            "test": (src[n_train + n_valid :], dst[n_train + n_valid :]),
+        }
+        self.graph = to_graph(*parts["train"], n_nodes, profile["directed"])
+        if "n_feats" in profile:
+            if name == "ogbl-ppa":
+                # one-hot species
+                self.graph.ndata["feat"] = torch.nn.functional.one_hot(
+                    torch.randint(profile["n_feats"], (n_nodes,), generator=generator), profile["n_feats"]
+                ).float()
+            else:
+                self.graph.ndata["feat"] = torch.randn(n_nodes, profile["n_feats"], generator=generator)
+
+        self.split = {}
+        if name == "ogbl-citation2":
+            self.graph.ndata["year"] = torch.randint(1901, 2020, (n_nodes, 1), generator=generator)
+            for key, (s, d) in parts.items():
+                self.split[key] = {"source_node": s, "target_node": d}
+                if key != "train":
+                    self.split[key]["target_node_neg"] = torch.randint(
+                        n_nodes, (len(s), profile["n_target_neg"]), generator=generator
+                    )
+            return
+
+        for key, (s, d) in parts.items():
+            self.split[key] = {"edge": torch.stack([s, d], dim=1)}
+        for key, n_neg in zip(["valid", "test"], profile["n_neg"]):
+            self.split[key]["edge_neg"] = torch.randint(n_nodes, (scaled(n_neg, scale), 2), generator=generator)
+        if name == "ogbl-collab":
+            # train until 2017, valid 2018, test 2019; weights count the papers the two authors wrote together
+            for key, years in zip(["train", "valid", "test"], [(1963, 2018), (2018, 2019), (2019, 2020)]):
+                n = len(self.split[key]["edge"])
+                self.split[key]["year"] = torch.randint(*years, (n,), generator=generator)
+                u = torch.rand(n, generator=generator).clamp(min=1e-12)
+                self.split[key]["weight"] = 1 + (torch.log(u) / torch.log(torch.tensor(0.3))).long()
+            year, weight = self.split["train"]["year"], self.split["train"]["weight"]
+            self.graph.edata["year"] = torch.cat([year, year]).view(-1, 1)
+            self.graph.edata["weight"] = torch.cat([weight, weight]).view(-1, 1)
+
+    def __getitem__(self, idx):
+        assert idx == 0, "This dataset has only one graph"
+        return self.graph
+
+    def __len__(self):
+        return 1
+
+    def get_edge_split(self):
+        return self.split
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""CPU microbenchmark of the AGDNConv implementations of all subprojects.
+
+Every (implementation, transition matrix, weight style, K, heads, hidden, edge_drop)
+cell is timed on the same synthetic graph: forward and backward wall time, peak
+RSS while running the cell and the bytes allocated by one forward/backward pass.
+Results are written to JSON; --compare flags cells that got slower than a stored
+baseline by more than --threshold.
+
+    python benchmark/agdn_bench.py --output bench.json
+    python benchmark/agdn_bench.py --output new.json --compare bench.json
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+
+import dgl
+import dgl.function as fn
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# for the modules shared by the subprojects, agdn_common/
+sys.path.insert(0, ROOT)
+
+
+def load_module(subproject, module):
+    # every subproject has its own flat src/ (models.py, utils.py, ...), so
+    # modules of the same name are imported one subproject at a time
+    src = os.path.join(ROOT, subproject, "src")
+    local = [f[:-3] for f in os.listdir(src) if f.endswith(".py")]
+    saved_path = list(sys.path)
+    saved = {name: sys.modules.pop(name) for name in local if name in sys.modules}
+    sys.path.insert(0, src)
+    try:
+        return importlib.import_module(module)
+    finally:
+        for name in local:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+        sys.path[:] = saved_path
+
+
+def synthetic_graph(n_nodes, avg_degree, in_feats, edge_feats, seed=0):
+    """Random undirected graph with self-loops and the edge norms every implementation expects."""
+    torch.manual_seed(seed)
+    # power-law-ish degrees: sources drawn with probability ~ 1 / rank
+    weights = 1.0 / torch.arange(1, n_nodes + 1, dtype=torch.float)
+    n_edges = n_nodes * avg_degree // 2
+    src = torch.multinomial(weights, n_edges, replacement=True)
+    dst = torch.randint(0, n_nodes, (n_edges,))
+    graph = dgl.graph((torch.cat([src, dst]), torch.cat([dst, src])), num_nodes=n_nodes)
+    graph = dgl.to_simple(graph).remove_self_loop().add_self_loop()
+
+    degs = graph.in_degrees().float().clamp(min=1)
+    deg_inv, deg_sqrt, deg_isqrt = torch.pow(degs, -1), torch.pow(degs, 0.5), torch.pow(degs, -0.5)
+    graph.srcdata.update({"src_norm": deg_isqrt})
+    graph.dstdata.update({"dst_norm": deg_isqrt})
+    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm"))
+    graph.srcdata.update({"src_norm": deg_isqrt})
+    graph.dstdata.update({"dst_norm": deg_sqrt})
+    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm_adjust"))
+    graph.edata["sage_norm"] = deg_inv[graph.edges()[1]]
+    # ogbn-products names them after its partitions
+    graph.edata["sub_gcn_norm"] = graph.edata["gcn_norm"]
+    graph.edata["sub_gcn_norm_adjust"] = graph.edata["gcn_norm_adjust"]
+    graph.ndata.pop("src_norm")
+    graph.ndata.pop("dst_norm")
+
+    feat = torch.randn(n_nodes, in_feats)
+    efeat = torch.rand(graph.number_of_edges(), edge_feats)
+    return graph, feat, efeat
+
+
+# Per implementation: subproject, module, supported transition matrices (mapped to
+# the implementation's own argument) and weight styles, and how to build / call it.
+IMPLEMENTATIONS = {
+    "ogbn-arxiv": dict(
+        subproject="ogbn-arxiv", module="models",
+        transition_matrices={t: t for t in ["gat", "gat_adj", "gat_sym", "gcn", "sage"]},
+        weight_styles=["HA", "HC", "HA+HC", "mean"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, c["hidden"], K=c["K"], num_heads=c["heads"], edge_drop=c["edge_drop"], residual=True,
+            allow_zero_in_degree=True, transition_matrix=c["tm"], weight_style=c["weight_style"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat),
+    ),
+    "heterophily": dict(
+        subproject="heterophily_datasets", module="models",
+        transition_matrices={t: t for t in ["gat", "gat_adj", "gat_sym", "gcn", "sage"]},
+        weight_styles=["HA", "HC", "HA+HC", "mean"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, c["hidden"], K=c["K"], num_heads=c["heads"], edge_drop=c["edge_drop"], residual=True,
+            allow_zero_in_degree=True, transition_matrix=c["tm"], weight_style=c["weight_style"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat),
+    ),
+    "ogbn-proteins": dict(
+        subproject="ogbn-proteins", module="models",
+        transition_matrices={"gat": "none", "gat_adj": "adj"},
+        weight_styles=["HA", "HC", "mean"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, edge_feats, c["hidden"], n_heads=c["heads"], K=c["K"], edge_drop=c["edge_drop"],
+            norm=c["tm"], weight_style=c["weight_style"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat, efeat),
+    ),
+    "ogbn-products": dict(
+        subproject="ogbn-products", module="models",
+        transition_matrices={"gat": "none", "gat_adj": "adj"},
+        weight_styles=["HA"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, c["hidden"], n_heads=c["heads"], K=c["K"], edge_drop=c["edge_drop"], norm=c["tm"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat),
+    ),
+    "ogbl_no_sampling": dict(
+        subproject="ogbl_no_sampling", module="layers",
+        transition_matrices={"gat": "gat", "gat_sym": "gat_sym", "gcn": "gcn", "sage": "row"},
+        weight_styles=["HA", "HC", "HA+HC"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, c["hidden"], c["heads"], c["K"], edge_drop=c["edge_drop"], residual=True,
+            transition_matrix=c["tm"], weight_style=c["weight_style"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat),
+    ),
+    "ogbl_sampling_methods": dict(
+        subproject="ogbl_sampling_methods", module="layers",
+        transition_matrices={"gat_sym": "gat_sym"},
+        weight_styles=["HA", "HC"],
+        edge_drop=False,
+        build=lambda m, c, in_feats, edge_feats: m.AGDNConv(
+            in_feats, c["hidden"], c["heads"], c["K"], residual=True, allow_zero_in_degree=True,
+            weight_style=c["weight_style"]),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat),
+    ),
+    # the shared agdn_common.agdn_ops.AGDNOp, transition matrices map to (transition, norm)
+    "unified": dict(
+        subproject="ogbn-arxiv", module="agdn_common.agdn_ops",
+        transition_matrices={
+            "gat": ("gat", "none"), "gat_adj": ("gat", "adj"), "gat_sym": ("gat_sym", "none"),
+            "gcn": ("gcn", "none"), "sage": ("sage", "none"),
+        },
+        weight_styles=["HA", "HC", "HA+HC", "mean"],
+        build=lambda m, c, in_feats, edge_feats: m.AGDNOp(in_feats, c["hidden"], m.AGDNConfig(
+            K=c["K"], num_heads=c["heads"], edge_drop=c["edge_drop"], transition_matrix=c["tm"][0], norm=c["tm"][1],
+            edge_feats=edge_feats, weight_style=c["weight_style"], residual="linear")),
+        call=lambda conv, graph, feat, efeat: conv(graph, feat, efeat),
+    ),
+}
+
+
+class PeakRSS(object):
+    """Samples the resident set size in a background thread, peak in bytes."""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            # not linux, lifetime maximum instead
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def allocated_bytes(step):
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        step()
+    return sum(e.self_cpu_memory_usage for e in prof.key_averages() if e.self_cpu_memory_usage > 0)
+
+
+def bench_cell(impl, module, cell, graph, feat, efeat, args):
+    conv = impl["build"](module, cell, feat.shape[1], efeat.shape[1])
+    conv.train()
+    feat = feat.clone().requires_grad_()
+
+    def forward():
+        rst = impl["call"](conv, graph, feat, efeat)
+        return rst[0] if isinstance(rst, tuple) else rst
+
+    def step():
+        forward().sum().backward()
+
+    for _ in range(args.warmup):
+        step()
+    fwd_times, bwd_times = [], []
+    with PeakRSS() as rss:
+        for _ in range(args.repeat):
+            tic = time.perf_counter()
+            rst = forward()
+            toc = time.perf_counter()
+            rst.sum().backward()
+            fwd_times.append(toc - tic)
+            bwd_times.append(time.perf_counter() - toc)
+    fwd_times.sort()
+    bwd_times.sort()
+    return {
+        "forward_ms": 1000 * fwd_times[len(fwd_times) // 2],
+        "backward_ms": 1000 * bwd_times[len(bwd_times) // 2],
+        "forward_min_ms": 1000 * fwd_times[0],
+        "backward_min_ms": 1000 * bwd_times[0],
+        "peak_rss_mb": rss.peak / 2 ** 20,
+        "allocated_mb": allocated_bytes(step) / 2 ** 20,
+    }
+
+
+def cells(args):
+    for tm, weight_style, K, heads, hidden, edge_drop in itertools.product(
+        args.transition_matrices, args.weight_styles, args.K, args.heads, args.hidden, args.edge_drop
+    ):
+        yield dict(tm=tm, weight_style=weight_style, K=K, heads=heads, hidden=hidden, edge_drop=edge_drop)
+
+
+def cell_key(record):
+    return "/".join(str(record[k]) for k in ["impl", "tm", "weight_style", "K", "heads", "hidden", "edge_drop"])
+
+
+def run(args):
+    graph, feat, efeat = synthetic_graph(args.n_nodes, args.avg_degree, args.in_feats, args.edge_feats, args.seed)
+    print(f"graph: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, threads: {torch.get_num_threads()}")
+
+    records = []
+    for name in args.impls:
+        impl = IMPLEMENTATIONS[name]
+        try:
+            module = load_module(impl["subproject"], impl["module"])
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        for cell in cells(args):
+            if cell["tm"] not in impl["transition_matrices"] or cell["weight_style"] not in impl["weight_styles"]:
+                continue
+            if cell["edge_drop"] > 0 and not impl.get("edge_drop", True):
+                continue
+            record = dict(impl=name, **cell)
+            torch.manual_seed(args.seed)
+            record.update(bench_cell(impl, module, dict(cell, tm=impl["transition_matrices"][cell["tm"]]), graph, feat, efeat, args))
+            print(
+                f"{cell_key(record)}: fwd {record['forward_ms']:.2f} ms, bwd {record['backward_ms']:.2f} ms, "
+                f"rss {record['peak_rss_mb']:.0f} MB, alloc {record['allocated_mb']:.0f} MB"
+            )
+            records.append(record)
+
+    return {
+        "meta": {
+            "torch": torch.__version__,
+            "dgl": dgl.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+            "n_nodes": graph.number_of_nodes(),
+            "n_edges": graph.number_of_edges(),
+            "in_feats": args.in_feats,
+            "edge_feats": args.edge_feats,
+            "repeat": args.repeat,
+        },
+        "results": records,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Cells whose median forward or backward time grew by more than threshold (relative)."""
+    base = {cell_key(record): record for record in baseline["results"]}
+    regressions = []
+    for record in results["results"]:
+        old = base.get(cell_key(record))
+        if old is None:
+            continue
+        for metric in ["forward_ms", "backward_ms"]:
+            ratio = record[metric] / max(old[metric], 1e-9)
+            if ratio > 1 + threshold:
+                regressions.append((cell_key(record), metric, old[metric], record[metric], ratio))
+    for key, metric, old, new, ratio in regressions:
+        print(f"REGRESSION {key} {metric}: {old:.2f} -> {new:.2f} ms (x{ratio:.2f})")
+    print(f"{len(regressions)} regressions against the baseline (threshold {threshold:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("AGDNConv microbenchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--impls", type=str, nargs="+", default=list(IMPLEMENTATIONS), choices=list(IMPLEMENTATIONS))
+    parser.add_argument("--n-nodes", type=int, default=20000)
+    parser.add_argument("--avg-degree", type=int, default=20)
+    parser.add_argument("--in-feats", type=int, default=128)
+    parser.add_argument("--edge-feats", type=int, default=8)
+    parser.add_argument("--transition-matrices", type=str, nargs="+", default=["gat", "gat_adj", "gat_sym", "gcn", "sage"])
+    parser.add_argument("--weight-styles", type=str, nargs="+", default=["HA", "HC", "mean"])
+    parser.add_argument("--K", type=int, nargs="+", default=[3])
+    parser.add_argument("--heads", type=int, nargs="+", default=[1, 3])
+    parser.add_argument("--hidden", type=int, nargs="+", default=[64])
+    parser.add_argument("--edge-drop", type=float, nargs="+", default=[0.0])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 for the default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="write the results to this JSON file")
+    parser.add_argument("--compare", type=str, default="", help="baseline JSON to check the results against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
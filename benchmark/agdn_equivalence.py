@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks agdn_common.agdn_ops.AGDNOp against the AGDNConv of every subproject.
+
+Every legacy conv of the grid below gets random parameters (several are
+zero-initialized, which would hide differences), is converted with
+agdn_ops.from_legacy and both are run on the same synthetic graph. Outputs and
+input gradients have to match in eval mode and in training mode (all dropouts
+are 0). Exits with 1 on any mismatch.
+
+    python benchmark/agdn_equivalence.py
+    python benchmark/agdn_equivalence.py --impls ogbn-proteins --K 1
+"""
+
+import argparse
+import itertools
+import sys
+
+import torch
+
+from agdn_bench import IMPLEMENTATIONS, load_module, synthetic_graph
+
+# the legacy AGDNConv implementations, i.e. everything but AGDNOp itself
+LEGACY = [name for name in IMPLEMENTATIONS if name != "unified"]
+
+
+def ogbl_edge_weight(conv, graph, feat, efeat):
+    # ogbl_no_sampling reads edge features as positive scalar weights
+    return conv(graph, feat, edge_feat=efeat[:, :1] + 0.1)
+
+
+# Options the microbenchmark grid does not cover: (label, build, call or None for the implementation's own).
+# build(m, in_feats, edge_feats, K, heads, hidden)
+EXTRA_CASES = {
+    "ogbn-arxiv": [
+        ("no_attn_dst", lambda m, i, e, K, h, d: m.AGDNConv(i, d, K=K, num_heads=h, use_attn_dst=False, residual=True, allow_zero_in_degree=True), None),
+        ("batch_norm", lambda m, i, e, K, h, d: m.AGDNConv(i, d, K=K, num_heads=h, batch_norm=True, allow_zero_in_degree=True), None),
+        ("propagate_first", lambda m, i, e, K, h, d: m.AGDNConv(i, d, K=K, num_heads=1, propagate_first=True, residual=True, allow_zero_in_degree=True), None),
+        ("no_position_emb", lambda m, i, e, K, h, d: m.AGDNConv(i, d, K=K, num_heads=h, position_emb=False, bias=False, allow_zero_in_degree=True), None),
+    ]
+    + [
+        (f"HA_{act}", lambda m, i, e, K, h, d, act=act: m.AGDNConv(i, d, K=K, num_heads=h, HA_activation=act, residual=True, allow_zero_in_degree=True), None)
+        for act in ["sigmoid", "relu", "standardize", "none"]
+    ],
+    "ogbn-proteins": [
+        ("no_residual", lambda m, i, e, K, h, d: m.AGDNConv(i, e, d, n_heads=h, K=K, residual=False), None),
+        ("no_edge_feats", lambda m, i, e, K, h, d: m.AGDNConv(i, 0, d, n_heads=h, K=K, use_attn_dst=False), lambda conv, graph, feat, efeat: conv(graph, feat)),
+        ("norm_avg", lambda m, i, e, K, h, d: m.AGDNConv(i, e, d, n_heads=h, K=K, norm="avg", batch_norm=False, weight_style="sum"), None),
+    ],
+    "ogbn-products": [
+        ("no_residual", lambda m, i, e, K, h, d: m.AGDNConv(i, d, n_heads=1, K=K, residual=False), None),
+        ("no_batch_norm", lambda m, i, e, K, h, d: m.AGDNConv(i, d, n_heads=h, K=K, norm="avg", batch_norm=False, use_attn_dst=False), None),
+    ],
+    "ogbl_no_sampling": [
+        ("pre_act", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, pre_act=True, residual=True), None),
+        ("no_dst_attn", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, no_dst_attn=True, hop_norm=True), None),
+        ("no_share_weights", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, share_weights=False, pos_emb=False), None),
+        ("gat_col", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, transition_matrix="gat_col", weight_style="sum"), None),
+        ("col", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, transition_matrix="col", weight_style="max_pool"), None),
+        ("mean_pool", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, weight_style="mean_pool"), None),
+        ("edge_weight", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, residual=True), ogbl_edge_weight),
+    ],
+    "ogbl_sampling_methods": [
+        ("edge_feats", lambda m, i, e, K, h, d: m.AGDNConv(i, d, h, K, edge_feats=e, residual=True, allow_zero_in_degree=True),
+         lambda conv, graph, feat, efeat: conv(graph, feat, edge_feat=efeat)),
+        ("identity_residual", lambda m, i, e, K, h, d: m.AGDNConv(i, i, 1, K, pos_emb=False, residual=True, allow_zero_in_degree=True), None),
+    ],
+}
+
+
+def cases(name, module, args, in_feats, edge_feats):
+    impl = IMPLEMENTATIONS[name]
+    for tm, weight_style in itertools.product(impl["transition_matrices"], impl["weight_styles"]):
+        cell = dict(tm=impl["transition_matrices"][tm], weight_style=weight_style, K=args.K, heads=args.heads, hidden=args.hidden, edge_drop=0.0)
+        yield f"{tm}/{weight_style}", lambda cell=cell: impl["build"](module, cell, in_feats, edge_feats), impl["call"]
+    for label, build, call in EXTRA_CASES.get(name, []):
+        yield label, lambda build=build: build(module, in_feats, edge_feats, args.K, args.heads, args.hidden), call or impl["call"]
+
+
+def randomize(conv, seed):
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for param in conv.parameters():
+            param.copy_(0.3 * torch.randn(param.shape, generator=generator))
+
+
+def run_both(conv, op, call, graph, feat, efeat, training):
+    results = []
+    weight = None
+    for module in [conv, op]:
+        module.train(training)
+        x = feat.clone().requires_grad_()
+        rst = call(module, graph, x, efeat)
+        rst = rst[0] if isinstance(rst, tuple) else rst
+        if weight is None:
+            weight = torch.randn(rst.shape, generator=torch.Generator().manual_seed(1))
+        (rst * weight).sum().backward()
+        results.append((rst.detach(), x.grad))
+    return results
+
+
+def max_rel_diff(a, b):
+    return ((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser("AGDNOp equivalence check", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--impls", type=str, nargs="+", default=LEGACY, choices=LEGACY)
+    parser.add_argument("--n-nodes", type=int, default=500)
+    parser.add_argument("--avg-degree", type=int, default=8)
+    parser.add_argument("--in-feats", type=int, default=32)
+    parser.add_argument("--edge-feats", type=int, default=8)
+    parser.add_argument("--K", type=int, default=3)
+    parser.add_argument("--heads", type=int, default=2)
+    parser.add_argument("--hidden", type=int, default=16)
+    parser.add_argument("--tol", type=float, default=1e-4, help="maximum difference relative to the largest legacy value")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ok = True
+    graph, feat, efeat = synthetic_graph(args.n_nodes, args.avg_degree, args.in_feats, args.edge_feats, args.seed)
+    n_checked = n_skipped = 0
+    for name in args.impls:
+        subproject = IMPLEMENTATIONS[name]["subproject"]
+        try:
+            module = load_module(subproject, IMPLEMENTATIONS[name]["module"])
+            ops = load_module(subproject, "agdn_common.agdn_ops")
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        for label, build, call in cases(name, module, args, args.in_feats, args.edge_feats):
+            torch.manual_seed(args.seed)
+            conv = build()
+            randomize(conv, args.seed)
+            try:
+                op = ops.from_legacy(conv)
+            except ValueError as e:
+                print(f"{name}/{label}: unsupported ({e})")
+                n_skipped += 1
+                continue
+            for training in [False, True]:
+                (out, grad), (out_op, grad_op) = run_both(conv, op, call, graph, feat, efeat, training)
+                mode = "train" if training else "eval"
+                if out.shape != out_op.shape:
+                    ok = False
+                    print(f"MISMATCH {name}/{label}/{mode}: output shape {tuple(out.shape)} vs {tuple(out_op.shape)}")
+                    continue
+                diffs = (max_rel_diff(out, out_op), max_rel_diff(grad, grad_op))
+                if max(diffs) > args.tol:
+                    ok = False
+                    print(f"MISMATCH {name}/{label}/{mode}: output {diffs[0]:.2e}, grad {diffs[1]:.2e}")
+                else:
+                    print(f"{name}/{label}/{mode}: ok (output {diffs[0]:.1e}, grad {diffs[1]:.1e})")
+            n_checked += 1
+
+    print(f"{n_checked} variants checked, {n_skipped} unsupported")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks --precision bf16 (agdn_common/precision.py) against float32 for the AGDN convs of every subproject.
+
+Every conv of the agdn_equivalence grid gets random parameters and is run on
+the same synthetic graph once in float32 and once under bfloat16 autocast;
+outputs and input gradients have to agree up to --tol. Then, for the first
+cell of every implementation, a student (the conv and a linear classifier) is
+trained from the same initialization in both precisions on labels of a random
+diffusion teacher, and the test accuracies have to agree up to --acc-tol. Exits
+with 1 on any mismatch.
+
+Needs torch>=1.10 and a DGL build with bfloat16 CPU kernels.
+
+    python benchmark/bf16_parity.py
+    python benchmark/bf16_parity.py --impls ogbn-arxiv unified --epochs 100
+"""
+
+import argparse
+import copy
+import sys
+
+import dgl.function as fn
+import torch
+import torch.nn.functional as F
+
+from agdn_bench import IMPLEMENTATIONS, load_module, synthetic_graph
+from agdn_common import precision
+from agdn_equivalence import cases, max_rel_diff, randomize
+
+
+def forward(conv, call, graph, feat, efeat, name):
+    with precision.autocast(name):
+        rst = call(conv, graph, feat, efeat)
+    rst = rst[0] if isinstance(rst, tuple) else rst
+    return rst.float().flatten(1)
+
+
+def run(conv, call, graph, feat, efeat, name, training):
+    conv.train(training)
+    x = feat.clone().requires_grad_()
+    rst = forward(conv, call, graph, x, efeat, name)
+    weight = torch.randn(rst.shape, generator=torch.Generator().manual_seed(1))
+    (rst * weight).sum().backward()
+    return rst.detach(), x.grad
+
+
+def teacher_labels(graph, feat, n_classes, seed):
+    # classes of a random projection diffused over two hops, i.e. something the convs can learn
+    generator = torch.Generator().manual_seed(seed)
+    h = feat @ torch.randn(feat.shape[1], n_classes, generator=generator)
+    with graph.local_scope():
+        for _ in range(2):
+            graph.ndata["h"] = h
+            graph.update_all(fn.copy_u("h", "m"), fn.mean("m", "h"))
+            h = graph.ndata["h"]
+    return h.argmax(dim=-1)
+
+
+def train_student(conv, call, graph, feat, efeat, labels, train_mask, n_classes, name, args):
+    torch.manual_seed(args.seed)
+    n_out = forward(conv, call, graph, feat, efeat, "fp32").shape[1]
+    head = torch.nn.Linear(n_out, n_classes)
+    parameters = list(conv.parameters()) + list(head.parameters())
+    optimizer = torch.optim.Adam(parameters, lr=args.lr)
+    conv.train()
+    for _ in range(args.epochs):
+        optimizer.zero_grad()
+        with precision.autocast(name):
+            logits = head(forward(conv, call, graph, feat, efeat, name)).float()
+        F.cross_entropy(logits[train_mask], labels[train_mask]).backward()
+        optimizer.step()
+    conv.eval()
+    with torch.no_grad(), precision.autocast(name):
+        logits = head(forward(conv, call, graph, feat, efeat, name)).float()
+    return (logits.argmax(dim=-1) == labels)[~train_mask].float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser("bf16 parity check", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--impls", type=str, nargs="+", default=list(IMPLEMENTATIONS), choices=list(IMPLEMENTATIONS))
+    parser.add_argument("--n-nodes", type=int, default=500)
+    parser.add_argument("--avg-degree", type=int, default=8)
+    parser.add_argument("--in-feats", type=int, default=32)
+    parser.add_argument("--edge-feats", type=int, default=8)
+    parser.add_argument("--K", type=int, default=3)
+    parser.add_argument("--heads", type=int, default=2)
+    parser.add_argument("--hidden", type=int, default=16)
+    parser.add_argument("--tol", type=float, default=5e-2, help="maximum difference relative to the largest float32 value")
+    parser.add_argument("--n-classes", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=50, help="training steps of the accuracy parity check, 0 to skip it")
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--acc-tol", type=float, default=0.02, help="maximum difference of the float32 and bfloat16 test accuracies")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if not precision.supported("bf16", "cpu"):
+        sys.exit("bfloat16 needs torch>=1.10 and a DGL build with bfloat16 CPU kernels")
+
+    ok = True
+    graph, feat, efeat = synthetic_graph(args.n_nodes, args.avg_degree, args.in_feats, args.edge_feats, args.seed)
+    labels = teacher_labels(graph, feat, args.n_classes, args.seed)
+    train_mask = torch.rand(args.n_nodes, generator=torch.Generator().manual_seed(args.seed)) < 0.5
+    n_checked = 0
+    for name in args.impls:
+        subproject = IMPLEMENTATIONS[name]["subproject"]
+        try:
+            module = load_module(subproject, IMPLEMENTATIONS[name]["module"])
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        for i, (label, build, call) in enumerate(cases(name, module, args, args.in_feats, args.edge_feats)):
+            torch.manual_seed(args.seed)
+            conv = build()
+            randomize(conv, args.seed)
+            for training in [False, True]:
+                conv.zero_grad()
+                out, grad = run(conv, call, graph, feat, efeat, "fp32", training)
+                conv.zero_grad()
+                out_bf16, grad_bf16 = run(conv, call, graph, feat, efeat, "bf16", training)
+                mode = "train" if training else "eval"
+                diffs = (max_rel_diff(out, out_bf16), max_rel_diff(grad, grad_bf16))
+                if max(diffs) > args.tol:
+                    ok = False
+                    print(f"MISMATCH {name}/{label}/{mode}: output {diffs[0]:.2e}, grad {diffs[1]:.2e}")
+                else:
+                    print(f"{name}/{label}/{mode}: ok (output {diffs[0]:.1e}, grad {diffs[1]:.1e})")
+
+            if i == 0 and args.epochs > 0:
+                accs = [
+                    train_student(copy.deepcopy(conv), call, graph, feat, efeat, labels, train_mask, args.n_classes, p, args)
+                    for p in ["fp32", "bf16"]
+                ]
+                if abs(accs[0] - accs[1]) > args.acc_tol:
+                    ok = False
+                    print(f"MISMATCH {name}/{label}/accuracy: fp32 {accs[0]:.4f}, bf16 {accs[1]:.4f}")
+                else:
+                    print(f"{name}/{label}/accuracy: ok (fp32 {accs[0]:.4f}, bf16 {accs[1]:.4f})")
+            n_checked += 1
+
+    print(f"{n_checked} variants checked")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Puts the repository root on sys.path, for the modules shared by all subprojects (agdn_common/). Imported first by
+# the entry points of this directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
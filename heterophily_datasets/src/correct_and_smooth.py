@@ -1,5 +1,6 @@
 import argparse
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -7,17 +8,24 @@ import torch.nn.functional as F
 from dgl import function as fn
 from ogb.nodeproppred import DglNodePropPredDataset, Evaluator
 
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
+
 device = None
 
 dataset = "ogbn-arxiv"
 n_node_feats, n_classes = 0, 0
 
 
-def load_data(dataset):
+def load_data(dataset, synthetic_scale=1.0):
     global n_node_feats, n_classes
 
-    data = DglNodePropPredDataset(name=dataset, root="/home/scx/dataset")
-    evaluator = Evaluator(name=dataset)
+    name, synthetic = split_synthetic(dataset)
+    if synthetic:
+        data = SyntheticNodePropPredDataset(name, scale=synthetic_scale)
+    else:
+        data = DglNodePropPredDataset(name=dataset, root="/home/scx/dataset")
+    evaluator = Evaluator(name=name)
 
     splitted_idx = data.get_idx_split()
     train_idx, val_idx, test_idx = splitted_idx["train"], splitted_idx["valid"], splitted_idx["test"]
@@ -46,34 +54,101 @@ def preprocess(graph):
     return graph
 
 
-def general_outcome_correlation(graph, y0, n_prop=50, alpha=0.8, use_norm=False, post_step=None):
-    with graph.local_scope():
-        y = y0
-        for _ in range(n_prop):
-            if use_norm:
-                degs = graph.in_degrees().float().clamp(min=1)
-                norm = torch.pow(degs, -0.5)
-                shp = norm.shape + (1,) * (y.dim() - 1)
-                norm = torch.reshape(norm, shp)
-                y = y * norm
+class Propagator(object):
+    """Outcome propagation with the normalized adjacency precomputed once.
+
+    Without use_norm the transition matrix is D^-1 A (mean over in-neighbors),
+    with use_norm it is D^-1/2 A D^-1/2.
+    """
+
+    def __init__(self, graph, use_norm=False):
+        self.graph = graph
+        degs = graph.in_degrees().float().clamp(min=1)
+        src, dst = graph.all_edges()
+        if use_norm:
+            weight = torch.pow(degs, -0.5)[src] * torch.pow(degs, -0.5)[dst]
+        else:
+            weight = 1 / degs[dst]
+        self.weight = weight.unsqueeze(-1)
+
+    def __call__(self, y0, n_prop=50, alpha=0.8, post_step=None, tol=0.0):
+        # alpha is a float or a 1 x C tensor with one value per channel, so that
+        # several settings stacked along the channel dimension run in one pass.
+        # Stops once the largest change of an iteration falls below tol.
+        with self.graph.local_scope():
+            self.graph.edata["w"] = self.weight
+            y = y0
+            for _ in range(n_prop):
+                self.graph.srcdata.update({"y": y})
+                self.graph.update_all(fn.u_mul_e("y", "w", "m"), fn.sum("m", "y"))
+                y_next = alpha * self.graph.dstdata["y"] + (1 - alpha) * y0
+
+                if post_step is not None:
+                    y_next = post_step(y_next)
+
+                converged = tol > 0 and (y_next - y).abs().max().item() < tol
+                y = y_next
+                if converged:
+                    break
 
-            graph.srcdata.update({"y": y})
-            graph.update_all(fn.copy_u("y", "m"), fn.mean("m", "y"))
-            y = graph.dstdata["y"]
+            return y
 
-            if use_norm:
-                degs = graph.in_degrees().float().clamp(min=1)
-                norm = torch.pow(degs, 0.5)
-                shp = norm.shape + (1,) * (y.dim() - 1)
-                norm = torch.reshape(norm, shp)
-                y = y * norm
 
-            y = alpha * y + (1 - alpha) * y0
+def general_outcome_correlation(graph, y0, n_prop=50, alpha=0.8, use_norm=False, post_step=None, tol=0.0):
+    return Propagator(graph, use_norm)(y0, n_prop=n_prop, alpha=alpha, post_step=post_step, tol=tol)
 
-            if post_step is not None:
-                y = post_step(y)
 
-        return y
+def channel_alpha(alphas, n_channels, device):
+    # one alpha per block of n_channels columns
+    return torch.tensor(alphas, device=device).repeat_interleave(n_channels).view(1, -1)
+
+
+def correct_and_smooth(args, propagators, labels, pred, train_idx, settings):
+    """C&S for a list of (alpha1, alpha2, use_norm) settings, returns one prediction per setting.
+
+    pred may hold several runs side by side (N x runs * C). Settings sharing use_norm
+    are stacked along the channel dimension as well: the correct step runs once for
+    all distinct alpha1, the smooth step once for all settings.
+    """
+    n_channels = pred.shape[1]
+    y_train = F.one_hot(labels[train_idx], n_classes).float().squeeze(1).repeat(1, n_channels // n_classes)
+    y = pred.clone()
+    y[train_idx] = y_train
+    dy = torch.zeros(pred.shape[0], n_channels, device=pred.device)
+    dy[train_idx] = y_train - pred[train_idx]
+
+    preds = [None] * len(settings)
+    for use_norm in sorted(set(setting[2] for setting in settings)):
+        propagate = propagators[use_norm]
+        group = [i for i, setting in enumerate(settings) if setting[2] == use_norm]
+
+        # NOTE: Only "smooth" is performed here.
+        if args.only_smooth:
+            corrected = {alpha1: y for alpha1, _, _ in settings}
+        else:
+            alpha1s = sorted(set(settings[i][0] for i in group))
+            smoothed_dy = propagate(
+                dy.repeat(1, len(alpha1s)),
+                n_prop=args.n_prop1,
+                alpha=channel_alpha(alpha1s, n_channels, dy.device),
+                post_step=lambda x: x.clamp(-1, 1),
+                tol=args.tol,
+            )
+            corrected = {
+                alpha1: y + alpha1 * smoothed_dy[:, j * n_channels : (j + 1) * n_channels] for j, alpha1 in enumerate(alpha1s)
+            }
+
+        smoothed_y = propagate(
+            torch.cat([corrected[settings[i][0]] for i in group], dim=1),
+            n_prop=args.n_prop2,
+            alpha=channel_alpha([settings[i][1] for i in group], n_channels, y.device),
+            post_step=lambda x: x.clamp(0, 1),
+            tol=args.tol,
+        )
+        for j, i in enumerate(group):
+            preds[i] = smoothed_y[:, j * n_channels : (j + 1) * n_channels]
+
+    return preds
 
 
 def evaluate(labels, pred, train_idx, val_idx, test_idx, evaluator):
@@ -84,43 +159,73 @@ def evaluate(labels, pred, train_idx, val_idx, test_idx, evaluator):
     )
 
 
-def run(args, graph, labels, pred, train_idx, val_idx, test_idx, evaluator):
+def run(args, propagators, labels, preds, train_idx, val_idx, test_idx, evaluator, settings):
+    # preds: list of N x C predictions of several runs, smoothed together
     evaluator_wrapper = lambda pred, labels: evaluator.eval(
         {"y_pred": pred.argmax(dim=-1, keepdim=True), "y_true": labels}
     )["acc"]
 
-    y = pred.clone()
-    y[train_idx] = F.one_hot(labels[train_idx], n_classes).float().squeeze(1)
-    dy = torch.zeros(graph.number_of_nodes(), n_classes, device=device)
-    dy[train_idx] = F.one_hot(labels[train_idx], n_classes).float().squeeze(1) - pred[train_idx]
-
-    _train_acc, origin_val_acc, origin_test_acc = evaluate(labels, y, train_idx, val_idx, test_idx, evaluator_wrapper)
-
-    # print("train acc:", _train_acc)
-    print("original val acc:", origin_val_acc)
-    print("original test acc:", origin_test_acc)
-
-    # NOTE: Only "smooth" is performed here.
-    if not args.only_smooth:
-        smoothed_dy = general_outcome_correlation(
-            graph, dy, n_prop=args.n_prop1, alpha=args.alpha1, use_norm=args.use_norm, post_step=lambda x: x.clamp(-1, 1)
-        )
-
+    origin_val_accs, origin_test_accs = [], []
+    for pred in preds:
+        y = pred.clone()
         y[train_idx] = F.one_hot(labels[train_idx], n_classes).float().squeeze(1)
-        smoothed_dy = smoothed_dy
-        y = y + args.alpha1 * smoothed_dy  # .clamp(0, 1)
 
-    smoothed_y = general_outcome_correlation(
-        graph, y, n_prop=args.n_prop2, alpha=args.alpha2, use_norm=args.use_norm, post_step=lambda x: x.clamp(0, 1)
-    )
+        _train_acc, origin_val_acc, origin_test_acc = evaluate(labels, y, train_idx, val_idx, test_idx, evaluator_wrapper)
 
-    _train_acc, val_acc, test_acc = evaluate(labels, smoothed_y, train_idx, val_idx, test_idx, evaluator_wrapper)
+        # print("train acc:", _train_acc)
+        print("original val acc:", origin_val_acc)
+        print("original test acc:", origin_test_acc)
+        origin_val_accs.append(origin_val_acc)
+        origin_test_accs.append(origin_test_acc)
 
-    # print("train acc:", _train_acc)
-    print("val acc:", val_acc)
-    print("test acc:", test_acc)
+    smoothed = correct_and_smooth(args, propagators, labels, torch.cat(preds, dim=1), train_idx, settings)
+
+    # runs x settings
+    val_accs, test_accs = [], []
+    for r in range(len(preds)):
+        val_accs.append([])
+        test_accs.append([])
+        for setting, smoothed_y in zip(settings, smoothed):
+            smoothed_y = smoothed_y[:, r * n_classes : (r + 1) * n_classes]
+            _train_acc, val_acc, test_acc = evaluate(labels, smoothed_y, train_idx, val_idx, test_idx, evaluator_wrapper)
+
+            # print("train acc:", _train_acc)
+            if len(settings) > 1:
+                print("alpha1: {}, alpha2: {}, use_norm: {}".format(*setting))
+            print("val acc:", val_acc)
+            print("test acc:", test_acc)
+            val_accs[-1].append(val_acc)
+            test_accs[-1].append(test_acc)
+
+    return origin_val_accs, origin_test_accs, val_accs, test_accs
+
+
+def load_pred(pred):
+    pred = pred.to(device)
+    if pred.max() > 1 or pred.min() < 0:
+        print("not standard probability")
+        pred = pred.softmax(dim=-1)
+    return pred
+
+
+def pred_batches(args):
+    """Yields lists of at most --run-batch predictions, from --pred-store or the --pred-files glob."""
+    if args.pred_store:
+        store = np.load(args.pred_store, mmap_mode="r")
+        # unfinished runs are still all zero
+        keys = [r for r in range(store.shape[0]) if store[r, 0].any()]
+        read = lambda r: torch.from_numpy(np.array(store[r]))
+    else:
+        keys = sorted(glob.glob(args.pred_files))
+        read = torch.load
 
-    return origin_val_acc, origin_test_acc, val_acc, test_acc
+    batch_size = args.run_batch if args.run_batch > 0 else max(len(keys), 1)
+    with ThreadPoolExecutor(args.load_threads) as pool:
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start : start + batch_size]
+            for key in batch:
+                print("load:", f"{args.pred_store}[{key}]" if args.pred_store else key)
+            yield [load_pred(pred) for pred in pool.map(read, batch)]
 
 
 def main():
@@ -129,13 +234,22 @@ def main():
     argparser = argparse.ArgumentParser(description="implementation of C&S)")
     argparser.add_argument("--cpu", action="store_true", help="CPU mode. This option overrides --gpu.")
     argparser.add_argument("--gpu", type=int, default=0, help="GPU device ID.")
+    argparser.add_argument("--dataset", type=str, default=dataset, choices=[dataset, f"synthetic-{dataset}"])
+    argparser.add_argument("--synthetic-scale", type=float, default=1.0, help="size of the synthetic graph relative to the real one")
     argparser.add_argument("--only-smooth", action="store_true", help="Only smooth the outcome.")
     argparser.add_argument("--use-norm", action="store_true", help="Use symmetrically normalized adjacency matrix.")
     argparser.add_argument("--alpha1", type=float, default=0.15, help="alpha1")
     argparser.add_argument("--n-prop1", type=int, default=10)
     argparser.add_argument("--alpha2", type=float, default=0.4, help="alpha2")
     argparser.add_argument("--n-prop2", type=int, default=10)
+    argparser.add_argument("--tol", type=float, default=0.0, help="stop propagating once the largest change is below tol, 0 to always run n_prop steps")
+    argparser.add_argument("--alpha1-grid", type=float, nargs="+", default=None, help="alpha1 values to sweep (overrides --alpha1)")
+    argparser.add_argument("--alpha2-grid", type=float, nargs="+", default=None, help="alpha2 values to sweep (overrides --alpha2)")
+    argparser.add_argument("--norm-grid", action="store_true", help="Sweep both use_norm settings.")
     argparser.add_argument("--pred-files", type=str, default="./checkpoint1/*.pt", help="address of prediction files")
+    argparser.add_argument("--pred-store", type=str, default="", help="memory-mapped prediction store written by main.py --pred-store, overrides --pred-files")
+    argparser.add_argument("--run-batch", type=int, default=0, help="number of runs propagated together as extra channels, 0 for all")
+    argparser.add_argument("--load-threads", type=int, default=4, help="threads reading prediction files")
     args = argparser.parse_args()
 
     if args.cpu:
@@ -144,36 +258,48 @@ def main():
         device = torch.device(f"cuda:{args.gpu}")
 
     # load data & preprocess
-    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(dataset)
+    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(args.dataset, args.synthetic_scale)
     graph = preprocess(graph)
 
     graph, labels, train_idx, val_idx, test_idx = map(
         lambda x: x.to(device), (graph, labels, train_idx, val_idx, test_idx)
     )
 
+    alpha1s = args.alpha1_grid if args.alpha1_grid is not None else [args.alpha1]
+    alpha2s = args.alpha2_grid if args.alpha2_grid is not None else [args.alpha2]
+    norms = [False, True] if args.norm_grid else [args.use_norm]
+    settings = [(alpha1, alpha2, use_norm) for use_norm in norms for alpha1 in alpha1s for alpha2 in alpha2s]
+    propagators = {use_norm: Propagator(graph, use_norm) for use_norm in norms}
+
     # run
     origin_val_accs, origin_test_accs, val_accs, test_accs = [], [], [], []
 
-    for pred_file in glob.iglob(args.pred_files):
-        print("load:", pred_file)
-        pred = torch.load(pred_file).to(device)
-        if pred.max() > 1 or pred.min() < 0:
-            print("not standard probability")
-            pred = pred.softmax(dim=-1)
-        origin_val_acc, origin_test_acc, val_acc, test_acc = run(args, graph, labels, pred, train_idx, val_idx, test_idx, evaluator)
-        origin_val_accs.append(origin_val_acc)
-        origin_test_accs.append(origin_test_acc)
-        val_accs.append(val_acc)
-        test_accs.append(test_acc)
+    for preds in pred_batches(args):
+        origin_val_acc, origin_test_acc, val_acc, test_acc = run(
+            args, propagators, labels, preds, train_idx, val_idx, test_idx, evaluator, settings
+        )
+        origin_val_accs.extend(origin_val_acc)
+        origin_test_accs.extend(origin_test_acc)
+        val_accs.extend(val_acc)
+        test_accs.extend(test_acc)
+
+    # runs x settings
+    val_accs, test_accs = np.array(val_accs), np.array(test_accs)
 
     print(args)
     print(f"Runned {len(val_accs)} times")
-    print("Val Accs:", val_accs)
-    print("Test Accs:", test_accs)
     print(f"Average original val accuracy: {np.mean(origin_val_accs)} ± {np.std(origin_val_accs)}")
     print(f"Average original test accuracy: {np.mean(origin_test_accs)} ± {np.std(origin_test_accs)}")
-    print(f"Average val accuracy: {np.mean(val_accs)} ± {np.std(val_accs)}")
-    print(f"Average test accuracy: {np.mean(test_accs)} ± {np.std(test_accs)}")
+    for i, setting in enumerate(settings):
+        if len(settings) > 1:
+            print("alpha1: {}, alpha2: {}, use_norm: {}".format(*setting))
+        print("Val Accs:", val_accs[:, i].tolist())
+        print("Test Accs:", test_accs[:, i].tolist())
+        print(f"Average val accuracy: {np.mean(val_accs[:, i])} ± {np.std(val_accs[:, i])}")
+        print(f"Average test accuracy: {np.mean(test_accs[:, i])} ± {np.std(test_accs[:, i])}")
+    if len(settings) > 1:
+        best = int(np.argmax(val_accs.mean(0)))
+        print("Best setting by val accuracy: alpha1: {}, alpha2: {}, use_norm: {}".format(*settings[best]))
 
 
 if __name__ == "__main__":
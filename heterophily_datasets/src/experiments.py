@@ -1,4 +1,7 @@
 import argparse
+import copy
+import json
+import os
 import time
 from tqdm import tqdm
 import dgl
@@ -8,11 +11,14 @@ from numpy.lib.function_base import append
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+import torch.multiprocessing as mp
+import common_path  # noqa: F401, puts agdn_common on sys.path
 from gen_model import gen_model
 from tqdm import tqdm
 from dgl.nn.pytorch.conv import SGConv
 from models import AGDNConv
 from ogb.nodeproppred import DglNodePropPredDataset
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
 from sklearn.metrics import accuracy_score
 import time
 from utils import seed, compute_norm
@@ -90,10 +96,10 @@ class AGDN(nn.Module):
         for conv in self.convs:
             conv.reset_parameters()
 
-    def forward(self, g, feat):
+    def forward(self, g, feat, hops=None):
         h = feat
         for i, conv in enumerate(self.convs):
-            h = conv(g, h)
+            h = conv(g, h, hops) if i == 0 else conv(g, h)
             if i < len(self.convs) - 1:
                 h = h.flatten(1)
                 h = self.bns[i](h)
@@ -107,18 +113,31 @@ def count_parameters(model):
     # print([np.prod(p.size()) for p in model.parameters() if p.requires_grad])
     return sum([np.prod(p.size()) for p in model.parameters() if p.requires_grad])
 
-def train(model, g, feat, labels, train_mask, loss_func, optimizer, device):
+def precompute_hops(g, feat, K, transition_matrix):
+    # [X, T X, ..., T^K X] for a fixed transition matrix T, the first layer of
+    # every model with K' <= K slices this prefix instead of diffusing itself
+    norm = {'gcn': 'gcn_norm', 'sage': 'sage_norm'}[transition_matrix]
+    with g.local_scope():
+        g.ndata['ft'] = feat
+        g.edata['w'] = g.edata[norm].view(-1, 1)
+        hops = [feat]
+        for _ in range(K):
+            g.update_all(fn.u_mul_e('ft', 'w', 'm'), fn.sum('m', 'ft'))
+            hops.append(g.ndata['ft'])
+    return torch.stack(hops)
+
+def train(model, g, feat, labels, train_mask, loss_func, optimizer, device, hops=None):
     model.train()
-    out = model(g, feat)
+    out = model(g, feat, hops)
     loss = loss_func(out[train_mask], labels[train_mask])
     optimizer.zero_grad()
     loss.backward()
     optimizer.step()
 
 @torch.no_grad()
-def test(model, g, feat, labels, train_mask, val_mask, test_mask, loss_func, evaluator, device):
+def test(model, g, feat, labels, train_mask, val_mask, test_mask, loss_func, evaluator, device, hops=None):
     model.eval()
-    out = model(g, feat)
+    out = model(g, feat, hops)
     pred = out.argmax(-1)
     train_loss = loss_func(out[train_mask], labels[train_mask]).item()
     val_loss = loss_func(out[val_mask], labels[val_mask]).item()
@@ -130,7 +149,7 @@ def test(model, g, feat, labels, train_mask, val_mask, test_mask, loss_func, eva
 
     return out, train_loss, val_loss, test_loss, train_score, val_score, test_score
 
-def run(g, feat, labels, train_mask, val_mask, test_mask, evaluator, device, args):
+def run(g, feat, labels, train_mask, val_mask, test_mask, evaluator, device, args, hops=None):
     in_feats = feat.shape[1]
     n_classes = len(labels.unique())
     model = AGDN(in_feats, args.n_hidden, n_classes, args.n_layers,
@@ -151,10 +170,10 @@ def run(g, feat, labels, train_mask, val_mask, test_mask, evaluator, device, arg
     best_epoch = 0
     for epoch in range(1, args.n_epochs+1):
         tic = time.time()
-        train(model, g, feat, labels, train_mask, loss_func, optimizer, device)
+        train(model, g, feat, labels, train_mask, loss_func, optimizer, device, hops)
         if epoch % args.eval_steps == 0:
             out, train_loss, val_loss, test_loss, train_score, val_score, test_score \
-                = test(model, g, feat, labels, train_mask, val_mask, test_mask, loss_func, evaluator, device)
+                = test(model, g, feat, labels, train_mask, val_mask, test_mask, loss_func, evaluator, device, hops)
             toc = time.time()
             if best_val_score < val_score:
                 best_val_loss = val_loss
@@ -204,6 +223,126 @@ def experiment(g, feat, labels, train_mask, val_mask, test_mask, evaluator, devi
         hop_weights_list_.append(hop_weights_list)
     return best_val_scores_, final_test_scores_, hop_weights_list_
 
+# Sweep executor: every (weight_style, K, seed) cell of the grid is one job. The
+# preprocessed graph lives in shared memory and is rebuilt (without copying)
+# in every worker; finished cells are appended to a JSONL results file, so a
+# killed sweep resumes with the cells that are still missing.
+
+_sweep_state = None
+
+
+def sweep_cells(weight_styles, Ks, n_seeds):
+    return [(weight_style, K, i) for weight_style in weight_styles for K in Ks for i in range(n_seeds)]
+
+
+def share_graph(g, feat, labels, train_mask, val_mask, test_mask, hops=None):
+    src, dst = g.all_edges()
+    shared = {
+        "n_nodes": g.number_of_nodes(),
+        "src": src.cpu(),
+        "dst": dst.cpu(),
+        "edata": {k: v.cpu() for k, v in g.edata.items()},
+        "feat": feat.cpu(),
+        "labels": labels.cpu(),
+        "masks": (train_mask.cpu(), val_mask.cpu(), test_mask.cpu()),
+        "hops": hops.cpu() if hops is not None else None,
+    }
+    for t in [shared["src"], shared["dst"], shared["feat"], shared["labels"], shared["hops"], *shared["masks"], *shared["edata"].values()]:
+        if t is not None:
+            t.share_memory_()
+    return shared
+
+
+def sweep_worker_init(shared, args, n_threads):
+    global _sweep_state
+
+    if n_threads > 0:
+        torch.set_num_threads(n_threads)
+    device = f'cuda:{args.device}' if args.device > -1 else 'cpu'
+    g = dgl.graph((shared["src"], shared["dst"]), num_nodes=shared["n_nodes"])
+    for k, v in shared["edata"].items():
+        g.edata[k] = v
+    g = g.to(device)
+    train_mask, val_mask, test_mask = [mask.to(device) for mask in shared["masks"]]
+    hops = shared["hops"].to(device) if shared["hops"] is not None else None
+    _sweep_state = (g, shared["feat"].to(device), shared["labels"].to(device), train_mask, val_mask, test_mask, hops, device, args)
+
+
+def sweep_cell(cell):
+    g, feat, labels, train_mask, val_mask, test_mask, hops, device, args = _sweep_state
+    weight_style, K, i = cell
+    args = copy.copy(args)
+    args.weight_style, args.K = weight_style, K
+    seed(i)
+    tic = time.time()
+    model, best_val_loss, best_val_score, final_test_score, best_epoch, best_hop_weights = \
+        run(g, feat, labels, train_mask, val_mask, test_mask, ACCEvaluator(), device, args, hops)
+    return {
+        "weight_style": weight_style, "K": K, "seed": i,
+        "best_val_loss": best_val_loss, "best_val_score": float(best_val_score),
+        "final_test_score": float(final_test_score), "best_epoch": best_epoch,
+        "params": int(count_parameters(model)), "time": time.time() - tic,
+    }, best_hop_weights
+
+
+def hop_weights_path(results_path, cell):
+    weight_style, K, i = cell
+    return os.path.join(os.path.splitext(results_path)[0] + "_hop_weights", f"{weight_style}_K{K}_seed{i}.pt")
+
+
+def load_results(results_path):
+    results = {}
+    if results_path and os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut off by a killed sweep
+                    continue
+                results[(record["weight_style"], record["K"], record["seed"])] = record
+    return results
+
+
+def sweep(shared, cells, args):
+    """Runs the missing cells, n_workers processes with worker_threads threads each (0: in this process)."""
+    results = load_results(args.results)
+    hop_weights = {}
+    todo = [cell for cell in cells if cell not in results]
+    print(f'{len(cells) - len(todo)}/{len(cells)} cells already done')
+
+    def collect(record, best_hop_weights):
+        cell = (record["weight_style"], record["K"], record["seed"])
+        results[cell] = record
+        hop_weights[cell] = best_hop_weights
+        if args.results:
+            path = hop_weights_path(args.results, cell)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            torch.save(best_hop_weights, path)
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        bar.set_description(f'{record["weight_style"]}, K {record["K"]}, seed {record["seed"]}: {record["best_val_score"]:.4f}/{record["final_test_score"]:.4f}')
+
+    bar = tqdm(total=len(todo))
+    if args.n_workers > 0:
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(args.n_workers, initializer=sweep_worker_init, initargs=(shared, args, args.worker_threads)) as pool:
+            for record, best_hop_weights in pool.imap_unordered(sweep_cell, todo):
+                collect(record, best_hop_weights)
+                bar.update()
+    else:
+        sweep_worker_init(shared, args, args.worker_threads)
+        for cell in todo:
+            collect(*sweep_cell(cell))
+            bar.update()
+    bar.close()
+
+    for cell in cells:
+        if cell not in hop_weights and args.results:
+            hop_weights[cell] = torch.load(hop_weights_path(args.results, cell))
+    return results, hop_weights
+
+
 def define_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--lr', type=float, default=0.01)
@@ -220,15 +359,28 @@ def define_args():
     parser.add_argument('--residual', action='store_true')
     parser.add_argument('--eval-steps', type=int, default=1)
     parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--dataset', type=str, default='ogbn-arxiv', choices=['ogbn-arxiv', 'synthetic-ogbn-arxiv'])
+    parser.add_argument('--synthetic-scale', type=float, default=1.0, help='size of the synthetic graph relative to the real one')
     parser.add_argument('--log-steps', type=int, default=100)
+    parser.add_argument('--weight-styles', type=str, nargs='+', default=['mean', 'HA', 'HC'])
+    parser.add_argument('--max-K', type=int, default=8)
+    parser.add_argument('--n-seeds', type=int, default=5)
+    parser.add_argument('--n-workers', type=int, default=0, help='sweep worker processes, 0 to run all cells in this process')
+    parser.add_argument('--worker-threads', type=int, default=0, help='torch threads per worker, 0 for the default')
+    parser.add_argument('--share-hops', action='store_true',
+                        help='gcn / sage only: diffuse the raw features once up to max K and let every K slice that prefix')
+    parser.add_argument('--results', type=str, default='', help='JSONL file the finished cells are appended to, the sweep resumes from it')
     return parser.parse_args()
 
 def main(args):
     # DataLoading
-    dataset_name = 'ogbn-arxiv'
+    dataset_name, synthetic = split_synthetic(args.dataset)
     root = '/mnt/ssd/ssd/dataset'
 
-    dataset = DglNodePropPredDataset(name=dataset_name, root=root)
+    if synthetic:
+        dataset = SyntheticNodePropPredDataset(dataset_name, scale=args.synthetic_scale)
+    else:
+        dataset = DglNodePropPredDataset(name=dataset_name, root=root)
     g, labels = dataset[0]
     srcs, dsts = g.all_edges()
     g.add_edges(dsts, srcs)
@@ -240,7 +392,7 @@ def main(args):
     g = g.to(device)
     labels = labels.to(device)
 
-    deg_sqrt, deg_isqrt = compute_norm(g)
+    deg_inv, deg_sqrt, deg_isqrt = compute_norm(g)
         
         
     g.srcdata.update({"src_norm": deg_isqrt})
@@ -250,7 +402,10 @@ def main(args):
     g.srcdata.update({"src_norm": deg_isqrt})
     g.dstdata.update({"dst_norm": deg_sqrt})
     g.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm_adjust"))
+
+    g.edata["sage_norm"] = deg_inv[g.edges()[1]]
     evaluator = ACCEvaluator()
+    args.pos_emb = not args.no_position_emb
 
     feat = g.ndata['feat']
     # labels = g.ndata['label']
@@ -265,10 +420,23 @@ def main(args):
     test_mask = torch.zeros(g.number_of_nodes(), dtype=torch.bool)
     test_mask[test_idx] = True
 
+    Ks = list(range(1, args.max_K + 1))
+    cells = sweep_cells(args.weight_styles, Ks, args.n_seeds)
+    hops = precompute_hops(g, feat, args.max_K, args.transition_matrix) if args.share_hops else None
+    results, hop_weights = sweep(share_graph(g, feat, labels, train_mask, val_mask, test_mask, hops), cells, args)
+
     hop_weights_dict = {}
-    for weight_style in ['mean', 'HA', 'HC']:
-        args.weight_style = weight_style
-        best_val_scores, final_test_scores, hop_weights_list = experiment(g, feat, labels, train_mask, val_mask, test_mask, evaluator, device, args)
-        hop_weights_dict[args.weight_style] = hop_weights_list
+    for weight_style in args.weight_styles:
+        hop_weights_dict[weight_style] = []
+        for K in Ks:
+            records = [results[(weight_style, K, i)] for i in range(args.n_seeds)]
+            best_val_scores = [record["best_val_score"] for record in records]
+            final_test_scores = [record["final_test_score"] for record in records]
+            print(f'params: {records[0]["params"]}, {weight_style}, pos_emb {args.pos_emb}, K {K}: {np.mean(best_val_scores):.4f}±{np.std(best_val_scores):.4f}/{np.mean(final_test_scores):.4f}±{np.std(final_test_scores):.4f}')
+            hop_weights_dict[weight_style].append([hop_weights[(weight_style, K, i)] for i in range(args.n_seeds)])
     
     torch.save(hop_weights_dict, f'{args.transition_matrix}_hop_weights.pt')
+
+
+if __name__ == '__main__':
+    main(define_args())
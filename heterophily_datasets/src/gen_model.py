@@ -1,7 +1,10 @@
 from models import MPNN, AGDN
 import torch.nn.functional as F
 
-def gen_model(in_feats, n_classes, args):
+from agdn_common import agdn_ops
+from agdn_common import precision
+
+def gen_model(in_feats, n_classes, args, n_replicas=1):
     use_attn_dst = not args.no_attn_dst
     residual = not args.no_residual
     bias_last = not args.no_bias_last
@@ -59,8 +62,14 @@ def gen_model(in_feats, n_classes, args):
                 bias_last=bias_last,
                 no_bias=args.no_bias,
                 zero_inits=args.zero_inits,
+                n_replicas=n_replicas,
                 )
 
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
+
     # print(model)
     return model
 
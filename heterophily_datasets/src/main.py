@@ -14,10 +14,14 @@ from matplotlib import pyplot as plt
 from matplotlib.ticker import AutoMinorLocator, MultipleLocator
 from dgl.data import ChameleonDataset, SquirrelDataset, ActorDataset
 
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from agdn_common import instrument
+from agdn_common import precision
 from gen_model import gen_model
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
 from utils import (add_labels, adjust_learning_rate, compute_acc, compute_norm,
                    cross_entropy, loge_cross_entropy, plot, print_info, seed,
-                   split_dataset, index_to_mask)
+                   split_dataset, index_to_mask, positional_encoding)
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -30,10 +34,14 @@ def train(args, model, graph, labels, train_mask, optimizer, loss_fcn, epoch=1):
 
     feat = graph.ndata["feat"]
     optimizer.zero_grad()
-    pred = model(graph, feat)
-    loss = loss_fcn(pred[train_mask], labels[train_mask])
-    loss.backward()
-    optimizer.step()
+    with instrument.stage("forward"):
+        pred = model(graph, feat)
+    with instrument.stage("loss"):
+        loss = loss_fcn(pred[train_mask], labels[train_mask])
+    with instrument.stage("backward"):
+        loss.backward()
+    with instrument.stage("optimizer"):
+        optimizer.step()
 
     return compute_acc(pred[train_mask], labels[train_mask]), loss
 
@@ -83,19 +91,7 @@ def run(args, graph, labels, train_mask, val_mask, test_mask, n_running):
     losses, train_losses, val_losses, test_losses = [], [], [], []
 
     ### do nomalization only once
-    
-    deg_inv, deg_sqrt, deg_isqrt = compute_norm(graph)
-    
-    
-    graph.srcdata.update({"src_norm": deg_isqrt})
-    graph.dstdata.update({"dst_norm": deg_isqrt})
-    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm"))
-
-    graph.srcdata.update({"src_norm": deg_isqrt})
-    graph.dstdata.update({"dst_norm": deg_sqrt})
-    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm_adjust"))
-
-    graph.edata["sage_norm"] = deg_inv[graph.edges()[1]]
+    set_norms(graph)
 
     checkpoint_path = args.checkpoint_path
     count = 0
@@ -107,12 +103,14 @@ def run(args, graph, labels, train_mask, val_mask, test_mask, n_running):
 
         acc, loss = train(args, model, graph, labels, train_mask, optimizer, loss_fcn, epoch=epoch)
 
-        train_acc, val_acc, test_acc, train_loss, val_loss, test_loss, pred = evaluate(
-            args, model, graph, labels, train_mask, val_mask, test_mask, loss_fcn
-        )
+        with instrument.stage("evaluation"):
+            train_acc, val_acc, test_acc, train_loss, val_loss, test_loss, pred = evaluate(
+                args, model, graph, labels, train_mask, val_mask, test_mask, loss_fcn
+            )
 
         toc = time.time()
         total_time += toc - tic
+        instrument.epoch_end(epoch, run=n_running, epoch_time=toc - tic)
 
         if args.selection_metric == "acc":
             new_best = val_acc > best_val_acc
@@ -157,6 +155,114 @@ def run(args, graph, labels, train_mask, val_mask, test_mask, n_running):
     return best_val_acc, best_test_acc
 
 
+def set_norms(graph):
+    deg_inv, deg_sqrt, deg_isqrt = compute_norm(graph)
+
+    graph.srcdata.update({"src_norm": deg_isqrt})
+    graph.dstdata.update({"dst_norm": deg_isqrt})
+    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm"))
+
+    graph.srcdata.update({"src_norm": deg_isqrt})
+    graph.dstdata.update({"dst_norm": deg_sqrt})
+    graph.apply_edges(fn.u_mul_v("src_norm", "dst_norm", "gcn_norm_adjust"))
+
+    graph.edata["sage_norm"] = deg_inv[graph.edges()[1]]
+
+
+def run_replicas(args, graph, labels, masks, models, n_runnings):
+    # Trains len(models) runs as stacked replicas of one model: every replica keeps
+    # its own initialization (copied from models), split, dropout masks, early
+    # stopping and optimizer state (Adam / RMSprop are elementwise, so one
+    # optimizer over the stacked parameters equals one optimizer per replica).
+    assert args.model == "agdn", "stacked replicas are only implemented for agdn"
+    n_replicas = len(models)
+    if n_replicas > 1:
+        model = gen_model(in_feats, n_classes, args, n_replicas=n_replicas)
+        model.load_replicas(models)
+    else:
+        model = models[0]
+    model = model.to(device)
+
+    if not args.standard_loss:
+        loss_fcn = loge_cross_entropy
+    else:
+        loss_fcn = cross_entropy
+    if args.optimizer == "rmsprop":
+        optimizer = optim.RMSprop(model.parameters(), lr=args.lr, weight_decay=args.wd)
+    elif args.optimizer == "adam":
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
+
+    set_norms(graph)
+    feat = graph.ndata["feat"]
+
+    total_time = 0
+    best_val_accs, best_test_accs = [0] * n_replicas, [0] * n_replicas
+    best_val_losses = [float("inf")] * n_replicas
+    final_preds = [None] * n_replicas
+    counts = [0] * n_replicas
+    for epoch in range(1, args.n_epochs + 1):
+        tic = time.time()
+
+        if args.adjust_lr:
+            adjust_learning_rate(optimizer, args.lr, epoch)
+
+        model.train()
+        optimizer.zero_grad()
+        with instrument.stage("forward"):
+            pred = model(graph, feat).view(feat.shape[0], n_replicas, -1)
+        # replicas that stopped early keep training, only their best scores are frozen
+        with instrument.stage("loss"):
+            loss = sum(loss_fcn(pred[train_mask, r], labels[train_mask]) for r, (train_mask, _, _) in enumerate(masks))
+        with instrument.stage("backward"):
+            loss.backward()
+        with instrument.stage("optimizer"):
+            optimizer.step()
+
+        model.eval()
+        with torch.no_grad(), instrument.stage("evaluation"):
+            pred = model(graph, feat).view(feat.shape[0], n_replicas, -1)
+
+        toc = time.time()
+        total_time += toc - tic
+        instrument.epoch_end(epoch, run=list(n_runnings), epoch_time=toc - tic)
+
+        for r, (train_mask, val_mask, test_mask) in enumerate(masks):
+            if counts[r] == args.patience:
+                continue
+            val_acc = compute_acc(pred[val_mask, r], labels[val_mask])
+            val_loss = loss_fcn(pred[val_mask, r], labels[val_mask])
+            if args.selection_metric == "acc":
+                new_best = val_acc > best_val_accs[r]
+            else:
+                new_best = val_loss < best_val_losses[r]
+            if new_best:
+                best_val_losses[r] = val_loss
+                best_val_accs[r] = val_acc
+                best_test_accs[r] = compute_acc(pred[test_mask, r], labels[test_mask])
+                final_preds[r] = pred[:, r]
+                counts[r] = 0
+            else:
+                counts[r] += 1
+
+        if epoch % args.log_every == 0:
+            print_info(f"Runs: {n_runnings[0]}-{n_runnings[-1]}/{args.n_runs}, Epoch: {epoch}/{args.n_epochs}", verbose=args.verbose)
+            print_info(f"Time: {(total_time / epoch):.4f}, Loss: {loss.item() / n_replicas:.4f}", verbose=args.verbose)
+            print_info(f"Best val/Best test acc: {best_val_accs}/{best_test_accs}", verbose=args.verbose)
+
+        if all(count == args.patience for count in counts):
+            break
+
+    print_info("*" * 50, verbose=args.verbose)
+    print_info(f"Average epoch time: {total_time / args.n_epochs}, Test accs: {best_test_accs}", verbose=args.verbose)
+
+    if args.save_pred:
+        os.makedirs(args.output_path, exist_ok=True)
+        for n_running, final_pred in zip(n_runnings, final_preds):
+            torch.save(F.softmax(final_pred, dim=1), os.path.join(args.output_path, f"{n_running - 1}.pt"))
+
+    return best_val_accs, best_test_accs
+
+
 def count_parameters(args):
     model = gen_model(in_feats, n_classes, args)
     # print([np.prod(p.size()) for p in model.parameters() if p.requires_grad])
@@ -168,11 +274,17 @@ def main():
 
     argparser = argparse.ArgumentParser("AGDN on OGBN-Arxiv", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # Dataset and device setting
-    argparser.add_argument("--dataset", type=str, default="chameleon")
+    argparser.add_argument("--dataset", type=str, default="chameleon",
+                           help="chameleon, squirrel, actor, or synthetic-ogbn-arxiv / synthetic-ogbn-products for offline runs")
+    argparser.add_argument("--synthetic-scale", type=float, default=1.0, help="size of the synthetic graph relative to the real one")
     argparser.add_argument("--cpu", action="store_true", help="CPU mode. This option overrides --gpu.")
     argparser.add_argument("--gpu", type=int, default=0, help   ="GPU device ID.")
     argparser.add_argument("--root", type=str, default="/mnt/ssd/ssd/dataset")
     argparser.add_argument("--no-self-loops", action="store_true", help="Do not add self-loops.")
+    argparser.add_argument("--pe-dim", type=int, default=0,
+        help="if > 0, append this many Laplacian positional encodings (eigenvectors) to the node features")
+    argparser.add_argument("--pe-cache-dir", type=str, default="",
+        help="cache the positional encodings in this directory, keyed by graph hash and --pe-dim")
     argparser.add_argument("--train_size", type=float, default=0.6)
     argparser.add_argument("--val_size", type=float, default=0.2)
 
@@ -180,6 +292,7 @@ def main():
     argparser.add_argument("--seed", type=int, default=0, help="initial random seed.")
     argparser.add_argument("--selection-metric", type=str, default="acc", choices=["acc", "loss"])
     argparser.add_argument("--n-runs", type=int, default=10)
+    argparser.add_argument("--n-replicas", type=int, default=1, help="train this many runs at once as stacked replicas of one model (agdn only)")
     argparser.add_argument("--n-epochs", type=int, default=2000)
     argparser.add_argument("--lr", type=float, default=0.001)
     argparser.add_argument("--optimizer", type=str, default="adam", choices=["rmsprop", "adam"])
@@ -222,14 +335,23 @@ def main():
     argparser.add_argument("--checkpoint-path", type=str, default="../checkpoint/")
     argparser.add_argument("--output-path", type=str, default="../output/")
     argparser.add_argument("--save-pred", action="store_true", help="save final predictions")
+    argparser.add_argument("--legacy-agdn", action="store_true",
+        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    argparser.add_argument("--precision", type=str, default="fp32", choices=precision.PRECISIONS,
+        help="bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32")
+    argparser.add_argument("--trace", type=str, default="", help="write per-epoch time and memory of the training stages to this JSONL file")
+    argparser.add_argument("--chrome-trace", type=str, default="", help="with --trace, also dump every stage in Chrome trace format here")
     
     args = argparser.parse_args()
     print_info(f"args: {args}", verbose=args.verbose)
+    assert args.precision == "fp32" or args.model == "agdn", "--precision bf16 is implemented for AGDN"
+    assert args.legacy_agdn or args.model != "agdn" or args.n_replicas == 1, "stacked replicas need --legacy-agdn"
 
     if args.cpu:
         device = torch.device("cpu")
     else:
         device = torch.device("cuda:%d" % args.gpu)
+    assert precision.supported(args.precision, device), "--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels"
 
     # load data
     if args.dataset == "chameleon":
@@ -238,6 +360,10 @@ def main():
         data = SquirrelDataset()
     elif args.dataset == "actor":
         data = ActorDataset()
+    elif split_synthetic(args.dataset)[1]:
+        graph, labels = SyntheticNodePropPredDataset(split_synthetic(args.dataset)[0], scale=args.synthetic_scale)[0]
+        graph.ndata["label"] = labels.view(-1)
+        data = [graph]
 
     
     graph = data[0]
@@ -263,18 +389,29 @@ def main():
     #     graph.update_all(fn.copy_u('PE', 'm'), fn.mean('m', 'PE'))
     #     PE.append(graph.ndata['PE'])
     # graph.ndata['PE'] = torch.stack(PE, dim=1)
+    if args.pe_dim > 0:
+        # of the final graph, i.e. with reverse edges and self-loops; repeated runs load them from --pe-cache-dir
+        pe = positional_encoding(graph, args.pe_dim, cache_dir=args.pe_cache_dir or None)
+        graph.ndata["feat"] = torch.cat([graph.ndata["feat"], pe], dim=-1)
+        print_info(f"node feature size with positional encodings: {graph.ndata['feat'].shape[-1]}", verbose=args.verbose)
     in_feats = graph.ndata["feat"].shape[1]
     n_classes = (labels.max() + 1).item()
     # graph.create_format_()
 
-    
-    labels = labels.to(device)
-    graph = graph.to(device)
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda=device.type == "cuda")
+
+    with instrument.stage("h2d"):
+        labels = labels.to(device)
+        graph = graph.to(device)
+    # setup stages go to an epoch 0 record
+    instrument.epoch_end(0)
 
     # run
     val_accs = []
     test_accs = []
 
+    replicas = []
     for i in range(1, args.n_runs + 1):
         seed(i + args.seed)
         indices = split_dataset(labels, args.train_size, args.val_size, 1 - args.train_size - args.val_size)
@@ -285,9 +422,20 @@ def main():
         train_mask = train_mask.to(device)
         val_mask = val_mask.to(device)
         test_mask = test_mask.to(device)
+        if args.n_replicas > 1:
+            # same initialization as the sequential run i
+            replicas.append((i, (train_mask, val_mask, test_mask), gen_model(in_feats, n_classes, args)))
+            if len(replicas) == args.n_replicas or i == args.n_runs:
+                n_runnings, masks, models = zip(*replicas)
+                val_acc, test_acc = run_replicas(args, graph, labels, masks, models, n_runnings)
+                val_accs.extend(val_acc)
+                test_accs.extend(test_acc)
+                replicas = []
+            continue
         val_acc, test_acc = run(args, graph, labels, train_mask, val_mask, test_mask, i)
         val_accs.append(val_acc)
         test_accs.append(test_acc)
+    instrument.close()
 
     print_info(f"Runned {args.n_runs} times", verbose=args.verbose)
     print_info(f"Val Accs: {val_accs}", verbose=args.verbose)
@@ -5,10 +5,12 @@ import torch.nn.functional as F
 from dgl import function as fn
 from dgl._ffi.base import DGLError
 from dgl.nn.pytorch.utils import Identity
-from dgl.ops import edge_softmax
 from dgl.utils import expand_as_pair
 from torch.nn.modules.linear import Linear
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
 
 # class GCN(nn.Module):
 #     def __init__(self, in_feats, n_hidden, n_classes, n_layers, activation, dropout, residual):
@@ -303,6 +305,21 @@ Our proposed AGDN actually contains AGDN_GCN, AGDN_GAT, AGDN_GAT_sym and AGDN_GA
 which depends on the transition matrix.
 '''
 
+class ReplicaLinear(nn.Module):
+    """n_replicas independent bias-free linears, N x n_replicas x in_feats -> N x n_replicas x out_feats."""
+
+    def __init__(self, n_replicas, in_feats, out_feats):
+        super().__init__()
+        self.weight = nn.Parameter(torch.FloatTensor(size=(n_replicas, out_feats, in_feats)))
+
+    def reset_parameters(self, gain=1.0):
+        for weight in self.weight:
+            nn.init.xavier_normal_(weight, gain=gain)
+
+    def forward(self, x):
+        return torch.einsum("nri,roi->nro", x, self.weight)
+
+
 class AGDNConv(nn.Module):
     def __init__(
         self,
@@ -327,7 +344,10 @@ class AGDNConv(nn.Module):
         propagate_first=False,
         zero_inits=False,
         bias=True,
+        n_replicas=1,
     ):
+        # n_replicas > 1 stacks independent replicas along the heads: num_heads
+        # counts the heads of all replicas and the input is N x n_replicas x in_feats
         super(AGDNConv, self).__init__()
         self._num_heads = num_heads
         self._in_src_feats, self._in_dst_feats = expand_as_pair(in_feats)
@@ -341,6 +361,7 @@ class AGDNConv(nn.Module):
         self._batch_norm = batch_norm
         self._propagate_first = propagate_first
         self._zero_inits = zero_inits
+        self._n_replicas = n_replicas
 
         if propagate_first:
             propagate_feats = in_feats
@@ -356,7 +377,10 @@ class AGDNConv(nn.Module):
             else:
                 self.register_buffer("attn_r", None)
 
-        self.fc = nn.Linear(self._in_src_feats, out_feats * num_heads, bias=False)
+        if n_replicas > 1:
+            self.fc = ReplicaLinear(n_replicas, self._in_src_feats, out_feats * num_heads // n_replicas)
+        else:
+            self.fc = nn.Linear(self._in_src_feats, out_feats * num_heads, bias=False)
         if position_emb:
             self.position_emb = nn.Parameter(torch.FloatTensor(size=(K+1, num_heads, propagate_feats)))
         if weight_style in ["HA", "HA+HC"]:
@@ -379,7 +403,9 @@ class AGDNConv(nn.Module):
         self.edge_drop = edge_drop
         self.diffusion_drop = diffusion_drop
         self.leaky_relu = nn.LeakyReLU(negative_slope)
-        if residual:
+        if residual and n_replicas > 1:
+            self.res_fc = ReplicaLinear(n_replicas, self._in_dst_feats, num_heads * out_feats // n_replicas)
+        elif residual:
             self.res_fc = nn.Linear(self._in_dst_feats, num_heads * out_feats, bias=False)
         else:
             self.register_buffer("res_fc", None)
@@ -392,7 +418,9 @@ class AGDNConv(nn.Module):
 
     def reset_parameters(self):
         gain = nn.init.calculate_gain("relu")
-        if hasattr(self, "fc"):
+        if isinstance(self.fc, ReplicaLinear):
+            self.fc.reset_parameters(gain)
+        elif hasattr(self, "fc"):
             nn.init.xavier_normal_(self.fc.weight, gain=gain)
         else:
             nn.init.xavier_normal_(self.fc_src.weight, gain=gain)
@@ -416,7 +444,9 @@ class AGDNConv(nn.Module):
         if self._weight_style in ["HC", "HA+HC"]:
             nn.init.xavier_uniform_(self.weights, gain=gain)
             # nn.init.ones_(self.weights)
-        if isinstance(self.res_fc, nn.Linear):
+        if isinstance(self.res_fc, ReplicaLinear):
+            self.res_fc.reset_parameters(gain)
+        elif isinstance(self.res_fc, nn.Linear):
             nn.init.xavier_normal_(self.res_fc.weight, gain=gain)
         if isinstance(self.bias, nn.Parameter):
             nn.init.zeros_(self.bias)
@@ -435,7 +465,12 @@ class AGDNConv(nn.Module):
             h = h + self.position_emb[[idx], :, :]
         return h
 
-    def forward(self, graph, feat):
+    def forward(self, graph, feat, hops=None):
+        # hops: [feat, T feat, ..., T^K' feat] with K' >= K, the raw input already
+        # diffused by a fixed (gcn / sage) transition matrix T, e.g. shared by a
+        # sweep over K. Since T^k (X W) = (T^k X) W the hops are only projected.
+        if hops is not None:
+            return self.forward_hops(feat, hops)
         with graph.local_scope():
             if not self._allow_zero_in_degree:
                 if (graph.in_degrees() == 0).any():
@@ -466,13 +501,24 @@ class AGDNConv(nn.Module):
                     h_dst = h_src
                     feat_dst = feat_src
             
-            if self.training and self.edge_drop > 0:
+            keep = None
+            if self.training and self.edge_drop > 0 and self._n_replicas > 1:
+                # one edge dropout mask per replica: its dropped edges get no attention and the softmax is over its
+                # kept in-edges only, as with eids below
+                n_edges = graph.number_of_edges()
+                perm = torch.rand(n_edges, self._n_replicas, device=graph.device).argsort(dim=0)
+                keep = torch.ones(n_edges, self._n_replicas, dtype=torch.bool, device=graph.device)
+                keep.scatter_(0, perm[: int(n_edges * self.edge_drop)], False)
+                keep = keep.repeat_interleave(self._num_heads // self._n_replicas, dim=1).unsqueeze(-1)
+                eids = torch.arange(n_edges, device=graph.device)
+            elif self.training and self.edge_drop > 0:
                 perm = torch.randperm(graph.number_of_edges(), device=graph.device)
                 bound = int(graph.number_of_edges() * self.edge_drop)
                 eids = perm[bound:]
             else:
                 eids = torch.arange(graph.number_of_edges(), device=graph.device)
 
+            instrument.begin("attention")
             graph.srcdata.update({"ft": feat_src})
             if self._transition_matrix.startswith("gat"):
                 el = (feat_src * self.attn_l).sum(-1).unsqueeze(-1)
@@ -486,6 +532,8 @@ class AGDNConv(nn.Module):
                 else:
                     graph.apply_edges(fn.copy_u("el", "e"))
                 e = self.leaky_relu(graph.edata.pop("e"))
+                if keep is not None:
+                    e = e.masked_fill(~keep, -1e9)
                 
                 # compute softmax
                 
@@ -500,13 +548,17 @@ class AGDNConv(nn.Module):
                 a = graph.edata["gcn_norm"][eids].unsqueeze(1).unsqueeze(1)
             elif self._transition_matrix == "sage":
                 a = graph.edata["sage_norm"][eids].unsqueeze(1).unsqueeze(1)
+            if keep is not None:
+                a = a * keep
             
-            graph.edata["a"] = torch.zeros(size=(graph.number_of_edges(), self._num_heads, 1), device=feat_src.device)
+            graph.edata["a"] = torch.zeros(size=(graph.number_of_edges(), self._num_heads, 1), dtype=feat_src.dtype, device=feat_src.device)
             graph.edata["a"][eids] = self.attn_drop(a)
+            instrument.end()
             
             hstack = [graph.dstdata["ft"]]
 
-            for _ in range(self._K):
+            for k in range(self._K):
+                instrument.begin("hop", k + 1)
                 # message passing
                 if self.diffusion_drop > 0:
                     # We could choose to simulate the dropout between convolutions by setting diffusion_drop > 0
@@ -514,58 +566,74 @@ class AGDNConv(nn.Module):
                 graph.update_all(fn.u_mul_e("ft", "a", "m"), fn.sum("m", "ft"))
 
                 hstack.append(graph.dstdata["ft"])
+                instrument.end()
 
-            hstack = [self.feat_trans(h, k) for k, h in enumerate(hstack)]
-
-            hop_a = None
-            if self._weight_style in ["HA", "HA+HC"]:
-                hop_a_l = (hstack[0] * self.hop_attn_l).sum(dim=-1).unsqueeze(-1)
-                hop_astack_r = [(feat_dst * self.hop_attn_r).sum(dim=-1).unsqueeze(-1) for feat_dst in hstack]
-                hop_a = torch.cat([(a_r + hop_a_l) for a_r in hop_astack_r], dim=-1)
-                if self._HA_activation == "sigmoid":
-                    hop_a = torch.sigmoid(hop_a)
-                if self._HA_activation == "leakyrelu":
-                    hop_a = self.leaky_relu(hop_a)
-                if self._HA_activation == "relu":
-                    hop_a = F.relu(hop_a)
-                if self._HA_activation == "standardize":
-                    hop_a = (hop_a - hop_a.min(dim=2, keepdim=True)[0]) / (hop_a.max(dim=2, keepdim=True)[0] - hop_a.min(dim=2, keepdim=True)[0]).clamp(min=1e-9)
-
-                hop_a = F.softmax(hop_a, dim=-1)
-                # hop_a = self.attn_drop(hop_a)
-                if not self.training:
-                    self.hop_a = hop_a
+            return self.combine_hops(feat, h_dst, hstack)
+
+    def forward_hops(self, feat, hops):
+        assert self._transition_matrix in ["gcn", "sage"], "only fixed transition matrices can be precomputed"
+        assert not self.training or (self.feat_drop.p == 0 and self.attn_drop.p == 0 and self.edge_drop == 0 and self.diffusion_drop == 0)
+        assert len(hops) > self._K
+        hops = torch.stack(list(hops[: self._K + 1]))
+        if not self._propagate_first:
+            hops = self.fc(hops)
+        hstack = [h.view(h.shape[0], -1, h.shape[-1] // (1 if self._propagate_first else self._num_heads)) for h in hops]
+        return self.combine_hops(feat, feat, hstack)
+
+    def combine_hops(self, feat, h_dst, hstack):
+        instrument.begin("hop_aggregation")
+        hstack = [self.feat_trans(h, k) for k, h in enumerate(hstack)]
+
+        hop_a = None
+        if self._weight_style in ["HA", "HA+HC"]:
+            hop_a_l = (hstack[0] * self.hop_attn_l).sum(dim=-1).unsqueeze(-1)
+            hop_astack_r = [(feat_dst * self.hop_attn_r).sum(dim=-1).unsqueeze(-1) for feat_dst in hstack]
+            hop_a = torch.cat([(a_r + hop_a_l) for a_r in hop_astack_r], dim=-1)
+            if self._HA_activation == "sigmoid":
+                hop_a = torch.sigmoid(hop_a)
+            if self._HA_activation == "leakyrelu":
+                hop_a = self.leaky_relu(hop_a)
+            if self._HA_activation == "relu":
+                hop_a = F.relu(hop_a)
+            if self._HA_activation == "standardize":
+                hop_a = (hop_a - hop_a.min(dim=2, keepdim=True)[0]) / (hop_a.max(dim=2, keepdim=True)[0] - hop_a.min(dim=2, keepdim=True)[0]).clamp(min=1e-9)
+
+            hop_a = F.softmax(hop_a.float(), dim=-1)
+            # hop_a = self.attn_drop(hop_a)
+            if not self.training:
+                self.hop_a = hop_a
+            
+            rst = 0
+            for i in range(hop_a.shape[2]):
                 
-                rst = 0
-                for i in range(hop_a.shape[2]):
-                    
-                    if self._weight_style == "HA+HC":
-                        rst += hstack[i] * hop_a[:, :, [i]] * self.weights[:, :, i, :]
-                    else:
-                        rst += hstack[i] * hop_a[:, :, [i]]
-
-            if self._weight_style == "HC":
-                rst = 0
-                for i in range(len(hstack)):
-                    rst += hstack[i] * self.weights[:, :, i, :]
-            if self._weight_style == "mean":
-                rst = 0
-                for i in range(len(hstack)):
-                    rst += hstack[i] / len(hstack)
-
-            if self._propagate_first:
-                rst = self.fc(rst)
-            # residual
-            if self.res_fc is not None:
-                resval = self.res_fc(feat).view(h_dst.shape[0], -1, self._out_feats)
-                rst = rst + resval
-            # bias
-            if self.bias is not None:
-                rst = rst + self.bias
-            # activation
-            if self._activation is not None:
-                rst = self._activation(rst)
-            return rst
+                if self._weight_style == "HA+HC":
+                    rst += hstack[i] * hop_a[:, :, [i]] * self.weights[:, :, i, :]
+                else:
+                    rst += hstack[i] * hop_a[:, :, [i]]
+
+        if self._weight_style == "HC":
+            rst = 0
+            for i in range(len(hstack)):
+                rst += hstack[i] * self.weights[:, :, i, :]
+        if self._weight_style == "mean":
+            rst = 0
+            for i in range(len(hstack)):
+                rst += hstack[i] / len(hstack)
+        instrument.end()
+
+        if self._propagate_first:
+            rst = self.fc(rst)
+        # residual
+        if self.res_fc is not None:
+            resval = self.res_fc(feat).view(h_dst.shape[0], -1, self._out_feats)
+            rst = rst + resval
+        # bias
+        if self.bias is not None:
+            rst = rst + self.bias
+        # activation
+        if self._activation is not None:
+            rst = self._activation(rst)
+        return rst
 
 class AGDN(nn.Module):
     def __init__(
@@ -592,13 +660,16 @@ class AGDN(nn.Module):
         no_bias=False,
         zero_inits=False,
         batch_norm=False,
+        n_replicas=1,
     ):
+        # n_replicas > 1 trains independent copies side by side, see load_replicas
         super().__init__()
         self.in_feats = in_feats
         self.n_hidden = n_hidden
         self.n_classes = n_classes
         self.n_layers = n_layers
         self.num_heads = n_heads
+        self.n_replicas = n_replicas
 
         self.convs = nn.ModuleList()
 
@@ -614,7 +685,7 @@ class AGDN(nn.Module):
                     in_hidden, 
                     out_hidden, 
                     K=K, 
-                    num_heads=num_heads, 
+                    num_heads=num_heads * n_replicas, 
                     edge_drop=edge_drop, 
                     attn_drop=attn_drop, 
                     diffusion_drop=diffusion_drop,
@@ -627,6 +698,7 @@ class AGDN(nn.Module):
                     bias=(not bias_last) and (not no_bias),
                     zero_inits=zero_inits,
                     batch_norm=batch_norm,
+                    n_replicas=n_replicas,
                 )
             )
 
@@ -636,6 +708,9 @@ class AGDN(nn.Module):
         self.activation = activation
 
     def forward(self, graph, feat):
+        # with replicas the output is N x n_replicas x n_classes
+        if self.n_replicas > 1:
+            return self.forward_replicas(graph, feat)
         h = feat
         h = self.input_dropout(h)
         # h_last = h
@@ -655,3 +730,30 @@ class AGDN(nn.Module):
         h = h.mean(1)
 
         return h
+
+    def forward_replicas(self, graph, feat):
+        n_nodes, n_replicas = feat.shape[0], self.n_replicas
+        h = self.input_dropout(feat.unsqueeze(1).expand(n_nodes, n_replicas, feat.shape[-1]))
+        for i in range(self.n_layers):
+            h = self.convs[i](graph, h)
+
+            if i < self.n_layers - 1:
+                h = h.reshape(n_nodes, n_replicas, -1)
+                h = self.activation(h, inplace=True)
+                h = self.dropout(h)
+
+        return h.view(n_nodes, n_replicas, -1, h.shape[-1]).mean(2)
+
+    @torch.no_grad()
+    def load_replicas(self, models):
+        """Copies the parameters of len(models) == n_replicas single AGDNs into the replicas."""
+        assert len(models) == self.n_replicas
+        states = [model.state_dict() for model in models]
+        for name, param in self.state_dict().items():
+            values = [state[name] for state in states]
+            if param.dim() == values[0].dim() + 1:
+                # ReplicaLinear weights
+                param.copy_(torch.stack(values))
+            else:
+                # per-head parameters, replicas are stacked along the heads
+                param.copy_(torch.cat(values, dim=1))
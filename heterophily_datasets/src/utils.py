@@ -1,9 +1,11 @@
+import hashlib
 import math
 import os
 import random
 
 import dgl
 from scipy import sparse as sp
+from scipy.sparse.linalg import eigsh, lobpcg
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -28,15 +30,58 @@ def index_to_mask(index, size):
     mask[index] = 1
     return mask
 
-def positional_encoding(g, pos_enc_dim):
+def graph_hash(g):
+    h = hashlib.sha1(str(g.number_of_nodes()).encode())
+    src, dst = g.all_edges(order="srcdst")
+    h.update(dgl.backend.asnumpy(src).astype(np.int64).tobytes())
+    h.update(dgl.backend.asnumpy(dst).astype(np.int64).tobytes())
+    return h.hexdigest()
+
+
+def normalized_laplacian(g):
+    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
+    if (A != A.T).nnz > 0:
+        # the symmetric solvers need a symmetric operator
+        A = ((A + A.T) > 0).astype(float)
+    degs = np.asarray(A.sum(axis=1)).flatten().clip(1)
+    N = sp.diags(degs ** -0.5, dtype=float)
+    return sp.eye(g.number_of_nodes()) - N * A * N
+
+
+def laplacian_eigenvectors(L, k, init=None, tol=1e-2, maxiter=200):
+    """Eigenvectors of the k smallest eigenvalues of L, in increasing order.
+
+    Uses LOBPCG when init (an n x k warm start, e.g. the eigenvectors of a
+    slightly different graph) is given, otherwise eigsh on 2I - L, whose largest
+    eigenvalues are the smallest ones of L and converge much faster.
+    """
+    n = L.shape[0]
+    if init is not None:
+        X = np.random.RandomState(0).normal(size=(n, k))
+        m, c = min(n, init.shape[0]), min(k, init.shape[1])
+        X[:m, :c] = init[:m, :c]
+        EigVal, EigVec = lobpcg(L, X, tol=tol, maxiter=maxiter, largest=False)
+    else:
+        EigVal, EigVec = eigsh(2 * sp.eye(n) - L, k=k, which="LA", tol=tol)
+        EigVal = 2 - EigVal
+    return EigVec[:, EigVal.argsort()]
+
+
+def positional_encoding(g, pos_enc_dim, cache_dir=None, init=None, tol=1e-2):
     """
         Graph positional encoding v/ Laplacian eigenvectors
+
+        Results are cached in cache_dir, keyed by the graph hash and pos_enc_dim.
+        init warm starts the solver (see laplacian_eigenvectors), either an array
+        or the cache file of a previous version of the graph.
     """
-    
-    # Laplacian
-    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
-    N = sp.diags(dgl.backend.asnumpy(g.in_degrees()).clip(1) ** -0.5, dtype=float)
-    L = sp.eye(g.number_of_nodes()) - N * A * N
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"lap_pe_{graph_hash(g)}_{pos_enc_dim}.npy")
+        if os.path.exists(cache_file):
+            return torch.from_numpy(np.load(cache_file)[:, 1:]).float().to(g.device)
+    if isinstance(init, str):
+        init = np.load(init)
 
     # # Eigenvectors with numpy
     # EigVal, EigVec = np.linalg.eig(L.toarray())
@@ -44,11 +89,12 @@ def positional_encoding(g, pos_enc_dim):
     # EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
     # g.ndata['pos_enc'] = torch.from_numpy(np.abs(EigVec[:,1:pos_enc_dim+1])).float() 
 
-    # Eigenvectors with scipy
-    #EigVal, EigVec = sp.linalg.eigs(L, k=pos_enc_dim+1, which='SR')
-    EigVal, EigVec = sp.linalg.eigs(L, k=pos_enc_dim+1, which='SR', tol=1e-2)
-    EigVec = EigVec[:, EigVal.argsort()] # increasing order
-    return torch.from_numpy(np.real(EigVec[:,1:pos_enc_dim+1])).float().to(g.device)
+    EigVec = laplacian_eigenvectors(normalized_laplacian(g), pos_enc_dim + 1, init=init, tol=tol)
+    if cache_file is not None:
+        # the trivial eigenvector is kept so the file can warm start later solves
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, EigVec.astype(np.float32))
+    return torch.from_numpy(EigVec[:, 1:pos_enc_dim + 1]).float().to(g.device)
 
     
 def compute_norm(graph):
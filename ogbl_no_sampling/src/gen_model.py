@@ -1,3 +1,5 @@
+from agdn_common import agdn_ops
+from agdn_common import precision
 from models import GCN, GAT, SAGE, AGDN, MemAGDN, DotPredictor, CosPredictor, LinkPredictor
 
 def gen_model(args, in_feats, in_edge_feats, device):
@@ -16,7 +18,8 @@ def gen_model(args, in_feats, in_edge_feats, device):
         model = SAGE(in_feats, args.n_hidden,
                      args.n_hidden, args.n_layers,
                      args.dropout, args.input_drop,
-                     bn=args.bn, residual=args.residual).to(device)
+                     bn=args.bn, residual=args.residual,
+                     aggregator_type=args.sage_aggregator).to(device)
     if args.model == 'agdn':
         model = AGDN(in_feats, args.n_hidden,
                      args.n_hidden, args.n_layers,
@@ -38,6 +41,11 @@ def gen_model(args, in_feats, in_edge_feats, device):
                      args.n_heads, args.K,
                      args.dropout, args.input_drop, args.attn_drop,
                      in_edge_feats=in_edge_feats).to(device)
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv; MemAGDNConv has a memory module instead of
+        # diffusion hops and is left as it is
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
 
     # n_heads = args.n_heads if args.model in ['gat', 'agdn'] else 1
     if args.predictor == 'MLP':
@@ -9,14 +9,46 @@ from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.nn.dense.linear import Linear
 
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence
 
 from dgl import function as fn
-from dgl.nn.functional import edge_softmax
 import math
 from dgl.base import DGLError
 from dgl.nn.pytorch.utils import Identity
 from dgl.utils import expand_as_pair, check_eq_shape, dgl_warning
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
+def degree_buckets(degs, step_overhead=256):
+    r"""Split the positive in-degrees into buckets of nodes padded to the bucket maximum.
+
+    Running the LSTM over a bucket costs about ``max_degree * (step_overhead + n_nodes)``:
+    every step is one batched LSTM cell call, ``step_overhead`` is its fixed cost
+    expressed in node units. The buckets minimizing the total cost over the degree
+    histogram are found by dynamic programming over the distinct degrees.
+
+    Returns a list of ``(low, high)`` with ``low < degree <= high``.
+    """
+    values, counts = torch.unique(degs[degs > 0].cpu(), return_counts=True)
+    m = len(values)
+    prefix = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)]).double()
+    # best[j]: cost of the first j distinct degrees, split[j]: start of the last bucket
+    best = torch.zeros(m + 1, dtype=torch.float64)
+    split = [0] * (m + 1)
+    for j in range(1, m + 1):
+        cost = best[:j] + float(values[j - 1]) * (step_overhead + prefix[j] - prefix[:j])
+        best[j], i = cost.min(0)
+        split[j] = int(i)
+    values = values.tolist()
+    buckets, j = [], m
+    while j > 0:
+        i = split[j]
+        buckets.append((values[i - 1] if i > 0 else 0, values[j - 1]))
+        j = i
+    return buckets[::-1]
+
+
 class SAGEConv(nn.Module):
     r"""GraphSAGE layer from `Inductive Representation Learning on
     Large Graphs <https://arxiv.org/pdf/1706.02216.pdf>`__
@@ -66,6 +98,12 @@ class SAGEConv(nn.Module):
     activation : callable activation function/layer or None, optional
         If not None, applies an activation function to the updated node features.
         Default: ``None``.
+    degree_padding : bool
+        For the ``lstm`` aggregator, pad the neighbor sequences to a few degree
+        buckets (see :func:`degree_buckets`) instead of one LSTM call per distinct
+        in-degree. Default: ``True``.
+    lstm_step_overhead : int
+        Cost of one LSTM step in node units, used to choose the degree buckets.
 
     Examples
     --------
@@ -109,7 +147,9 @@ class SAGEConv(nn.Module):
                  feat_drop=0.,
                  bias=True,
                  norm=None,
-                 activation=None):
+                 activation=None,
+                 degree_padding=True,
+                 lstm_step_overhead=256):
         super(SAGEConv, self).__init__()
         valid_aggre_types = {'mean', 'gcn', 'pool', 'lstm'}
         if aggregator_type not in valid_aggre_types:
@@ -124,6 +164,8 @@ class SAGEConv(nn.Module):
         self.norm = norm
         self.feat_drop = nn.Dropout(feat_drop)
         self.activation = activation
+        self.degree_padding = degree_padding
+        self.lstm_step_overhead = lstm_step_overhead
         # aggregator type: mean/pool/lstm/gcn
         if aggregator_type == 'pool':
             self.fc_pool = nn.Linear(self._in_src_feats, self._in_src_feats)
@@ -186,6 +228,41 @@ class SAGEConv(nn.Module):
         _, (rst, _) = self.lstm(m, h)
         return {'neigh': rst.squeeze(0)}
 
+    def _lstm_padded(self, graph, feat_src, edge_weight=None):
+        """LSTM aggregation over degree buckets padded to the bucket maxima.
+
+        Messages keep the edge ID order of DGL's mailboxes, the padding is
+        skipped by packing the sequences so each node gets the hidden state
+        after its last neighbor.
+        """
+        src, dst = graph.edges()
+        n_dst = graph.number_of_dst_nodes()
+        degs = graph.in_degrees()
+        m = feat_src[src]
+        if edge_weight is not None:
+            m = m * edge_weight.view(-1, *([1] * (m.dim() - 1)))
+
+        # position of every edge in the (edge ID ordered) neighbor list of its dst
+        order = torch.argsort(dst * graph.number_of_edges() + torch.arange(len(dst), device=dst.device))
+        dst_sorted = dst[order]
+        offsets = torch.cumsum(degs, 0) - degs
+        pos = torch.empty_like(order)
+        pos[order] = torch.arange(len(order), device=order.device) - offsets[dst_sorted]
+
+        neigh = feat_src.new_zeros(n_dst, self._in_src_feats)
+        for low, high in degree_buckets(degs, self.lstm_step_overhead):
+            nodes = torch.nonzero((degs > low) & (degs <= high), as_tuple=True)[0]
+            row = torch.full((n_dst,), -1, dtype=torch.long, device=nodes.device)
+            row[nodes] = torch.arange(len(nodes), device=nodes.device)
+            eids = torch.nonzero(row[dst] >= 0, as_tuple=True)[0]
+
+            padded = m.new_zeros(len(nodes), high, self._in_src_feats)
+            padded[row[dst[eids]], pos[eids]] = m[eids]
+            packed = pack_padded_sequence(padded, degs[nodes].cpu(), batch_first=True, enforce_sorted=False)
+            _, (rst, _) = self.lstm(packed)
+            neigh[nodes] = rst.squeeze(0)
+        return neigh
+
     def forward(self, graph, feat, edge_weight=None):
         r"""
 
@@ -267,9 +344,12 @@ class SAGEConv(nn.Module):
                 graph.update_all(msg_fn, fn.max('m', 'neigh'))
                 h_neigh = self.fc_neigh(graph.dstdata['neigh'])
             elif self._aggre_type == 'lstm':
-                graph.srcdata['h'] = feat_src
-                graph.update_all(msg_fn, self._lstm_reducer)
-                h_neigh = self.fc_neigh(graph.dstdata['neigh'])
+                if self.degree_padding:
+                    h_neigh = self.fc_neigh(self._lstm_padded(graph, feat_src, edge_weight))
+                else:
+                    graph.srcdata['h'] = feat_src
+                    graph.update_all(msg_fn, self._lstm_reducer)
+                    h_neigh = self.fc_neigh(graph.dstdata['neigh'])
             else:
                 raise KeyError('Aggregator type {} not recognized.'.format(self._aggre_type))
 
@@ -723,6 +803,7 @@ class AGDNConv(nn.Module):
                     feat_dst = feat_src[:graph.number_of_dst_nodes()]
                     h_dst = h_dst[:graph.number_of_dst_nodes()]
             
+            instrument.begin('attention')
             graph.srcdata.update({'ft': feat_src})
 
             if self._transition_matrix.startswith('gat'):
@@ -786,6 +867,7 @@ class AGDNConv(nn.Module):
                 inv_deg[torch.isinf(inv_deg)] = 0
                 a = inv_deg[graph.edges()[0]]
                 a = a.view(-1, 1, 1)
+            instrument.end()
                 
 
             # message passing
@@ -794,11 +876,14 @@ class AGDNConv(nn.Module):
             h_query = self.feat_trans(graph.dstdata['ft'], 0).unsqueeze(2)
             
             for k in range(1, self._K+1):
+                instrument.begin('hop', k)
                 graph.ndata['ft'] = self.diffusion_drop(graph.ndata['ft'])
-                graph.edata['a'] = self.attn_drop(a)
+                graph.edata['a'] = self.attn_drop(a).to(feat_src.dtype)
                 graph.update_all(fn.u_mul_e('ft', 'a', 'm'),
                                 fn.sum('m', 'ft'))
                 hstack.append(self.feat_trans(graph.dstdata['ft'], k))
+                instrument.end()
+            instrument.begin('hop_aggregation')
             hstack = torch.stack(hstack, dim=2)
             if self._weight_style in ["HC"]:
                 rst = (hstack * self.attn_drop(self.weights)).sum(dim=2)
@@ -807,7 +892,7 @@ class AGDNConv(nn.Module):
                 astack = (hstack * self.hop_attn_r.unsqueeze(2)).sum(dim=-1).unsqueeze(-1) \
                         + (h_query * self.hop_attn_l.unsqueeze(2)).sum(dim=-1).unsqueeze(-1)
                 astack = self.leaky_relu(astack) 
-                astack = F.softmax(astack, dim=2) * torch.exp(self.beta.view(1, -1, 1, 1))
+                astack = F.softmax(astack.float(), dim=2) * torch.exp(self.beta.view(1, -1, 1, 1))
                 # astack = self.attn_drop(astack)
                 if self._weight_style == "HA+HC":
                     hstack = hstack * self.weights
@@ -821,8 +906,9 @@ class AGDNConv(nn.Module):
             elif self._weight_style == "lstm":
                 alpha, _ = self.lstm(hstack.view(-1, self._K+1, self._out_feats))
                 alpha = self.att(alpha)
-                alpha = torch.softmax(alpha, dim=1)
+                alpha = torch.softmax(alpha.float(), dim=1)
                 rst = (hstack * alpha.view(-1, self._num_heads, self._K+1, 1)).sum(dim=2)
+            instrument.end()
             
             # residual
             if self.res_fc is not None:
@@ -14,9 +14,14 @@ from torch.utils.data import DataLoader
 from dgl.sampling import random_walk
 # from torch_cluster import random_walk
 import os.path as osp
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from agdn_common import instrument
+from agdn_common import precision
 from gen_model import gen_model
 from logger import Logger
 from loss import calculate_loss
+from agdn_common.memory_plan import GB, AGDNMemoryModel, optimizer_state_bytes, plan_batch_size
+from agdn_common.synthetic import SyntheticLinkPropPredDataset, split_synthetic
 from utils import (RA_AA_CN, adjust_lr, count_parameters, evaluate_hits,
                    evaluate_mrr, filter_edge, precompute_adjs, seed,
                    to_undirected)
@@ -50,6 +55,7 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, optimizer, batch
         edge_weight_margin = split_edge['train']['weight']
     else:
         edge_weight_margin = None
+    instrument.begin('sampling')
     if args.negative_sampler == 'strict_global':
         neg_train_edge = torch.randint(0, graph.number_of_nodes(), (int(1.1 * args.n_neg * pos_train_edge.size(0)),)+(2,), dtype=torch.long,
                                  device=feat.device)
@@ -70,6 +76,7 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, optimizer, batch
         neg_train_edge = torch.reshape(
                         torch.stack([neg_src, neg_dst], dim=1),
                         (-1, args.n_neg, 2))
+    instrument.end()
 
     # idx = torch.rand(pos_train_edge.shape[0]) < 0.15
     # pos_train_edge = pos_train_edge[idx, :]
@@ -80,14 +87,17 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, optimizer, batch
                            shuffle=True):
         optimizer.zero_grad()
 
-        h = model(graph, feat, edge_feat)
+        with instrument.stage('forward'):
+            h = model(graph, feat, edge_feat)
         
 
         edge = pos_train_edge[perm]
 
-        pos_out = predictor(h[edge[:, 0]], h[edge[:, 1]])
+        with instrument.stage('predictor'):
+            pos_out = predictor(h[edge[:, 0]], h[edge[:, 1]])
         # pos_loss = -torch.log(pos_out + 1e-15).mean()
 
+        instrument.begin('sampling')
         if args.negative_sampler == 'global':
             # Just do some trivial random sampling.
             neg_edge = torch.randint(0, graph.number_of_nodes(), (args.n_neg * edge.size(0),)+(2,), dtype=torch.long,
@@ -97,22 +107,27 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, optimizer, batch
         else:
             dst_neg = torch.randint(0, graph.number_of_nodes(), (args.n_neg * edge.size(0),)+(1,), dtype=torch.long, device=h.device)
             neg_edge = torch.cat([edge[:,0].repeat(args.n_neg).unsqueeze(-1), dst_neg], dim=1)
+        instrument.end()
         # edge = neg_train_edge[:, perm]
 
-        neg_out = predictor(h[neg_edge[:,0]], h[neg_edge[:,1]])
+        with instrument.stage('predictor'):
+            neg_out = predictor(h[neg_edge[:,0]], h[neg_edge[:,1]])
         # neg_loss = -torch.log(1 - neg_out + 1e-15).mean()
         # loss = pos_loss + neg_loss
         weight_margin = edge_weight_margin[perm].to(feat.device) if edge_weight_margin is not None else None
 
-        loss = calculate_loss(pos_out, neg_out, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
+        with instrument.stage('loss'):
+            loss = calculate_loss(pos_out, neg_out, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
         # cross_out = predictor(h[edge[:,0].view(-1, 1)], h[neg_edge[:,1].view(-1, args.n_neg)]) + \
         #             predictor(h[edge[:,0].view(-1, 1)], h[neg_edge[:,0].view(-1, args.n_neg)]) + \
         #             predictor(h[edge[:,1].view(-1, 1)], h[neg_edge[:,1].view(-1, args.n_neg)]) + \
         #             predictor(h[edge[:,1].view(-1, 1)], h[neg_edge[:,0].view(-1, args.n_neg)])
         # cross_loss = -torch.log(1 - cross_out.sigmoid() + 1e-15).sum()
         # loss = loss + 0.1 * cross_loss
-        loss.backward()
+        with instrument.stage('backward'):
+            loss.backward()
 
+        instrument.begin('optimizer')
         if args.clip_grad_norm > -1:
             if 'feat' not in graph.ndata:
                 torch.nn.utils.clip_grad_norm_(feat, args.clip_grad_norm)
@@ -121,6 +136,7 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, optimizer, batch
         
 
         optimizer.step()
+        instrument.end()
 
         num_examples = pos_out.size(0)
         total_loss += loss.item() * num_examples
@@ -169,11 +185,47 @@ def test(model, predictor, feat, edge_feat, graph, full_edge_feat, full_graph, s
     return results
 
 
+def plan_memory(args, model, predictor, feat, edge_feat, graph, split_edge, optimizer, parameters):
+    """Sets the batch size to the largest one whose training step fits into --memory-budget."""
+    memory_model = AGDNMemoryModel(
+        args.n_layers,
+        args.n_hidden,
+        n_heads=args.n_heads if args.model in ['gat', 'agdn'] else 1,
+        K=args.K if args.model == 'agdn' else 1,
+        weight_style=args.weight_style if args.model == 'agdn' else 'sum',
+        n_node_feats=feat.shape[1],
+        n_edge_feats=edge_feat.shape[1] if edge_feat is not None else 0,
+        value_bytes=2 if args.precision == 'bf16' else 4,
+    )
+    print(f'Planning batch size for {args.memory_budget} GB, {memory_model}')
+    n_pairs = split_edge['train']['source_node' if args.dataset == 'ogbl-citation2' else 'edge'].size(0)
+    # per positive edge and its negatives: both gathered embeddings, their product and the predictor activations
+    n_predictor_layers = args.n_layers if args.predictor == 'MLP' else 0
+    pair_values = (1 + args.n_neg) * (3 + 3 * n_predictor_layers) * args.n_hidden
+
+    def probe(batch_size):
+        # one forward / backward with random pairs, the optimizer is not stepped
+        model.train()
+        predictor.train()
+        h = model(graph, feat, edge_feat)
+        pairs = torch.randint(0, graph.number_of_nodes(), (2, (1 + args.n_neg) * batch_size), device=h.device)
+        predictor(h[pairs[0]], h[pairs[1]]).sum().backward()
+        del h, pairs
+        optimizer.zero_grad(set_to_none=True)
+
+    args.batch_size = plan_batch_size(
+        memory_model, graph.number_of_nodes(), graph.number_of_edges(), n_pairs, pair_values,
+        args.memory_budget * GB, probe, reserve=optimizer_state_bytes(parameters), cuda=feat.device.type == 'cuda')
+    print(f'Batch size: {args.batch_size}')
+
+
 def main():
     parser = argparse.ArgumentParser(description='OGBL-COLLAB (GNN)')
     parser.add_argument('--device', type=int, default=0)
     parser.add_argument('--log-steps', type=int, default=1)
-    parser.add_argument('--dataset', type=str, default='ogbl-collab')
+    parser.add_argument('--dataset', type=str, default='ogbl-collab',
+                        help='synthetic-<name> generates a random graph with the same schema instead of loading the real dataset')
+    parser.add_argument('--synthetic-scale', type=float, default=1.0, help='size of the synthetic graph relative to the real one')
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--model', type=str, default='gcn', choices=['gcn', 'gat', 'sage', 'agdn', 'memagdn'])
     parser.add_argument('--clip-grad-norm', type=float, default=1)
@@ -205,6 +257,7 @@ def main():
     parser.add_argument('--output-bn', action='store_true')
     parser.add_argument('--residual', action='store_true')
     parser.add_argument('--no-dst-attn', action='store_true')
+    parser.add_argument('--sage-aggregator', type=str, default='mean', choices=['mean', 'gcn', 'pool', 'lstm'])
     
     parser.add_argument('--advanced-optimizer', action='store_true')
     parser.add_argument('--batch-size', type=int, default=64 * 1024)
@@ -228,13 +281,31 @@ def main():
     parser.add_argument('--n-extra-edges', type=int, default=200000)
     parser.add_argument('--heuristic-method', type=str, default='CN')
     parser.add_argument('--extra-training-edges', action='store_true')
+    parser.add_argument('--memory-budget', type=float, default=0,
+                        help='device memory in GB; if > 0, pick the largest training batch size that fits with a probe step at startup')
+    parser.add_argument('--legacy-agdn', action='store_true',
+                        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    parser.add_argument('--precision', type=str, default='fp32', choices=precision.PRECISIONS,
+                        help='bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32')
+    parser.add_argument('--trace', type=str, default='', help='write per-epoch time and memory of the training stages to this JSONL file')
+    parser.add_argument('--chrome-trace', type=str, default='', help='with --trace, also dump every stage in Chrome trace format here')
     args = parser.parse_args()
+    # the rest of the script only sees the real dataset name
+    args.dataset, args.synthetic = split_synthetic(args.dataset)
     print(args)
+    assert args.precision == 'fp32' or args.model == 'agdn', '--precision bf16 is implemented for AGDN'
+    assert args.legacy_agdn or args.weight_style != 'lstm', 'the lstm hop weighting needs --legacy-agdn'
 
     device = f'cuda:{args.device}' if args.device > -1 else 'cpu'
     device = torch.device(device)
+    assert precision.supported(args.precision, device), '--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels'
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda=device.type == 'cuda')
 
-    dataset = DglLinkPropPredDataset(name=args.dataset, root='/mnt/ssd/ssd/dataset')
+    if args.synthetic:
+        dataset = SyntheticLinkPropPredDataset(args.dataset, scale=args.synthetic_scale)
+    else:
+        dataset = DglLinkPropPredDataset(name=args.dataset, root='/mnt/ssd/ssd/dataset')
     graph = dataset[0]
 
     if args.dataset in ['ogbl-citation2']:
@@ -326,7 +397,9 @@ def main():
         method_dict = {'RA':0, 'AA':1, 'CN':2}
         target_idx = method_dict[args.heuristic_method]
         target_size = args.n_extra_edges
-        if not osp.exists(f'../extra_edges/{args.dataset}.pt'):
+        # synthetic graphs get their own cache, it depends on --synthetic-scale too
+        extra_edges_path = f'../extra_edges/{args.dataset}.pt' if not args.synthetic else f'../extra_edges/synthetic-{args.dataset}-{args.synthetic_scale}.pt'
+        if not osp.exists(extra_edges_path):
             A2 = A @ A
             A2[A > 0] = 0
             row, col = A2.nonzero()
@@ -342,9 +415,9 @@ def main():
 
             extra_scores = RA_AA_CN(adjs, extra_edges.t())
             
-            torch.save([extra_edges, extra_scores], f'../extra_edges/{args.dataset}.pt')
+            torch.save([extra_edges, extra_scores], extra_edges_path)
         else:
-            extra_edges, extra_scores = torch.load(f'../extra_edges/{args.dataset}.pt')
+            extra_edges, extra_scores = torch.load(extra_edges_path)
         _, idx = torch.sort(extra_scores[:, target_idx], descending=True)
         extra_edges = extra_edges[idx]
         extra_edges = extra_edges[:target_size]
@@ -373,8 +446,11 @@ def main():
                        shape=(full_graph.number_of_nodes(), full_graph.number_of_nodes()))
     full_adjs = precompute_adjs(full_A)
 
-    graph = graph.to(device)
-    full_graph = full_graph.to(device)
+    with instrument.stage('h2d'):
+        graph = graph.to(device)
+        full_graph = full_graph.to(device)
+    # setup stages go to an epoch 0 record
+    instrument.epoch_end(0)
 
     has_node_attr = 'feat' in graph.ndata
     if has_node_attr and (not args.use_emb) and (not args.no_node_feat):
@@ -461,6 +537,10 @@ def main():
                 parameters,
                 lr=args.lr)
 
+        # plan once per process, the batch size is reused by later runs
+        if args.memory_budget > 0 and run == 0:
+            plan_memory(args, model, predictor, feat, full_edge_feat, full_graph, split_edge, optimizer, parameters)
+
         best_val = {}
         best_test = {}
         for epoch in range(1, 1 + args.epochs):
@@ -493,8 +573,9 @@ def main():
             t2 = time.time()
             if epoch % args.eval_steps == 0:
                 
-                results = test(model, predictor, feat, edge_feat, graph, full_edge_feat, full_graph, split_edge, evaluator,
-                               args.batch_size, args)
+                with instrument.stage('evaluation'):
+                    results = test(model, predictor, feat, edge_feat, graph, full_edge_feat, full_graph, split_edge, evaluator,
+                                   args.batch_size, args)
                 t3 = time.time()
                 for key, result in results.items():
                     loggers[key].add_result(run, result)
@@ -519,11 +600,14 @@ def main():
                     print(f'---Loss: {loss:.4f}---Train time: {(t2-t1):.4f}---Test time: {(t3-t2):.4f}---')
             if args.adjust_lr:
                 adjust_lr(optimizer, epoch / args.epochs, args.lr)
+            instrument.epoch_end(epoch, run=run + 1, epoch_time=t2 - t1)
 
         for key in loggers.keys():
             print(key)
             loggers[key].print_statistics(run)
 
+    instrument.close()
+
     for key in loggers.keys():
         print(key)
         loggers[key].print_statistics()
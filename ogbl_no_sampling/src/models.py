@@ -70,27 +70,27 @@ class GCN(Module):
 
 class SAGE(torch.nn.Module):
     def __init__(self, in_feats, n_hidden, out_feats, n_layers,
-                 dropout, input_drop, edge_feats=0, bn=True, residual=True):
+                 dropout, input_drop, edge_feats=0, bn=True, residual=True, aggregator_type='mean'):
         super(SAGE, self).__init__()
         self.residual = residual
         self.input_drop = input_drop
         self.convs = torch.nn.ModuleList()
         if n_layers == 1:
-            self.convs.append(SAGEConv(in_feats, out_feats, 'mean'))
+            self.convs.append(SAGEConv(in_feats, out_feats, aggregator_type))
             self.norms = None
         else:
-            self.convs.append(SAGEConv(in_feats, n_hidden, 'mean'))
+            self.convs.append(SAGEConv(in_feats, n_hidden, aggregator_type))
             if bn:
                 self.norms = torch.nn.ModuleList()
                 self.norms.append(BatchNorm1d(n_hidden))
             else:
                 self.norms = None
         for _ in range(n_layers - 2):
-            self.convs.append(SAGEConv(n_hidden, n_hidden, 'mean'))
+            self.convs.append(SAGEConv(n_hidden, n_hidden, aggregator_type))
             if bn:
                 self.norms.append(BatchNorm1d(n_hidden))
         if n_layers > 1:
-            self.convs.append(SAGEConv(n_hidden, out_feats, 'mean'))
+            self.convs.append(SAGEConv(n_hidden, out_feats, aggregator_type))
 
         self.dropout = dropout
         self.reset_parameters()
@@ -0,0 +1,158 @@
+import math
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from agdn_common import distributed
+
+
+class EmbeddingStore(object):
+    """Learnable n_rows x dim node embeddings outside of the model, with a pull / push (parameter server) API.
+
+    The rows are split into contiguous ranges, one per distributed worker (a single one without a process group),
+    and every worker's range into n_shards shards. A shard holds the values and both Adam moments, in memory or,
+    with path, in memory-mapped files path/<name>_<first row>.dat. Nothing of the table lives on the training
+    device: a step pulls the rows of its input nodes and pushes their gradients back, which updates those rows
+    only (like torch.optim.SparseAdam).
+
+        x = store.pull(input_nodes)                 # (len(input_nodes), dim) leaf on device
+        ... loss.backward()
+        store.push(input_nodes, x.grad, weight, lr=optimizer.param_groups[0]["lr"])
+
+    In distributed mode pull and push are collectives (all workers call them equally often): requested ids and
+    pushed gradients are all-gathered and every worker serves / updates the rows of its own range.
+    """
+
+    def __init__(self, n_rows, dim, n_shards=1, path=None, lr=0.001, betas=(0.9, 0.999), eps=1e-8, device="cpu"):
+        self.n_rows = n_rows
+        self.dim = dim
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.device = device
+        self.n_steps = 0
+
+        self.rows_per_worker = max((n_rows + distributed.world_size() - 1) // distributed.world_size(), 1)
+        self.start = min(distributed.rank() * self.rows_per_worker, n_rows)
+        self.end = min(self.start + self.rows_per_worker, n_rows)
+        self.shard_size = max((self.end - self.start + n_shards - 1) // n_shards, 1)
+        # (weight, exp_avg, exp_avg_sq) of every shard
+        self.shards = []
+        for shard_start in range(self.start, self.end, self.shard_size):
+            shape = (min(self.shard_size, self.end - shard_start), dim)
+            self.shards.append(tuple(self._buffer(path, f"{name}_{shard_start}", shape) for name in ["weight", "exp_avg", "exp_avg_sq"]))
+
+    def _buffer(self, path, name, shape):
+        if not path:
+            return torch.zeros(shape)
+        os.makedirs(path, exist_ok=True)
+        array = np.memmap(os.path.join(path, f"{name}.dat"), dtype=np.float32, mode="w+", shape=shape)
+        return torch.from_numpy(array)
+
+    def __repr__(self):
+        return f"EmbeddingStore({self.n_rows}, {self.dim}, rows {self.start}-{self.end} in {len(self.shards)} shards)"
+
+    def numel(self):
+        return self.n_rows * self.dim
+
+    def reset_parameters(self):
+        # xavier_uniform_ of the whole table, as for torch.nn.Embedding in the mains. Every worker draws the values of
+        # the full table, in row order, from one generator seeded from the global RNG (seeded equally on all workers)
+        # and keeps those of its range, so that the rows do not repeat across workers and the initialization does not
+        # depend on the number of workers or shards.
+        bound = math.sqrt(6.0 / (self.n_rows + self.dim))
+        generator = torch.Generator().manual_seed(int(torch.randint(0, 2 ** 62, (1,))))
+        for skip in range(0, self.start, self.shard_size):
+            torch.empty(min(self.shard_size, self.start - skip), self.dim).uniform_(-bound, bound, generator=generator)
+        for weight, exp_avg, exp_avg_sq in self.shards:
+            weight.uniform_(-bound, bound, generator=generator)
+            exp_avg.zero_()
+            exp_avg_sq.zero_()
+        self.n_steps = 0
+
+    def _locate(self, index):
+        # shard and row within it of ids of this worker's range
+        local = index - self.start
+        return local // self.shard_size, local % self.shard_size
+
+    def _owned(self, index):
+        return (index >= self.start) & (index < self.end)
+
+    def _read(self, index):
+        rows = torch.zeros(len(index), self.dim)
+        shard, row = self._locate(index)
+        for i, (weight, _, _) in enumerate(self.shards):
+            mask = shard == i
+            if mask.any():
+                rows[mask] = weight[row[mask]]
+        return rows
+
+    def _update(self, index, grad, lr):
+        # Adam on distinct rows index only, the bias correction uses the global step count
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.n_steps
+        bias_correction2 = 1 - beta2 ** self.n_steps
+        shard, row = self._locate(index)
+        for i, (weight, exp_avg, exp_avg_sq) in enumerate(self.shards):
+            mask = shard == i
+            if not mask.any():
+                continue
+            r, g = row[mask], grad[mask]
+            m = exp_avg[r].mul_(beta1).add_(g, alpha=1 - beta1)
+            v = exp_avg_sq[r].mul_(beta2).addcmul_(g, g, value=1 - beta2)
+            exp_avg[r] = m
+            exp_avg_sq[r] = v
+            weight[r] -= lr * (m / bias_correction1) / ((v / bias_correction2).sqrt() + self.eps)
+
+    def read(self, index):
+        """Rows index (repeats allowed) as a CPU tensor, without gradient."""
+        index = index.cpu().long()
+        unique, inverse = torch.unique(index, return_inverse=True)
+        if not distributed.enabled():
+            return self._read(unique)[inverse]
+
+        requests = distributed.all_gather_rows(unique)
+        offset = sum(len(r) for r in requests[: distributed.rank()])
+        requests = torch.cat(requests)
+        # every worker fills in the rows it owns, the sum has them all
+        rows = torch.zeros(len(requests), self.dim)
+        owned = self._owned(requests)
+        rows[owned] = self._read(requests[owned])
+        dist.all_reduce(rows)
+        return rows[offset : offset + len(unique)][inverse]
+
+    def read_all(self):
+        """The whole table as one CPU tensor, e.g. for full-graph evaluation (a collective in distributed mode)."""
+        local = torch.cat([weight for weight, _, _ in self.shards]) if self.shards else torch.zeros(0, self.dim)
+        return torch.cat(distributed.all_gather_rows(local))
+
+    def pull(self, index):
+        """Rows index as a leaf on the store's device that requires grad; push its .grad back after backward."""
+        return self.read(index).to(self.device).requires_grad_()
+
+    def push(self, index, grad, weight=1, lr=None):
+        """Applies grad, the gradient of the pulled rows index, with one sparse Adam step.
+
+        weight is this worker's share of the step (as for distributed.all_reduce_gradients): the update uses the
+        weighted average of all workers' gradients. Rows pulled several times, here or on other workers, get the
+        sum of their gradients. lr overrides the store's learning rate for this step, e.g. to follow the model
+        optimizer's lr scheduler.
+        """
+        index = index.cpu().long()
+        unique, inverse = torch.unique(index, return_inverse=True)
+        if grad is None or weight <= 0:
+            unique, grad, weight = unique[:0], torch.zeros(0, self.dim), 0
+        else:
+            grad = torch.zeros(len(unique), self.dim).index_add_(0, inverse, grad.detach().cpu().float()) * weight
+
+        index = torch.cat(distributed.all_gather_rows(unique))
+        grad = torch.cat(distributed.all_gather_rows(grad))
+        (total,) = distributed.all_reduce_sum(weight)
+        owned = self._owned(index)
+        unique, inverse = torch.unique(index[owned], return_inverse=True)
+        grad = torch.zeros(len(unique), self.dim).index_add_(0, inverse, grad[owned]) / max(total, 1e-12)
+
+        self.n_steps += 1
+        self._update(unique, grad, self.lr if lr is None else lr)
@@ -1,3 +1,5 @@
+from agdn_common import agdn_ops
+from agdn_common import precision
 from models import GCN, GAT, SAGE, AGDN, DotPredictor, LinkPredictor
 
 def gen_model(args, in_feats, in_edge_feats, device):
@@ -26,6 +28,10 @@ def gen_model(args, in_feats, in_edge_feats, device):
                      pos_emb=not args.no_pos_emb,
                      in_edge_feats=in_edge_feats, 
                      residual=args.residual).to(device)
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
 
     n_heads = args.n_heads if args.model in ['gat', 'agdn'] else 1
     # predictor = DotPredictor(args.n_hidden * n_heads, args.n_hidden * n_heads, 1,
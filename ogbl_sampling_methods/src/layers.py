@@ -12,11 +12,13 @@ import torch as th
 from torch import nn
 
 from dgl import function as fn
-from dgl.nn.functional import edge_softmax
 from dgl.base import DGLError
 from dgl.nn.pytorch.utils import Identity
 from dgl.utils import expand_as_pair
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
 # pylint: enable=W0235
 class GATConv(nn.Module):
     def __init__(self,
@@ -402,6 +404,7 @@ class AGDNConv(nn.Module):
                 if graph.is_block:
                     feat_dst = feat_src[:graph.number_of_dst_nodes()]
 
+            instrument.begin('attention')
             el = (feat_src * self.attn_l).sum(dim=-1).unsqueeze(-1)
             er = (feat_dst * self.attn_r).sum(dim=-1).unsqueeze(-1)
             graph.srcdata.update({'ft': feat_src, 'el': el})
@@ -413,15 +416,19 @@ class AGDNConv(nn.Module):
             e = self.leaky_relu(graph.edata.pop('e'))
             # compute softmax
             graph.edata['a'] = self.attn_drop(torch.sqrt(edge_softmax(graph, e, norm_by='dst').clamp(min=1e-9) \
-                                                       * edge_softmax(graph, e, norm_by='src').clamp(min=1e-9)))
+                                                       * edge_softmax(graph, e, norm_by='src').clamp(min=1e-9))).to(feat_src.dtype)
+            instrument.end()
             # message passing
             hstack = []
             h_query = self.feat_trans(graph.dstdata['ft'], 0).unsqueeze(2)
             for k in range(1, self._K+1):
+                instrument.begin('hop', k)
                 # graph.ndata['ft'] = F.dropout(graph.ndata['ft'], 0.1, training=self.training)
                 graph.update_all(fn.u_mul_e('ft', 'a', 'm'),
                                 fn.sum('m', 'ft'))
                 hstack.append(self.feat_trans(graph.dstdata['ft'], k))
+                instrument.end()
+            instrument.begin('hop_aggregation')
             hstack = torch.stack(hstack, dim=2)
             if self._weight_style == "HC":
                 rst = (hstack * self.weights).sum(dim=2)
@@ -430,9 +437,10 @@ class AGDNConv(nn.Module):
                         + (h_query * self.hop_attn_l.unsqueeze(2)).sum(dim=-1).unsqueeze(-1)
                 astack = self.leaky_relu(astack)
                 # astack = F.relu(astack)
-                astack = F.softmax(astack, dim=2)
+                astack = F.softmax(astack.float(), dim=2)
                 astack = self.attn_drop(astack)
                 rst = (hstack * astack).sum(dim=2)
+            instrument.end()
 
             # residual
             if self.res_fc is not None:
@@ -19,9 +19,16 @@ from ogb.linkproppred import DglLinkPropPredDataset, Evaluator
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from agdn_common import distributed
+from agdn_common import instrument
+from agdn_common import precision
+from embedding_store import EmbeddingStore
 from gen_model import gen_model
 from logger import Logger
 from loss import calculate_loss
+from agdn_common.pipeline import Prefetcher, pop_stats
+from agdn_common.synthetic import SyntheticLinkPropPredDataset, split_synthetic
 from utils import RA_AA_CN, evaluate_hits, evaluate_mrr, precompute_adjs, seed, count_parameters, process_collab
 
 
@@ -38,7 +45,16 @@ def compute_pred(h, predictor, edges, batch_size, device):
     pred = torch.cat(preds, dim=0)
     return pred
 
-def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, optimizer, batch_size, device, args):
+def sync_gradients(model, predictor, emb, input_nodes, weight):
+    # dense all-reduce for the GNN and the predictor; of the embedding table only the rows of the input nodes
+    # have gradients, so only those are exchanged
+    distributed.all_reduce_gradients(list(model.parameters()) + list(predictor.parameters()), weight)
+    # an EmbeddingStore exchanges its rows itself, on push
+    if emb is not None and not isinstance(emb, EmbeddingStore):
+        distributed.all_reduce_rows(emb.weight, input_nodes, weight)
+
+
+def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, optimizer, batch_size, device, args, emb=None):
     model.train()
     predictor.train()
 
@@ -50,37 +66,65 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, opti
     total_loss = total_examples = 0
     
     if args.sampler in ['neighborsampler', 'shadow']:
-        for i, (input_nodes, pos_graph, neg_graph, mfgs) in enumerate(dataloader):
+
+        def prepare(batch):
+            input_nodes, pos_graph, neg_graph, mfgs = batch
             if not isinstance(mfgs, list):
                 mfgs = mfgs.to(device)
             else:
                 mfgs = [mfg.to(device) for mfg in mfgs]
             pos_graph = pos_graph.to(device)
             neg_graph = neg_graph.to(device)
+            # static node features only: the rows of an EmbeddingStore are pulled in the loop (pull is a collective)
+            # and those of an nn.Embedding, which feat then holds, read there after the previous optimizer step
+            inputs = feat[input_nodes].to(device) if feat is not None and not embedding_feat else None
+            return input_nodes, pos_graph, neg_graph, mfgs, inputs
+
+        embedding_feat = isinstance(emb, torch.nn.Embedding)
+        for i, (input_nodes, pos_graph, neg_graph, mfgs, inputs) in enumerate(Prefetcher(dataloader, prepare, args.prefetch_depth)):
             pos_edge_src, pos_edge_dst = pos_graph.edges()
             neg_edge_src, neg_edge_dst = neg_graph.edges()
-            inputs = feat[input_nodes].to(device)
+            if embedding_feat:
+                inputs = feat[input_nodes].to(device)
+            elif isinstance(emb, EmbeddingStore):
+                # only the batch's rows of the table, next to their node features if any
+                with instrument.stage('pull'):
+                    emb_inputs = emb.pull(input_nodes)
+                inputs = emb_inputs if inputs is None else torch.cat([inputs, emb_inputs], dim=-1)
+
+            with instrument.stage('forward'):
+                outputs = model(mfgs, inputs)
 
-            pos_score = predictor(outputs[pos_edge_src], outputs[pos_edge_dst])
-            neg_score = predictor(outputs[neg_edge_src], outputs[neg_edge_dst])
+            with instrument.stage('predictor'):
+                pos_score = predictor(outputs[pos_edge_src], outputs[pos_edge_dst])
+                neg_score = predictor(outputs[neg_edge_src], outputs[neg_edge_dst])
 
-            outputs = model(mfgs, inputs)
             if 'weight' in pos_graph.edata:
                 weight_margin = pos_graph.edata['weight']
             else:
                 weight_margin = None
 
-            loss = calculate_loss(pos_score, neg_score, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
+            with instrument.stage('loss'):
+                loss = calculate_loss(pos_score, neg_score, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
             # score = torch.cat([pos_score, neg_score])
             # label = torch.cat([torch.ones_like(pos_score), torch.zeros_like(neg_score)])
             # loss = F.binary_cross_entropy_with_logits(score, label)
 
             optimizer.zero_grad()
-            loss.backward()
+            with instrument.stage('backward'):
+                loss.backward()
+            if distributed.enabled():
+                with instrument.stage('all_reduce'):
+                    sync_gradients(model, predictor, emb, input_nodes, pos_score.size(0))
+            instrument.begin('optimizer')
             if args.clip_grad_norm > 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
                 torch.nn.utils.clip_grad_norm_(predictor.parameters(), args.clip_grad_norm)
             optimizer.step()
+            if isinstance(emb, EmbeddingStore):
+                # at the optimizer's current lr, which ReduceLROnPlateau lowers
+                emb.push(input_nodes, emb_inputs.grad, pos_score.size(0), lr=optimizer.param_groups[0]['lr'])
+            instrument.end()
 
             num_examples = pos_score.size(0)
             total_loss += loss.item() * num_examples
@@ -92,18 +136,20 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, opti
                 break
     
     if args.sampler in ['clustergcn', 'saint_node', 'saint_edge', 'saint_rw']:
-        for subgraph in dataloader:
-            subgraph = subgraph.to(device)
+        for subgraph in Prefetcher(dataloader, lambda subgraph: subgraph.to(device), args.prefetch_depth):
             optimizer.zero_grad()
-            h = model(subgraph, subgraph.ndata['feat'])
+            with instrument.stage('forward'):
+                h = model(subgraph, subgraph.ndata['feat'])
 
             src, dst = subgraph.edges()
             # mask = src != dst
             # src, dst = src[mask], dst[mask]
-            pos_out = predictor(h[src], h[dst])
+            with instrument.stage('predictor'):
+                pos_out = predictor(h[src], h[dst])
             # pos_loss = -torch.log(pos_out + 1e-15).mean()
 
             # Just do some trivial random sampling.
+            instrument.begin('sampling')
             if args.negative_sampler == 'global':
                 src_neg = torch.randint(0, subgraph.number_of_nodes(), (args.n_neg * src.size(0),) + src.size()[1:],
                                     dtype=torch.long, device=device)
@@ -112,7 +158,9 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, opti
 
             dst_neg = torch.randint(0, subgraph.number_of_nodes(), (args.n_neg * src.size(0),) + src.size()[1:],
                                     dtype=torch.long, device=device)
-            neg_out = predictor(h[src_neg], h[dst_neg])
+            instrument.end()
+            with instrument.stage('predictor'):
+                neg_out = predictor(h[src_neg], h[dst_neg])
             # neg_loss = -torch.log(1 - neg_out + 1e-15).mean()
 
             # loss = pos_loss + neg_loss
@@ -121,18 +169,25 @@ def train(model, predictor, feat, edge_feat, graph, split_edge, dataloader, opti
             else:
                 weight_margin = None
 
-            loss = calculate_loss(pos_out, neg_out, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
-            loss.backward()
+            with instrument.stage('loss'):
+                loss = calculate_loss(pos_out, neg_out, args.n_neg, margin=weight_margin, loss_func_name=args.loss_func)
+            with instrument.stage('backward'):
+                loss.backward()
+            if distributed.enabled():
+                with instrument.stage('all_reduce'):
+                    sync_gradients(model, predictor, emb, subgraph.ndata[dgl.NID], src.size(0))
+            instrument.begin('optimizer')
             if args.clip_grad_norm > 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
                 torch.nn.utils.clip_grad_norm_(predictor.parameters(), args.clip_grad_norm)
             optimizer.step()
+            instrument.end()
 
             num_examples = src.size(0)
             total_loss += loss.item() * num_examples
             total_examples += num_examples
 
-
+    total_loss, total_examples = distributed.all_reduce_sum(total_loss, total_examples)
     return total_loss / total_examples
 
 
@@ -207,13 +262,19 @@ def main():
     parser.add_argument('--device', type=int, default=0)
     parser.add_argument('--eval-device', type=int, default=-1)
     parser.add_argument('--log-steps', type=int, default=1)
-    parser.add_argument('--dataset', type=str, default='ogbl-citation2')
+    parser.add_argument('--dataset', type=str, default='ogbl-citation2',
+                        help='synthetic-<name> generates a random graph with the same schema instead of loading the real dataset')
+    parser.add_argument('--synthetic-scale', type=float, default=1.0, help='size of the synthetic graph relative to the real one')
     parser.add_argument('--eval-metric', type=str, default='mrr')
     parser.add_argument('--use-valedges-as-input', action='store_true',
                         help='This option can only be used for ogbl-collab')
     parser.add_argument('--year', type=int, default=0)
     parser.add_argument('--no-node-feat', action='store_true')
     parser.add_argument('--use-emb', action='store_true')
+    parser.add_argument('--emb-store-shards', type=int, default=0,
+                        help='if > 0, keep the learnable embeddings in an EmbeddingStore with this many shards (per worker) instead of a torch.nn.Embedding on the device')
+    parser.add_argument('--emb-store-path', type=str, default='',
+                        help='with --emb-store-shards, memory-map the shards (values and Adam moments) to files in this directory')
     parser.add_argument('--loss-func', type=str, default='CE')
 
     parser.add_argument('--seed', type=int, default=0)
@@ -256,24 +317,48 @@ def main():
     parser.add_argument('--K', type=int, default=3)
     parser.add_argument('--no-pos-emb', action='store_true')
     parser.add_argument('--weight-style', type=str, default='HA', choices=['HC', 'HA'])
+    parser.add_argument('--dist-procs', type=int, default=0,
+                        help='if > 0, train data-parallel in this many CPU worker processes on this host (gloo), each on a shard of the training edges')
+    parser.add_argument('--dist-hosts', type=int, default=1, help='number of hosts taking part, each runs this script with --dist-procs')
+    parser.add_argument('--dist-host-rank', type=int, default=0, help='rank of this host among --dist-hosts')
+    parser.add_argument('--dist-init-method', type=str, default='tcp://127.0.0.1:29500',
+                        help='torch.distributed init method, the address of host 0 when there are several hosts')
+    parser.add_argument('--prefetch-depth', type=int, default=0,
+                        help='if > 0, prepare this many training batches (feature gathering, device placement) ahead in a background thread')
+    parser.add_argument('--legacy-agdn', action='store_true',
+                        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    parser.add_argument('--precision', type=str, default='fp32', choices=precision.PRECISIONS,
+                        help='bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32')
+    parser.add_argument('--trace', type=str, default='', help='write per-epoch time and memory of the training stages to this JSONL file')
+    parser.add_argument('--chrome-trace', type=str, default='', help='with --trace, also dump every stage in Chrome trace format here')
     
     
     args = parser.parse_args()
+    # the rest of the script only sees the real dataset name
+    args.dataset, args.synthetic = split_synthetic(args.dataset)
     print(args)
+    assert args.precision == 'fp32' or args.model == 'agdn', '--precision bf16 is implemented for AGDN'
+    assert args.dist_procs <= 0 or args.device < 0, 'distributed training runs on CPU'
+    assert args.emb_store_shards <= 0 or args.sampler in ['neighborsampler', 'shadow'], 'the embedding store serves input_nodes of neighbor / ShaDow batches'
 
     device = f'cuda:{args.device}' if args.device > -1 else 'cpu'
     device = torch.device(device)
     eval_device = f'cuda:{args.eval_device}' if args.eval_device > -1 else 'cpu'
     eval_device = torch.device(eval_device)
+    assert all(precision.supported(args.precision, d) for d in [device, eval_device]), '--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels'
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda='cuda' in (device.type, eval_device.type))
 
-    dataset = DglLinkPropPredDataset(name=args.dataset, root='/mnt/ssd/ssd/dataset')
+    if args.synthetic:
+        dataset = SyntheticLinkPropPredDataset(args.dataset, scale=args.synthetic_scale)
+    else:
+        dataset = DglLinkPropPredDataset(name=args.dataset, root='/mnt/ssd/ssd/dataset')
     graph = dataset[0]
     if args.dataset in ['ogbl-citation2', 'ogbl-ppa']:
         graph = dgl.to_bidirected(graph, copy_ndata=True)
         graph = dgl.add_self_loop(graph)
     print(graph)
     # graph.edata['year'] = (graph.edata['year'] - 1950) / 100
-    has_edge_attr = 'weight' in graph.edata.keys()
     # if has_edge_attr:
     #     train_feat = []
     #     for k, v in graph.edata.items():
@@ -304,6 +389,29 @@ def main():
 
     # graph = graph.to(device)
 
+    if args.dist_procs > 0:
+        # the coordinator worker traces to the same file again, without the setup record
+        instrument.close()
+        distributed.launch(
+            run_worker,
+            (args, distributed.share_graph(graph), split_edge, device, eval_device),
+            args.dist_procs,
+            n_hosts=args.dist_hosts,
+            host_rank=args.dist_host_rank,
+            init_method=args.dist_init_method,
+        )
+    else:
+        run_all(args, graph, split_edge, device, eval_device)
+
+
+def run_worker(args, graph, split_edge, device, eval_device):
+    if args.trace and distributed.is_coordinator():
+        instrument.enable(args.trace, args.chrome_trace or None)
+    run_all(args, graph, split_edge, device, eval_device)
+
+
+def run_all(args, graph, split_edge, device, eval_device):
+    has_edge_attr = 'weight' in graph.edata.keys()
     has_node_attr = 'feat' in graph.ndata
     if has_node_attr and (not args.use_emb) and (not args.no_node_feat):
         emb = None
@@ -311,13 +419,22 @@ def main():
     else:
         # Use learnable embedding if node attributes are not available
         n_heads = args.n_heads if args.model in ['gat', 'agdn'] else 1
-        emb = torch.nn.Embedding(graph.number_of_nodes(), args.n_hidden).to(device)
-        if not has_node_attr or args.no_node_feat:
-            feat = emb.weight
+        if args.emb_store_shards > 0:
+            # the input rows are assembled per batch, feat only holds the node features (if any)
+            emb = EmbeddingStore(graph.number_of_nodes(), args.n_hidden, n_shards=args.emb_store_shards,
+                                 path=args.emb_store_path or None, lr=args.lr, device=device)
+            feat = graph.ndata['feat'].float() if has_node_attr and not args.no_node_feat else None
         else:
-            feat = torch.cat([graph.ndata['feat'].float(), emb.weight], dim=-1)
+            emb = torch.nn.Embedding(graph.number_of_nodes(), args.n_hidden).to(device)
+            if not has_node_attr or args.no_node_feat:
+                feat = emb.weight
+            else:
+                feat = torch.cat([graph.ndata['feat'].float(), emb.weight], dim=-1)
 
-    in_feats = feat.shape[1]
+    if isinstance(emb, EmbeddingStore):
+        in_feats = (feat.shape[1] if feat is not None else 0) + args.n_hidden
+    else:
+        in_feats = feat.shape[1]
 
     if has_edge_attr:
         edge_feat = graph.edata['weight']
@@ -339,7 +456,7 @@ def main():
         train_dataloader = dgl.dataloading.DataLoader(
             # The following arguments are specific to NodeDataLoader.
             graph,                                  # The graph
-            torch.arange(graph.number_of_edges()),  # The edges to iterate over
+            distributed.shard(torch.arange(graph.number_of_edges())),  # The edges to iterate over
             train_sampler,                                # The neighbor sampler
             # The following arguments are inherited from PyTorch DataLoader.
             batch_size=args.batch_size,    # Batch size
@@ -363,7 +480,7 @@ def main():
         train_sampler = dgl.dataloading.as_edge_prediction_sampler(
             train_sampler, negative_sampler=negative_sampler)
         train_dataloader = dgl.dataloading.DataLoader(
-            graph, graph.edges(form='eid'), train_sampler,
+            graph, distributed.shard(graph.edges(form='eid')), train_sampler,
             batch_size=args.batch_size,
             shuffle=True,
             drop_last=False,
@@ -377,9 +494,14 @@ def main():
             num_workers=args.n_workers)
     
     if args.sampler in ['clustergcn']:
+        # METIS runs once, on the coordinator; the other workers load the partitioning it caches
+        if not distributed.is_coordinator():
+            distributed.barrier()
         train_sampler = ClusterGCNSampler(graph, args.n_clusters)
+        if distributed.is_coordinator():
+            distributed.barrier()
         train_dataloader = dgl.dataloading.DataLoader(
-            graph, torch.arange(args.n_subgraphs), train_sampler,
+            graph, distributed.shard(torch.arange(args.n_subgraphs)), train_sampler,
             batch_size=args.batch_size,
             shuffle=True,
             drop_last=False,
@@ -404,7 +526,7 @@ def main():
             budget = args.rw_budget
         train_sampler = SAINTSampler(mode, budget)
         train_dataloader = dgl.dataloading.DataLoader(
-            graph, torch.arange(args.n_subgraphs), train_sampler,
+            graph, distributed.shard(torch.arange(args.n_subgraphs)), train_sampler,
             batch_size=args.batch_size,
             shuffle=True,
             drop_last=False,
@@ -433,13 +555,20 @@ def main():
         seed(args.seed + run)
         model, predictor = gen_model(args, in_feats, in_edge_feats, device)
         parameters = list(model.parameters()) + list(predictor.parameters())
-        if emb is not None:
+        if isinstance(emb, EmbeddingStore):
+            # updated by the store on push, not by the optimizer
+            emb.reset_parameters()
+            num_param = count_parameters(model) + count_parameters(predictor) + emb.numel()
+        elif emb is not None:
             parameters = parameters + list(emb.parameters())
             torch.nn.init.xavier_uniform_(emb.weight)
             num_param = count_parameters(model) + count_parameters(predictor) + count_parameters(emb)
         else:
             num_param = count_parameters(model) + count_parameters(predictor)
         print(f'Number of parameters: {num_param}')
+        for module in [model, predictor, emb]:
+            if module is not None and not isinstance(module, EmbeddingStore):
+                distributed.broadcast_parameters(module)
         # optimizer = torch.optim.Adam(
         #     parameters,
         #     lr=args.lr)
@@ -450,18 +579,28 @@ def main():
         for epoch in range(1, 1 + args.epochs):
             t1 = time.time()
             loss = train(model, predictor, feat, edge_feat, graph, split_edge, train_dataloader, optimizer,
-                         args.batch_size, device, args)
+                         args.batch_size, device, args, emb=emb)
             lr_scheduler.step(loss)
             t2 = time.time()
+            stall_time, _ = pop_stats()
             print(f'Run: {run + 1:02d}, '
                   f'Epoch: {epoch:02d}, '
                   f'Loss: {loss:.4f}, '
-                  f'Time: {t2-t1:.4f}')
+                  f'Time: {t2-t1:.4f}, '
+                  f'Batch stall: {stall_time:.4f}')
             
-            if epoch >= args.eval_from and (epoch % args.eval_steps == 0):
+            evaluate = epoch >= args.eval_from and (epoch % args.eval_steps == 0)
+            if evaluate and isinstance(emb, EmbeddingStore):
+                # full-graph evaluation needs the whole table; all workers take part in gathering it
+                eval_feat = emb.read_all() if feat is None else torch.cat([feat, emb.read_all()], dim=-1)
+            else:
+                eval_feat = feat
+            # in distributed mode the models are identical and only the coordinator evaluates
+            if evaluate and distributed.is_coordinator():
                 
-                results = test(model, predictor, feat, edge_feat, graph, split_edge, eval_dataloader, evaluator,
-                               args.eval_batch_size, device, eval_device, args)
+                with instrument.stage('evaluation'):
+                    results = test(model, predictor, eval_feat, edge_feat, graph, split_edge, eval_dataloader, evaluator,
+                                   args.eval_batch_size, device, eval_device, args)
                 t3 = time.time()
                 for key, result in results.items():
                     loggers[key].add_result(run, result)
@@ -481,10 +620,16 @@ def main():
                               f'Train/Val/Test: {train_scores:.4f}/{valid_scores:.4f}/{test_scores:.4f}, '
                               f'Best Val/Test: {best_val[key]:.4f}/{best_test[key]:.4f}')
                     print(f'---Loss: {loss:.4f}---Train time: {(t2-t1):.4f}---Test time: {(t3-t2):.4f}---')
+            instrument.epoch_end(epoch, run=run + 1, epoch_time=t2 - t1, stall_time=stall_time)
 
+        if not distributed.is_coordinator():
+            continue
         for key in loggers.keys():
             print(key)
             loggers[key].print_statistics(run)
+    instrument.close()
+    if not distributed.is_coordinator():
+        return
 
     for key in loggers.keys():
         print(key)
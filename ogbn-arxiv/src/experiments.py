@@ -8,11 +8,13 @@ from numpy.lib.function_base import append
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+import common_path  # noqa: F401, puts agdn_common on sys.path
 from gen_model import gen_model
 from tqdm import tqdm
 from dgl.nn.pytorch.conv import SGConv
 from models import AGDNConv
 from ogb.nodeproppred import DglNodePropPredDataset
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
 from sklearn.metrics import accuracy_score
 import time
 from utils import seed, compute_norm
@@ -220,15 +222,20 @@ def define_args():
     parser.add_argument('--residual', action='store_true')
     parser.add_argument('--eval-steps', type=int, default=1)
     parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--dataset', type=str, default='ogbn-arxiv', choices=['ogbn-arxiv', 'synthetic-ogbn-arxiv'])
+    parser.add_argument('--synthetic-scale', type=float, default=1.0, help='size of the synthetic graph relative to the real one')
     parser.add_argument('--log-steps', type=int, default=100)
     return parser.parse_args()
 
 def main(args):
     # DataLoading
-    dataset_name = 'ogbn-arxiv'
+    dataset_name, synthetic = split_synthetic(args.dataset)
     root = '/mnt/ssd/ssd/dataset'
 
-    dataset = DglNodePropPredDataset(name=dataset_name, root=root)
+    if synthetic:
+        dataset = SyntheticNodePropPredDataset(dataset_name, scale=args.synthetic_scale)
+    else:
+        dataset = DglNodePropPredDataset(name=dataset_name, root=root)
     g, labels = dataset[0]
     srcs, dsts = g.all_edges()
     g.add_edges(dsts, srcs)
@@ -1,6 +1,9 @@
 from models import MPNN, AGDN
 import torch.nn.functional as F
 
+from agdn_common import agdn_ops
+from agdn_common import precision
+
 def gen_model(in_feats, n_classes, args):
     use_attn_dst = not args.no_attn_dst
     residual = not args.no_residual
@@ -64,6 +67,11 @@ def gen_model(in_feats, n_classes, args):
                 zero_inits=args.zero_inits,
                 )
 
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
+
     # print(model)
     return model
 
@@ -14,41 +14,89 @@ from matplotlib import pyplot as plt
 from matplotlib.ticker import AutoMinorLocator, MultipleLocator
 from ogb.nodeproppred import DglNodePropPredDataset, Evaluator
 
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from agdn_common import instrument
+from agdn_common import precision
 from gen_model import gen_model
-from utils import (add_labels, adjust_learning_rate, compute_acc, compute_norm, positional_encoding,
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
+from utils import (add_labels, adjust_learning_rate, compute_acc, compute_norm, label_onehot, positional_encoding,
                    cross_entropy, loge_cross_entropy, loss_kd_only, consis_loss, plot, print_info,
-                   save_checkpoint, seed)
+                   open_prediction_store, save_checkpoint, seed, TeacherStore, load_teacher_output)
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 device = None
 in_feats, n_classes = None, None
+pred_store = None
+
+
+def label_reuse_forward(args, model, graph, feat, label_feat, unlabel_idx):
+    # The feature part of the first layer is projected once (model.cache_input),
+    # every label iteration only projects the N x n_classes label matrix, which
+    # is updated in place. Only the last forward needs gradients.
+    cache = model.cache_input(feat)
+    if args.n_label_iters > 0:
+        with torch.no_grad():
+            pred = model(graph, label_feat, cache=cache)
+            for _ in range(args.n_label_iters - 1):
+                label_feat[unlabel_idx] = F.softmax(pred[unlabel_idx], dim=-1)
+                pred = model(graph, label_feat, cache=cache)
+        label_feat[unlabel_idx] = F.softmax(pred[unlabel_idx], dim=-1)
+    # label_feat keeps being updated by later samples, autograd gets its own copy
+    return model(graph, label_feat.clone(), cache=cache)
 
 
 def train(args, model, graph, labels, train_idx, val_idx, test_idx, optimizer, teacher_output, loss_fcn, evaluator, epoch=1):
     model.train()
 
     feat = graph.ndata["feat"]
+    label_reuse = args.use_labels and args.label_reuse_cache
 
     if args.use_labels:
         mask = torch.rand(train_idx.shape) < args.mask_rate
 
         train_labels_idx = train_idx[mask]
         train_pred_idx = train_idx[~mask]
+        unlabel_idx = torch.cat([train_pred_idx, val_idx, test_idx])
 
-        feat = add_labels(feat, labels, train_labels_idx, n_classes, device)
+        if label_reuse:
+            label_feat = label_onehot(feat.shape[0], labels, train_labels_idx, n_classes, device)
+        else:
+            feat = add_labels(feat, labels, train_labels_idx, n_classes, device)
     else:
         mask = torch.rand(train_idx.shape) < args.mask_rate
         # We change mask to ~mask to match previous definition
         train_pred_idx = train_idx[~mask]
 
     optimizer.zero_grad()
-    if args.use_consis_loss:
+    instrument.begin("forward")
+    batched_consis = (
+        args.use_consis_loss and args.batched_consis and args.model == "agdn"
+        and not label_reuse and not (args.n_label_iters > 0 and args.use_labels)
+    )
+    if batched_consis:
+        # all dropout samples in one forward, N x sample x n_classes
+        preds = model(graph, feat, n_samples=args.sample)
+        with instrument.stage("loss"):
+            loss = 0
+            for s in range(args.sample):
+                loss += loss_fcn(preds[train_pred_idx, s], labels[train_pred_idx])
+            loss /= args.sample
+            ps = preds.softmax(-1)
+            if args.strict_consis_loss:
+                ps = ps[torch.cat([val_idx, test_idx])]
+            loss_consis = consis_loss(ps.transpose(1, 2), args.consis_temp, args.consis_lamb, conf=args.conf)
+            loss += loss_consis
+        pred = preds[:, -1]
+    elif args.use_consis_loss:
         p_list = []
         loss = 0
         for s in range(args.sample):
-            pred = model(graph, feat)
-            if args.n_label_iters > 0 and args.use_labels:
+            if label_reuse:
+                pred = label_reuse_forward(args, model, graph, feat, label_feat, unlabel_idx)
+            else:
+                pred = model(graph, feat)
+            if args.n_label_iters > 0 and args.use_labels and not label_reuse:
                 unlabel_idx = torch.cat([train_pred_idx, val_idx, test_idx])
                 for _ in range(args.n_label_iters):
                     pred = pred.detach()
@@ -58,15 +106,21 @@ def train(args, model, graph, labels, train_idx, val_idx, test_idx, optimizer, t
                     # confident_unlabel_idx = unlabel_idx[unlabel_probs.max(dim=-1)[0] > 0.7]
                     feat[unlabel_idx, -n_classes:] = F.softmax(pred[unlabel_idx], dim=-1)
                     pred = model(graph, feat)
-            if not args.strict_consis_loss:
-                p_list.append(pred.softmax(-1))
-            else:
-                p_list.append(pred.softmax(-1)[torch.cat([val_idx, test_idx])])
-            loss += loss_fcn(pred[train_pred_idx], labels[train_pred_idx])
-        loss /= args.sample
-        ps = torch.stack(p_list, dim=2)
-        loss_consis = consis_loss(ps, args.consis_temp, args.consis_lamb, conf=args.conf)
-        loss += loss_consis
+            with instrument.stage("loss"):
+                if not args.strict_consis_loss:
+                    p_list.append(pred.softmax(-1))
+                else:
+                    p_list.append(pred.softmax(-1)[torch.cat([val_idx, test_idx])])
+                loss += loss_fcn(pred[train_pred_idx], labels[train_pred_idx])
+        with instrument.stage("loss"):
+            loss /= args.sample
+            ps = torch.stack(p_list, dim=2)
+            loss_consis = consis_loss(ps, args.consis_temp, args.consis_lamb, conf=args.conf)
+            loss += loss_consis
+    elif label_reuse:
+        pred = label_reuse_forward(args, model, graph, feat, label_feat, unlabel_idx)
+        with instrument.stage("loss"):
+            loss = loss_fcn(pred[train_pred_idx], labels[train_pred_idx])
     else:
         pred = model(graph, feat)
         if args.n_label_iters > 0 and args.use_labels:
@@ -80,12 +134,17 @@ def train(args, model, graph, labels, train_idx, val_idx, test_idx, optimizer, t
                 feat[unlabel_idx, -n_classes:] = F.softmax(pred[unlabel_idx], dim=-1)
                 pred = model(graph, feat)
         
-        loss = loss_fcn(pred[train_pred_idx], labels[train_pred_idx])
+        with instrument.stage("loss"):
+            loss = loss_fcn(pred[train_pred_idx], labels[train_pred_idx])
     if args.mode == "student":
-        loss_kd = loss_kd_only(pred, teacher_output, args.temp)
-        loss = loss*(1-args.alpha) + loss_kd*args.alpha
-    loss.backward()
-    optimizer.step()
+        with instrument.stage("loss"):
+            loss_kd = loss_kd_only(pred, teacher_output, args.temp)
+            loss = loss*(1-args.alpha) + loss_kd*args.alpha
+    instrument.end()
+    with instrument.stage("backward"):
+        loss.backward()
+    with instrument.stage("optimizer"):
+        optimizer.step()
 
     return compute_acc(pred[train_idx], labels[train_idx], evaluator), loss
 
@@ -96,11 +155,15 @@ def evaluate(args, model, graph, labels, train_idx, val_idx, test_idx, use_label
 
     feat = graph.ndata["feat"]
 
-    if use_labels:
-        feat = add_labels(feat, labels, train_idx, n_classes, device)
-
-    pred = model(graph, feat)
-    if args.n_label_iters > 0 and args.use_labels:
+    if use_labels and args.label_reuse_cache:
+        label_feat = label_onehot(feat.shape[0], labels, train_idx, n_classes, device)
+        unlabel_idx = torch.cat([val_idx, test_idx])
+        pred = label_reuse_forward(args, model, graph, feat, label_feat, unlabel_idx)
+    else:
+        if use_labels:
+            feat = add_labels(feat, labels, train_idx, n_classes, device)
+        pred = model(graph, feat)
+    if args.n_label_iters > 0 and args.use_labels and not args.label_reuse_cache:
         unlabel_idx = torch.cat([val_idx, test_idx])
         for _ in range(args.n_label_iters):
             feat[unlabel_idx, -n_classes:] = F.softmax(pred[unlabel_idx], dim=-1)
@@ -158,10 +221,16 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
     graph.edata["sage_norm"] = deg_inv[graph.edges()[1]]
 
     checkpoint_path = args.checkpoint_path
+    teacher_store = None
     if args.mode == "student":
-        teacher_output = torch.load(os.path.join(checkpoint_path, f'best_pred_run{n_running}.pt')).cpu().cuda()
+        if args.teacher_store:
+            teacher_output = load_teacher_output(os.path.join(checkpoint_path, f'best_pred_run{n_running}.npy'), device=device)
+        else:
+            teacher_output = torch.load(os.path.join(checkpoint_path, f'best_pred_run{n_running}.pt')).cpu().cuda()
     else:
         teacher_output = None
+        if args.mode == "teacher" and args.teacher_store:
+            teacher_store = TeacherStore(os.path.join(checkpoint_path, f'best_pred_run{n_running}.npy'))
 
     for epoch in range(1, args.n_epochs + 1):
         tic = time.time()
@@ -171,12 +240,14 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
         acc, loss = train(args, model, graph, labels, train_idx, val_idx, test_idx, optimizer, teacher_output, loss_fcn, evaluator, epoch=epoch)
 
-        train_acc, val_acc, test_acc, train_loss, val_loss, test_loss, pred = evaluate(
-            args, model, graph, labels, train_idx, val_idx, test_idx, args.use_labels, loss_fcn, evaluator
-        )
+        with instrument.stage("evaluation"):
+            train_acc, val_acc, test_acc, train_loss, val_loss, test_loss, pred = evaluate(
+                args, model, graph, labels, train_idx, val_idx, test_idx, args.use_labels, loss_fcn, evaluator
+            )
 
         toc = time.time()
         total_time += toc - tic
+        instrument.epoch_end(epoch, run=n_running, epoch_time=toc - tic)
 
         if args.selection_metric == "acc":
             new_best = val_acc > best_val_acc
@@ -187,7 +258,9 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
             best_val_acc = val_acc
             best_test_acc = test_acc
             final_pred = pred
-            if args.mode == "teacher":
+            if teacher_store is not None:
+                teacher_store.save(final_pred)
+            elif args.mode == "teacher":
                 os.makedirs(checkpoint_path, exist_ok=True)
                 save_checkpoint(final_pred, n_running, checkpoint_path)
 
@@ -203,6 +276,9 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
         ):
             l.append(e)
 
+    if teacher_store is not None:
+        teacher_store.close()
+
     print_info("*" * 50, verbose=args.verbose)
     print_info(f"Average epoch time: {total_time / args.n_epochs}, Test acc: {best_test_acc}", verbose=args.verbose)
 
@@ -214,6 +290,9 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
     if args.save_pred:
         os.makedirs(args.output_path, exist_ok=True)
         torch.save(F.softmax(final_pred, dim=1), os.path.join(args.output_path, f"{n_running - 1}.pt"))
+    if pred_store is not None:
+        pred_store[n_running - 1] = F.softmax(final_pred, dim=1).cpu().numpy()
+        pred_store.flush()
 
     return best_val_acc, best_test_acc
 
@@ -225,14 +304,23 @@ def count_parameters(args):
 
 
 def main():
-    global device, in_feats, n_classes, epsilon
+    global device, in_feats, n_classes, epsilon, pred_store
 
     argparser = argparse.ArgumentParser("AGDN on OGBN-Arxiv", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # Dataset and device setting
     argparser.add_argument("--cpu", action="store_true", help="CPU mode. This option overrides --gpu.")
     argparser.add_argument("--gpu", type=int, default=0, help="GPU device ID.")
     argparser.add_argument("--root", type=str, default="/mnt/ssd/ssd/dataset")
+    argparser.add_argument(
+        "--dataset", type=str, default="ogbn-arxiv", choices=["ogbn-arxiv", "synthetic-ogbn-arxiv"],
+        help="synthetic-* generates a random graph with the same schema instead of loading the real dataset",
+    )
+    argparser.add_argument("--synthetic-scale", type=float, default=1.0, help="size of the synthetic graph relative to the real one")
     argparser.add_argument("--no-self-loops", action="store_true", help="Do not add self-loops.")
+    argparser.add_argument("--pe-dim", type=int, default=0,
+        help="if > 0, append this many Laplacian positional encodings (eigenvectors) to the node features")
+    argparser.add_argument("--pe-cache-dir", type=str, default="",
+        help="cache the positional encodings in this directory, keyed by graph hash and --pe-dim")
     argparser.add_argument("--use-xrt-emb", action="store_true")
 
     # Training setting
@@ -253,6 +341,8 @@ def main():
     )
     argparser.add_argument("--mask-rate", type=float, default=0.5, help="mask rate")
     argparser.add_argument("--n-label-iters", type=int, default=0, help="number of label iterations")
+    argparser.add_argument("--label-reuse-cache", action="store_true",
+        help="Project the node features of the first layer once and only re-project labels in label iterations (agdn only).")
     argparser.add_argument("--no-attn-dst", action="store_true", help="Don't use attn_dst.")
     argparser.add_argument("--no-residual", action="store_true", help="Don't use residual linears")
     argparser.add_argument("--adjust-lr", action="store_true", help="adjust learning rate in first 50 iterations")
@@ -264,6 +354,8 @@ def main():
     argparser.add_argument('--consis-temp', type=float, default=0.5,)
     argparser.add_argument('--consis-lamb', type=float, default=1.,)
     argparser.add_argument('--sample', type=int, default=1,)
+    argparser.add_argument('--batched-consis', action='store_true',
+        help="Run all consistency samples in one forward with the samples stacked along the head dimension (agdn only, no label iterations).")
     argparser.add_argument('--conf', type=float, default=0.,)
 
     # Model setting
@@ -294,17 +386,38 @@ def main():
     argparser.add_argument("--checkpoint-path", type=str, default="../checkpoint/")
     argparser.add_argument("--output-path", type=str, default="../output/")
     argparser.add_argument("--save-pred", action="store_true", help="save final predictions")
+    argparser.add_argument("--teacher-store", action="store_true",
+        help="Teacher: write the best predictions as fp16 .npy from a background thread. Student: read them from there.")
+    argparser.add_argument("--pred-store", type=str, default="",
+        help="Also write the final softmax of every run into this memory-mapped .npy (n_runs x N x C), read by correct_and_smooth.py --pred-store.")
+    argparser.add_argument("--resume-pred-store", action="store_true",
+        help="Reopen an existing --pred-store of the same shape instead of recreating it, keeping the runs it already holds.")
+    argparser.add_argument("--legacy-agdn", action="store_true",
+        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    argparser.add_argument("--precision", type=str, default="fp32", choices=precision.PRECISIONS,
+        help="bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32")
+    argparser.add_argument("--trace", type=str, default="", help="write per-epoch time and memory of the training stages to this JSONL file")
+    argparser.add_argument("--chrome-trace", type=str, default="", help="with --trace, also dump every stage in Chrome trace format here")
     
     args = argparser.parse_args()
     print_info(f"args: {args}", verbose=args.verbose)
+    assert args.precision == "fp32" or args.model == "agdn", "--precision bf16 is implemented for AGDN"
+    # the cache is AGDN.cache_input, which projects the label part of the input
+    assert not args.label_reuse_cache or (args.use_labels and args.model == "agdn"), "--label-reuse-cache needs --use-labels and AGDN"
+    # AGDNOp has neither the label reuse cache nor the batched multi-sample forward
+    assert args.legacy_agdn or args.model != "agdn" or not (args.label_reuse_cache or args.batched_consis), "--label-reuse-cache and --batched-consis need --legacy-agdn"
 
     if args.cpu:
         device = torch.device("cpu")
     else:
         device = torch.device("cuda:%d" % args.gpu)
+    assert precision.supported(args.precision, device), "--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels"
 
     # load data
-    data = DglNodePropPredDataset(name="ogbn-arxiv", root=args.root)
+    if split_synthetic(args.dataset)[1]:
+        data = SyntheticNodePropPredDataset("ogbn-arxiv", scale=args.synthetic_scale)
+    else:
+        data = DglNodePropPredDataset(name="ogbn-arxiv", root=args.root)
     
     evaluator = Evaluator(name="ogbn-arxiv")
 
@@ -339,15 +452,30 @@ def main():
     #     graph.update_all(fn.copy_u('PE', 'm'), fn.mean('m', 'PE'))
     #     PE.append(graph.ndata['PE'])
     # graph.ndata['PE'] = torch.stack(PE, dim=1)
+    if args.pe_dim > 0:
+        # of the final graph, i.e. with reverse edges and self-loops; repeated runs load them from --pe-cache-dir
+        pe = positional_encoding(graph, args.pe_dim, cache_dir=args.pe_cache_dir or None)
+        graph.ndata["feat"] = torch.cat([graph.ndata["feat"], pe], dim=-1)
+        print_info(f"node feature size with positional encodings: {graph.ndata['feat'].shape[-1]}", verbose=args.verbose)
     in_feats = graph.ndata["feat"].shape[1]
     n_classes = (labels.max() + 1).item()
     # graph.create_format_()
+    if args.pred_store:
+        pred_store = open_prediction_store(
+            args.pred_store, args.n_runs, graph.number_of_nodes(), n_classes, resume=args.resume_pred_store
+        )
+
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda=device.type == "cuda")
 
-    train_idx = train_idx.to(device)
-    val_idx = val_idx.to(device)
-    test_idx = test_idx.to(device)
-    labels = labels.to(device)
-    graph = graph.to(device)
+    with instrument.stage("h2d"):
+        train_idx = train_idx.to(device)
+        val_idx = val_idx.to(device)
+        test_idx = test_idx.to(device)
+        labels = labels.to(device)
+        graph = graph.to(device)
+    # setup stages go to an epoch 0 record
+    instrument.epoch_end(0)
 
     # run
     val_accs = []
@@ -358,6 +486,7 @@ def main():
         val_acc, test_acc = run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, i)
         val_accs.append(val_acc)
         test_accs.append(test_acc)
+    instrument.close()
 
     print_info(f"Runned {args.n_runs} times", verbose=args.verbose)
     print_info(f"Val Accs: {val_accs}", verbose=args.verbose)
@@ -5,10 +5,12 @@ import torch.nn.functional as F
 from dgl import function as fn
 from dgl._ffi.base import DGLError
 from dgl.nn.pytorch.utils import Identity
-from dgl.ops import edge_softmax
 from dgl.utils import expand_as_pair
 from torch.nn.modules.linear import Linear
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
 # implementation from @Espylapiza
 class ElementWiseLinear(nn.Module):
     def __init__(self, size, weight=True, bias=True, inplace=False):
@@ -386,6 +388,7 @@ class AGDNConv(nn.Module):
         self._batch_norm = batch_norm
         self._propagate_first = propagate_first
         self._zero_inits = zero_inits
+        self._n_samples = 1
 
         if propagate_first:
             propagate_feats = in_feats
@@ -469,18 +472,33 @@ class AGDNConv(nn.Module):
     def set_allow_zero_in_degree(self, set_value):
         self._allow_zero_in_degree = set_value
 
+    def per_head(self, param):
+        # With n_samples > 1 the samples are stacked along the head dimension
+        # (index sample * num_heads + head), so per-head parameters are tiled.
+        if self._n_samples == 1:
+            return param
+        repeats = [1] * param.dim()
+        repeats[1] = self._n_samples
+        return param.repeat(*repeats)
+
     def feat_trans(self, h, idx):
         
         if self._batch_norm:
-            mean = h.mean(dim=-1).view(h.shape[0], self._num_heads, 1)
-            var = h.var(dim=-1, unbiased=False).view(h.shape[0], self._num_heads, 1) + 1e-9
-            h = (h - mean) * self.scale[idx] * torch.rsqrt(var) + self.offset[idx]
+            mean = h.mean(dim=-1).view(h.shape[0], h.shape[1], 1)
+            var = h.var(dim=-1, unbiased=False).view(h.shape[0], h.shape[1], 1) + 1e-9
+            h = (h - mean) * self.per_head(self.scale[idx]) * torch.rsqrt(var) + self.per_head(self.offset[idx])
 
         if self._position_emb:
-            h = h + self.position_emb[[idx], :, :]
+            h = h + self.per_head(self.position_emb[[idx], :, :])
         return h
 
-    def forward(self, graph, feat):
+    def forward(self, graph, feat, cache=None, n_samples=1):
+        # cache: projections of the leading input columns (see AGDN.cache_input),
+        # feat then only holds the remaining columns.
+        # n_samples > 1: feat is N x n_samples x in_feats, every sample has its own
+        # dropout masks (edge dropout is shared) and all samples are diffused together.
+        assert n_samples == 1 or not self._propagate_first
+        self._n_samples = n_samples
         with graph.local_scope():
             if not self._allow_zero_in_degree:
                 if (graph.in_degrees() == 0).any():
@@ -500,8 +518,11 @@ class AGDNConv(nn.Module):
             else:
                 h_src = self.feat_drop(feat)
                 feat_src = h_src
-                if not self._propagate_first:
-                    feat_src = self.fc(h_src).view(-1, self._num_heads, self._out_feats)
+                if cache is not None:
+                    feat_src = cache["fc"] + F.linear(h_src, self.fc.weight[:, -h_src.shape[-1]:])
+                    feat_src = feat_src.view(h_src.shape[0], -1, self._out_feats)
+                elif not self._propagate_first:
+                    feat_src = self.fc(h_src).view(h_src.shape[0], -1, self._out_feats)
                 else:
                     feat_src = feat_src.view(-1, 1, self._in_src_feats)
                 if graph.is_block:
@@ -518,14 +539,15 @@ class AGDNConv(nn.Module):
             else:
                 eids = torch.arange(graph.number_of_edges(), device=graph.device)
 
+            instrument.begin("attention")
             graph.srcdata.update({"ft": feat_src})
             if self._transition_matrix.startswith("gat"):
-                el = (feat_src * self.attn_l).sum(-1).unsqueeze(-1)
+                el = (feat_src * self.per_head(self.attn_l)).sum(-1).unsqueeze(-1)
                 graph.srcdata.update({"el": el})
                 # graph.dstdata.update({"er": er})
                 # compute edge attention, el and er are a_l Wh_i and a_r Wh_j respectively.
                 if self.attn_r is not None:
-                    er = (feat_dst * self.attn_r).sum(dim=-1).unsqueeze(-1)
+                    er = (feat_dst * self.per_head(self.attn_r)).sum(dim=-1).unsqueeze(-1)
                     graph.dstdata.update({"er": er})
                     graph.apply_edges(fn.u_add_v("el", "er", "e"))
                 else:
@@ -546,12 +568,14 @@ class AGDNConv(nn.Module):
             elif self._transition_matrix == "sage":
                 a = graph.edata["sage_norm"][eids].unsqueeze(1).unsqueeze(1)
             
-            graph.edata["a"] = torch.zeros(size=(graph.number_of_edges(), self._num_heads, 1), device=feat_src.device)
+            graph.edata["a"] = torch.zeros(size=(graph.number_of_edges(), feat_src.shape[1], 1), dtype=feat_src.dtype, device=feat_src.device)
             graph.edata["a"][eids] = self.attn_drop(a)
+            instrument.end()
             
             hstack = [graph.dstdata["ft"]]
 
-            for _ in range(self._K):
+            for k in range(self._K):
+                instrument.begin("hop", k + 1)
                 # message passing
                 if self.diffusion_drop > 0:
                     # We could choose to simulate the dropout between convolutions by setting diffusion_drop > 0
@@ -559,13 +583,15 @@ class AGDNConv(nn.Module):
                 graph.update_all(fn.u_mul_e("ft", "a", "m"), fn.sum("m", "ft"))
 
                 hstack.append(graph.dstdata["ft"])
+                instrument.end()
 
+            instrument.begin("hop_aggregation")
             hstack = [self.feat_trans(h, k) for k, h in enumerate(hstack)]
 
             hop_a = None
             if self._weight_style in ["HA", "HA+HC"]:
-                hop_a_l = (hstack[0] * self.hop_attn_l).sum(dim=-1).unsqueeze(-1)
-                hop_astack_r = [(feat_dst * self.hop_attn_r).sum(dim=-1).unsqueeze(-1) for feat_dst in hstack]
+                hop_a_l = (hstack[0] * self.per_head(self.hop_attn_l)).sum(dim=-1).unsqueeze(-1)
+                hop_astack_r = [(feat_dst * self.per_head(self.hop_attn_r)).sum(dim=-1).unsqueeze(-1) for feat_dst in hstack]
                 hop_a = torch.cat([(a_r + hop_a_l) for a_r in hop_astack_r], dim=-1)
                 if self._HA_activation == "sigmoid":
                     hop_a = torch.sigmoid(hop_a)
@@ -576,7 +602,7 @@ class AGDNConv(nn.Module):
                 if self._HA_activation == "standardize":
                     hop_a = (hop_a - hop_a.min(dim=2, keepdim=True)[0]) / (hop_a.max(dim=2, keepdim=True)[0] - hop_a.min(dim=2, keepdim=True)[0]).clamp(min=1e-9)
 
-                hop_a = F.softmax(hop_a, dim=-1)
+                hop_a = F.softmax(hop_a.float(), dim=-1)
                 # hop_a = self.attn_drop(hop_a)
                 if not self.training:
                     self.hop_a = hop_a
@@ -585,28 +611,33 @@ class AGDNConv(nn.Module):
                 for i in range(hop_a.shape[2]):
                     
                     if self._weight_style == "HA+HC":
-                        rst += hstack[i] * hop_a[:, :, [i]] * self.weights[:, :, i, :]
+                        rst += hstack[i] * hop_a[:, :, [i]] * self.per_head(self.weights[:, :, i, :])
                     else:
                         rst += hstack[i] * hop_a[:, :, [i]]
 
             if self._weight_style == "HC":
                 rst = 0
                 for i in range(len(hstack)):
-                    rst += hstack[i] * self.weights[:, :, i, :]
+                    rst += hstack[i] * self.per_head(self.weights[:, :, i, :])
             if self._weight_style == "mean":
                 rst = 0
                 for i in range(len(hstack)):
                     rst += hstack[i] / len(hstack)
+            instrument.end()
 
             if self._propagate_first:
                 rst = self.fc(rst)
             # residual
             if self.res_fc is not None:
-                resval = self.res_fc(feat).view(h_dst.shape[0], -1, self._out_feats)
+                if cache is not None:
+                    resval = cache["res_fc"] + F.linear(feat, self.res_fc.weight[:, -feat.shape[-1]:])
+                else:
+                    resval = self.res_fc(feat)
+                resval = resval.view(h_dst.shape[0], -1, self._out_feats)
                 rst = rst + resval
             # bias
             if self.bias is not None:
-                rst = rst + self.bias
+                rst = rst + self.per_head(self.bias)
             # activation
             if self._activation is not None:
                 rst = self._activation(rst)
@@ -686,12 +717,41 @@ class AGDN(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.activation = activation
 
-    def forward(self, graph, feat):
+    def cache_input(self, feat):
+        """Project the static part of the input once for label reuse.
+
+        The first layer's fc and res_fc are linear in their input, so for an
+        input [feat, labels] they split into a feature part, computed here, and
+        a label part. forward(graph, labels, cache) then only projects the label
+        columns, which is all that changes between label iterations.
+        """
+        conv = self.convs[0]
+        assert not conv._propagate_first
+        h = self.input_dropout(feat)
+        cache = {"fc": F.linear(conv.feat_drop(h), conv.fc.weight[:, : feat.shape[-1]])}
+        if conv.res_fc is not None:
+            cache["res_fc"] = F.linear(h, conv.res_fc.weight[:, : feat.shape[-1]])
+        if self.in_feats == self.num_heads * self.n_hidden:
+            # only needed for the input residual of the first layer
+            cache["input"] = h
+        return cache
+
+    def forward(self, graph, feat, cache=None, n_samples=1):
+        # n_samples > 1 returns N x n_samples x n_classes, one independent dropout
+        # sample per slice, with all samples sharing each layer's sparse aggregation
+        if n_samples > 1:
+            return self.forward_samples(graph, feat, n_samples)
         h = feat
         h = self.input_dropout(h)
-        h_last = h
+        if cache is None:
+            h_last = h
+        elif "input" in cache:
+            h_last = torch.cat([cache["input"], h], dim=-1)
+        else:
+            # the full input does not match the hidden size, no input residual
+            h_last = h[:, :0]
         for i in range(self.n_layers):
-            conv = self.convs[i](graph, h)
+            conv = self.convs[i](graph, h, cache if i == 0 else None)
 
             h = conv
 
@@ -709,3 +769,26 @@ class AGDN(nn.Module):
             h = self.bias_last(h)
 
         return h
+
+    def forward_samples(self, graph, feat, n_samples):
+        n_nodes = feat.shape[0]
+        h = self.input_dropout(feat.unsqueeze(1).expand(n_nodes, n_samples, feat.shape[-1]))
+        h_last = h
+        for i in range(self.n_layers):
+            h = self.convs[i](graph, h, n_samples=n_samples)
+
+            if i < self.n_layers - 1:
+                h = h.reshape(n_nodes, n_samples, -1)
+                if h_last.shape[-1] == h.shape[-1]:
+                    h = h + h_last
+                # batch statistics are kept per sample
+                h = torch.stack([self.bns[i](h[:, s]) for s in range(n_samples)], dim=1)
+                h = self.activation(h, inplace=True)
+                h = self.dropout(h)
+                h_last = h
+
+        h = h.view(n_nodes, n_samples, -1, h.shape[-1]).mean(2)
+        if self.bias_last is not None:
+            h = self.bias_last(h)
+
+        return h
@@ -1,9 +1,12 @@
+import hashlib
 import math
 import os
 import random
+import threading
 
 import dgl
 from scipy import sparse as sp
+from scipy.sparse.linalg import eigsh, lobpcg
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -12,15 +15,58 @@ from matplotlib.ticker import AutoMinorLocator, MultipleLocator
 
 epsilon = 1 - math.log(2)
 
-def positional_encoding(g, pos_enc_dim):
+def graph_hash(g):
+    h = hashlib.sha1(str(g.number_of_nodes()).encode())
+    src, dst = g.all_edges(order="srcdst")
+    h.update(dgl.backend.asnumpy(src).astype(np.int64).tobytes())
+    h.update(dgl.backend.asnumpy(dst).astype(np.int64).tobytes())
+    return h.hexdigest()
+
+
+def normalized_laplacian(g):
+    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
+    if (A != A.T).nnz > 0:
+        # the symmetric solvers need a symmetric operator
+        A = ((A + A.T) > 0).astype(float)
+    degs = np.asarray(A.sum(axis=1)).flatten().clip(1)
+    N = sp.diags(degs ** -0.5, dtype=float)
+    return sp.eye(g.number_of_nodes()) - N * A * N
+
+
+def laplacian_eigenvectors(L, k, init=None, tol=1e-2, maxiter=200):
+    """Eigenvectors of the k smallest eigenvalues of L, in increasing order.
+
+    Uses LOBPCG when init (an n x k warm start, e.g. the eigenvectors of a
+    slightly different graph) is given, otherwise eigsh on 2I - L, whose largest
+    eigenvalues are the smallest ones of L and converge much faster.
+    """
+    n = L.shape[0]
+    if init is not None:
+        X = np.random.RandomState(0).normal(size=(n, k))
+        m, c = min(n, init.shape[0]), min(k, init.shape[1])
+        X[:m, :c] = init[:m, :c]
+        EigVal, EigVec = lobpcg(L, X, tol=tol, maxiter=maxiter, largest=False)
+    else:
+        EigVal, EigVec = eigsh(2 * sp.eye(n) - L, k=k, which="LA", tol=tol)
+        EigVal = 2 - EigVal
+    return EigVec[:, EigVal.argsort()]
+
+
+def positional_encoding(g, pos_enc_dim, cache_dir=None, init=None, tol=1e-2):
     """
         Graph positional encoding v/ Laplacian eigenvectors
+
+        Results are cached in cache_dir, keyed by the graph hash and pos_enc_dim.
+        init warm starts the solver (see laplacian_eigenvectors), either an array
+        or the cache file of a previous version of the graph.
     """
-    
-    # Laplacian
-    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
-    N = sp.diags(dgl.backend.asnumpy(g.in_degrees()).clip(1) ** -0.5, dtype=float)
-    L = sp.eye(g.number_of_nodes()) - N * A * N
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"lap_pe_{graph_hash(g)}_{pos_enc_dim}.npy")
+        if os.path.exists(cache_file):
+            return torch.from_numpy(np.load(cache_file)[:, 1:]).float().to(g.device)
+    if isinstance(init, str):
+        init = np.load(init)
 
     # # Eigenvectors with numpy
     # EigVal, EigVec = np.linalg.eig(L.toarray())
@@ -28,11 +74,12 @@ def positional_encoding(g, pos_enc_dim):
     # EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
     # g.ndata['pos_enc'] = torch.from_numpy(np.abs(EigVec[:,1:pos_enc_dim+1])).float() 
 
-    # Eigenvectors with scipy
-    #EigVal, EigVec = sp.linalg.eigs(L, k=pos_enc_dim+1, which='SR')
-    EigVal, EigVec = sp.linalg.eigs(L, k=pos_enc_dim+1, which='SR', tol=1e-2)
-    EigVec = EigVec[:, EigVal.argsort()] # increasing order
-    return torch.from_numpy(np.real(EigVec[:,1:pos_enc_dim+1])).float().to(g.device)
+    EigVec = laplacian_eigenvectors(normalized_laplacian(g), pos_enc_dim + 1, init=init, tol=tol)
+    if cache_file is not None:
+        # the trivial eigenvector is kept so the file can warm start later solves
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, EigVec.astype(np.float32))
+    return torch.from_numpy(EigVec[:, 1:pos_enc_dim + 1]).float().to(g.device)
 
     
 def compute_norm(graph):
@@ -52,6 +99,75 @@ def save_checkpoint(pred, n_running, checkpoint_path):
     print('Saving prediction.......')
     torch.save(pred.cpu(),fname)
 
+class TeacherStore(object):
+    """Best teacher predictions of a run as a memory-mappable fp16 .npy file.
+
+    save() hands the prediction to a background writer and returns; if the
+    writer is still busy only the newest prediction is kept, and every write
+    goes to a temporary file that atomically replaces the previous best.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._writer = None
+
+    def save(self, pred):
+        pred = pred.detach().to("cpu", torch.float16).numpy()
+        with self._cond:
+            self._pending = pred
+            self._cond.notify()
+        if self._writer is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                pred, self._pending = self._pending, None
+            tmp_path = self.path + ".tmp.npy"
+            np.save(tmp_path, pred)
+            os.replace(tmp_path, self.path)
+
+    def close(self):
+        # waits for the last prediction to be written
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+def load_teacher_output(path, idx=None, device="cpu"):
+    # only the rows of idx are read from the memory-mapped file
+    pred = np.load(path, mmap_mode="r")
+    if idx is not None:
+        pred = pred[np.asarray(idx.cpu() if torch.is_tensor(idx) else idx)]
+    return torch.from_numpy(np.array(pred, dtype=np.float32)).to(device)
+
+def open_prediction_store(path, n_runs, n_nodes, n_classes, resume=False):
+    """n_runs x n_nodes x n_classes float32 .npy memmap, row r holds the softmax output of run r.
+
+    The store is created anew, rows of runs that have not finished yet are all zero.
+    With resume an existing store of the same shape is reopened instead, so that
+    runs can be filled in by several processes of the same experiment.
+    """
+    shape = (n_runs, n_nodes, n_classes)
+    if resume and os.path.exists(path):
+        store = np.load(path, mmap_mode="r+")
+        if store.shape == shape:
+            return store
+        del store
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+
 def cross_entropy(x, labels):
     return F.cross_entropy(x, labels[:, 0], reduction="mean")
 
@@ -91,9 +207,14 @@ def seed(seed=0):
     torch.backends.cudnn.benchmark = False
     dgl.random.seed(seed)
 
-def add_labels(feat, labels, idx, n_classes, device):
-    onehot = torch.zeros([feat.shape[0], n_classes]).to(device)
+def label_onehot(n_nodes, labels, idx, n_classes, device):
+    onehot = torch.zeros([n_nodes, n_classes]).to(device)
     onehot[idx, labels[idx, 0]] = 1
+    return onehot
+
+
+def add_labels(feat, labels, idx, n_classes, device):
+    onehot = label_onehot(feat.shape[0], labels, idx, n_classes, device)
     return torch.cat([feat, onehot], dim=-1)
 
 
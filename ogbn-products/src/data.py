@@ -3,12 +3,17 @@ import torch
 import numpy as np
 from ogb.nodeproppred import DglNodePropPredDataset, Evaluator
 
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
 from utils import compute_norm
 
 
 def load_data(dataset, args):
-    data = DglNodePropPredDataset(name=dataset, root=args.root)
-    evaluator = Evaluator(name=dataset)
+    name, synthetic = split_synthetic(dataset)
+    if synthetic:
+        data = SyntheticNodePropPredDataset(name, scale=args.synthetic_scale)
+    else:
+        data = DglNodePropPredDataset(name=dataset, root=args.root)
+    evaluator = Evaluator(name=name)
 
     splitted_idx = data.get_idx_split()
     train_idx, val_idx, test_idx = splitted_idx["train"], splitted_idx["valid"], splitted_idx["test"]
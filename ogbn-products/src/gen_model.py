@@ -1,6 +1,8 @@
 import numpy as np
 import torch.nn.functional as F
 
+from agdn_common import agdn_ops
+from agdn_common import precision
 from models import AGDN, GAT
 
 
@@ -45,6 +47,10 @@ def gen_model(args, n_node_feats, n_edge_feats, n_classes):
             norm=args.norm,
             shadow=args.sample_type == 'shadow_sample'
         )
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
     return model
 
 
@@ -0,0 +1,261 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import dgl
+import dgl.function as fn
+import numpy as np
+import torch
+from dgl.ops import edge_softmax
+
+from models import AGDN, GAT
+from utils import compute_norm
+
+
+class LayerwiseInference(object):
+    """Layer-wise full-neighborhood inference on CPU.
+
+    Every layer is computed for all nodes before the next one starts, in chunks
+    of destination nodes whose in-edge blocks are built once and reused by all
+    layers and hops. Intermediate tensors live in named buffers (optionally
+    memory-mapped files under memmap_dir) that are reused across layers and
+    across calls, so peak memory is a few N x hidden buffers plus the working
+    set of n_threads chunks instead of all layers' K-hop activations.
+    """
+
+    def __init__(self, graph, chunk_size=65536, n_threads=1, memmap_dir=None):
+        self.graph = graph
+        self.n_nodes = graph.number_of_nodes()
+        self.chunks = [(start, min(start + chunk_size, self.n_nodes)) for start in range(0, self.n_nodes, chunk_size)]
+        self.n_threads = n_threads
+        self.pool = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+        self.memmap_dir = memmap_dir
+        self.buffers = {}
+        self._in_blocks, self._out_blocks = None, None
+        self.deg_sqrt, self.deg_isqrt = compute_norm(graph)
+
+    def buffer(self, name, shape):
+        shape = tuple(shape)
+        if name not in self.buffers or tuple(self.buffers[name].shape) != shape:
+            self.buffers.pop(name, None)
+            if self.memmap_dir:
+                os.makedirs(self.memmap_dir, exist_ok=True)
+                array = np.memmap(os.path.join(self.memmap_dir, f"{name}.dat"), dtype=np.float32, mode="w+", shape=shape)
+                self.buffers[name] = torch.from_numpy(array)
+            else:
+                self.buffers[name] = torch.empty(shape)
+        return self.buffers[name]
+
+    def in_blocks(self):
+        # blocks of all in-edges of each chunk, i.e. full neighborhoods of the destination nodes
+        if self._in_blocks is None:
+            self._in_blocks = []
+            for start, end in self.chunks:
+                nodes = torch.arange(start, end)
+                self._in_blocks.append(dgl.to_block(dgl.in_subgraph(self.graph, nodes), nodes))
+        return self._in_blocks
+
+    def out_blocks(self):
+        # blocks of all out-edges of each chunk (reversed), used for source-side normalization
+        if self._out_blocks is None:
+            self._out_blocks = []
+            for start, end in self.chunks:
+                nodes = torch.arange(start, end)
+                self._out_blocks.append(dgl.to_block(dgl.reverse(dgl.out_subgraph(self.graph, nodes)), nodes))
+        return self._out_blocks
+
+    def map(self, func, blocks=None):
+        """Run func(start, end[, block]) over all chunks, in the thread pool if there is one."""
+        if blocks is None:
+            jobs = [(start, end) for start, end in self.chunks]
+        else:
+            jobs = [(start, end, block) for (start, end), block in zip(self.chunks, blocks)]
+        if self.pool is None:
+            for job in jobs:
+                func(*job)
+        else:
+            list(self.pool.map(lambda job: func(*job), jobs))
+
+    def edge_norm(self, block, norm, a):
+        # the same gcn norms random_partition_v2 computes for a single partition
+        if norm == "none":
+            return a
+        src = block.srcdata[dgl.NID]
+        dst = block.dstdata[dgl.NID]
+        u, v = block.edges()
+        if norm == "adj":
+            return a * (self.deg_isqrt[src][u] * self.deg_sqrt[dst][v]).view(-1, 1, 1)
+        if norm == "avg":
+            return (a + (self.deg_isqrt[src][u] * self.deg_isqrt[dst][v]).view(-1, 1, 1)) / 2
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def _project(conv, engine, feat):
+    n_heads, out_feats = conv._n_heads, conv._out_feats
+    feat_src_fc = engine.buffer("feat_src_fc", (engine.n_nodes, n_heads, out_feats))
+    attn_src = engine.buffer("attn_src", (engine.n_nodes, n_heads, 1))
+    attn_dst = engine.buffer("attn_dst", (engine.n_nodes, n_heads, 1)) if conv.attn_dst_fc is not None else None
+    rst = engine.buffer("rst", (engine.n_nodes, n_heads, out_feats))
+
+    def project(start, end):
+        x = feat[start:end]
+        feat_src_fc[start:end] = conv.src_fc(x).view(-1, n_heads, out_feats)
+        attn_src[start:end] = conv.attn_src_fc(x).view(-1, n_heads, 1)
+        if attn_dst is not None:
+            attn_dst[start:end] = conv.attn_dst_fc(x).view(-1, n_heads, 1)
+        # residual
+        if conv.dst_fc is not None:
+            rst[start:end] = conv.dst_fc(x).view(-1, n_heads, out_feats)
+        else:
+            rst[start:end] = conv.bias.view(1, n_heads, out_feats)
+
+    engine.map(project)
+    return feat_src_fc, attn_src, attn_dst, rst
+
+
+def _attn_logits(conv, block, attn_src, attn_dst):
+    block.srcdata["attn_src"] = attn_src[block.srcdata[dgl.NID]]
+    if attn_dst is not None:
+        block.dstdata["attn_dst"] = attn_dst[block.dstdata[dgl.NID]]
+        block.apply_edges(fn.u_add_v("attn_src", "attn_dst", "e"))
+    else:
+        block.apply_edges(fn.copy_u("attn_src", "e"))
+    return conv.leaky_relu(block.edata.pop("e"))
+
+
+def gat_conv_inference(conv, engine, feat):
+    assert conv.attn_edge_fc is None, "layer-wise inference does not support edge features"
+    feat_src_fc, attn_src, attn_dst, rst = _project(conv, engine, feat)
+
+    def propagate(start, end, block):
+        with block.local_scope():
+            block.edata["a"] = engine.edge_norm(block, conv._norm, edge_softmax(block, _attn_logits(conv, block, attn_src, attn_dst)))
+            block.srcdata["h"] = feat_src_fc[block.srcdata[dgl.NID]]
+            block.update_all(fn.u_mul_e("h", "a", "m"), fn.sum("m", "h"))
+            h = rst[start:end] + block.dstdata["h"]
+        if conv.activation is not None:
+            h = conv.activation(h, inplace=True)
+        rst[start:end] = h
+
+    engine.map(propagate, engine.in_blocks())
+    return rst
+
+
+def agdn_conv_inference(conv, engine, feat):
+    n_heads, out_feats = conv._n_heads, conv._out_feats
+    h_prev, attn_src, attn_dst, rst = _project(conv, engine, feat)
+    h_next = engine.buffer("hop", (engine.n_nodes, n_heads, out_feats))
+    # source-side log-sum-exp of the attention logits, for softmax(norm_by='src')
+    lse_src = engine.buffer("lse_src", (engine.n_nodes, n_heads, 1))
+
+    def src_normalizer(start, end, block):
+        with block.local_scope():
+            # reversed block: dst nodes are the original sources
+            block.dstdata["attn_src"] = attn_src[start:end]
+            if attn_dst is not None:
+                block.srcdata["attn_dst"] = attn_dst[block.srcdata[dgl.NID]]
+                block.apply_edges(fn.u_add_v("attn_dst", "attn_src", "e"))
+            else:
+                block.apply_edges(fn.copy_v("attn_src", "e"))
+            block.edata["e"] = conv.leaky_relu(block.edata["e"])
+            block.update_all(fn.copy_e("e", "m"), fn.max("m", "e_max"))
+            block.apply_edges(fn.e_sub_v("e", "e_max", "e"))
+            block.edata["e"] = torch.exp(block.edata["e"])
+            block.update_all(fn.copy_e("e", "m"), fn.sum("m", "e_sum"))
+            lse_src[start:end] = block.dstdata["e_max"] + torch.log(block.dstdata["e_sum"])
+
+    engine.map(src_normalizer, engine.out_blocks())
+
+    # hop attention is accumulated with an online softmax over hops
+    acc = engine.buffer("hop_acc", (engine.n_nodes, n_heads, out_feats))
+    a_l = engine.buffer("hop_attn_l", (engine.n_nodes, n_heads, 1))
+    a_max = engine.buffer("hop_attn_max", (engine.n_nodes, n_heads, 1))
+    a_sum = engine.buffer("hop_attn_sum", (engine.n_nodes, n_heads, 1))
+
+    for k in range(conv._K):
+
+        def propagate(start, end, block):
+            src = block.srcdata[dgl.NID]
+            with block.local_scope():
+                e = _attn_logits(conv, block, attn_src, attn_dst)
+                block.edata["e"] = e
+                block.srcdata["lse_src"] = lse_src[src]
+                block.apply_edges(fn.e_sub_u("e", "lse_src", "e_src"))
+                a = torch.sqrt(edge_softmax(block, e, norm_by="dst").clamp(min=1e-9) * torch.exp(block.edata["e_src"]).clamp(min=1e-9))
+                block.edata["a"] = engine.edge_norm(block, conv._norm, a)
+                block.srcdata["h"] = h_prev[src]
+                block.update_all(fn.u_mul_e("h", "a", "m"), fn.sum("m", "h"))
+                h = block.dstdata["h"]
+            h_next[start:end] = h
+
+            h = conv.feat_trans(h, k)
+            if k == 0:
+                a_l[start:end] = (h * conv.hop_attn_l).sum(-1).unsqueeze(-1)
+            a = conv.leaky_relu((h * conv.hop_attn_r).sum(-1).unsqueeze(-1) + a_l[start:end])
+            if k == 0:
+                a_max[start:end] = a
+                a_sum[start:end] = 1
+                acc[start:end] = h
+            else:
+                new_max = torch.max(a_max[start:end], a)
+                scale_old, scale_new = torch.exp(a_max[start:end] - new_max), torch.exp(a - new_max)
+                acc[start:end] = acc[start:end] * scale_old + h * scale_new
+                a_sum[start:end] = a_sum[start:end] * scale_old + scale_new
+                a_max[start:end] = new_max
+
+        engine.map(propagate, engine.in_blocks())
+        h_prev, h_next = h_next, h_prev
+
+    def finalize(start, end):
+        h = rst[start:end] + acc[start:end] / a_sum[start:end]
+        if conv.activation is not None:
+            h = conv.activation(h, inplace=True)
+        rst[start:end] = h
+
+    engine.map(finalize)
+    return rst
+
+
+@torch.no_grad()
+def layerwise_inference(model, engine, feat):
+    """Full-graph predictions of a products GAT / AGDN model, layer by layer."""
+    model.eval()
+    if isinstance(model, AGDN):
+        conv_inference = agdn_conv_inference
+    elif isinstance(model, GAT):
+        assert model.edge_encoder is None, "layer-wise inference does not support edge features"
+        conv_inference = gat_conv_inference
+    else:
+        raise ValueError(f"Unsupported model: {type(model).__name__}")
+
+    h = feat
+    for i in range(model.n_layers):
+        rst = conv_inference(model.convs[i], engine, h)
+        h = engine.buffer("h", (engine.n_nodes, rst.shape[1] * rst.shape[2]))
+        h_last = engine.buffer("h_last", h.shape) if model.residual else None
+
+        def post(start, end):
+            x = rst[start:end].flatten(1, -1)
+            if h_last is not None:
+                if i > 0:
+                    x = x + h_last[start:end]
+                h_last[start:end] = x
+            x = model.norms[i](x)
+            h[start:end] = model.activation(x, inplace=True)
+
+        engine.map(post)
+
+    preds = torch.empty(engine.n_nodes, model.n_classes)
+    if getattr(model, "shadow", False):
+        h_mean = h.mean(dim=0, keepdim=True)
+
+    def predict(start, end):
+        x = h[start:end]
+        if getattr(model, "shadow", False):
+            x = torch.cat([x, h_mean.expand(x.shape[0], -1)], dim=1)
+        preds[start:end] = model.pred_linear(x)
+
+    engine.map(predict)
+    return preds
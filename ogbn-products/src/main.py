@@ -6,7 +6,6 @@ import datetime
 import os
 import sys
 import time
-from copy import deepcopy
 from functools import partial
 
 import dgl
@@ -18,10 +17,18 @@ from dgl.dataloading import DataLoader, NeighborSampler, SAINTSampler
 from torch import nn
 from tqdm import tqdm
 
+import common_path  # noqa: F401, puts agdn_common on sys.path
 from data import load_data, preprocess
+from agdn_common import distributed
+from agdn_common import instrument
+from agdn_common import precision
 from gen_model import count_parameters, gen_model
+from inference import LayerwiseInference, layerwise_inference
+from agdn_common.memory_plan import GB, AGDNMemoryModel, optimizer_state_bytes, plan_partitions
+from agdn_common.pipeline import Prefetcher, pop_stats
+from agdn_common.resources import ResourcePlan, tune_resources
 from sampler import RandomSampler, random_partition_v2
-from utils import (add_labels, loge_loss_function, plot_stats,
+from utils import (ModelSnapshot, add_labels, loge_loss_function, plot_stats,
                    preprocess_lp_local, seed)
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -29,6 +36,8 @@ device = None
 eval_device = None
 dataset = "ogbn-products"
 n_node_feats, n_edge_feats, n_classes = 0, 0, 0
+resource_plan = None
+inference_engine = None
 
 def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx, criterion, optimizer, _evaluator, estimation_mode=False):
     model.train()
@@ -38,7 +47,9 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
     train_loss = val_loss = test_loss = 1e3
     train_score = val_score = test_score = 0
     if args.sample_type == "neighbor_sample":
-        for input_nodes, output_nodes, subgraphs in dataloader:
+
+        def prepare(batch):
+            input_nodes, output_nodes, subgraphs = batch
             subgraphs = [b.to(device) for b in subgraphs]
             new_train_idx = torch.arange(len(output_nodes), device=device)
 
@@ -47,15 +58,21 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
                 train_pred_idx = new_train_idx
                 concat = not args.label_emb
 
-                add_labels(subgraphs[0], train_labels_idx, concat=concat)
+                add_labels(subgraphs[0], train_labels_idx, n_classes, device, concat=concat)
             else:
                 train_pred_idx = new_train_idx
+            return subgraphs, train_pred_idx
 
-            pred = model(subgraphs)
-            loss = criterion(pred[train_pred_idx], subgraphs[-1].ndata["labels"]["_N"][train_pred_idx].float())
+        for subgraphs, train_pred_idx in Prefetcher(dataloader, prepare, args.prefetch_depth):
+            with instrument.stage("forward"):
+                pred = model(subgraphs)
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraphs[-1].ndata["labels"]["_N"][train_pred_idx].float())
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
@@ -71,7 +88,15 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
             global_train_idx = np.random.permutation(_train_idx.cpu())
             global_labels_idx = global_train_idx[:int(len(global_train_idx)*args.mask_rate)]
             global_pred_idx = global_train_idx[int(len(global_train_idx)*args.mask_rate):]
-        for batch_nodes, subgraph in random_partition_v2(args.train_partition_num, graph, shuffle=True):
+        if distributed.enabled():
+            partitions = distributed.partitions(random_partition_v2, args.train_partition_num, graph)
+        else:
+            partitions = random_partition_v2(args.train_partition_num, graph, shuffle=True)
+
+        def prepare(partition):
+            if partition is None:
+                return None
+            batch_nodes, subgraph = partition
             subgraph = subgraph.to(device)
             new_train_idx = torch.tensor(np.random.permutation(len(batch_nodes)), device=device)
             degrees = subgraph.in_degrees()
@@ -88,20 +113,39 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
 
             train_pred_idx = train_pred_idx[np.isin(batch_nodes[train_pred_idx.cpu()], _train_idx.cpu())]
             # train_pred_idx = train_pred_idx[np.isin(train_pred_idx.cpu(), useful_idx.cpu())]
-
-            pred = model(subgraph)
+            return batch_nodes, subgraph, train_pred_idx
+
+        for partition in Prefetcher(partitions, prepare, args.prefetch_depth, "partitioning"):
+            if partition is None:
+                # padding step of a worker without partitions left, it only takes part in the all-reduce
+                optimizer.zero_grad()
+                with instrument.stage("all_reduce"):
+                    distributed.all_reduce_gradients(model.parameters(), 0)
+                with instrument.stage("optimizer"):
+                    optimizer.step()
+                continue
+            batch_nodes, subgraph, train_pred_idx = partition
+            with instrument.stage("forward"):
+                pred = model(subgraph)
             if estimation_mode:
                 preds[batch_nodes] = pred.to(eval_device)
-            loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx, 0])
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx, 0])
 
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            if distributed.enabled():
+                with instrument.stage("all_reduce"):
+                    distributed.all_reduce_gradients(model.parameters(), len(train_pred_idx))
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
             total += count
-            
+
+        loss_sum, total = distributed.all_reduce_sum(loss_sum, total)
         if estimation_mode:
             train_loss = criterion(preds[_train_idx], _labels[_train_idx, 0].to(eval_device)).item()
             val_loss = criterion(preds[val_idx], _labels[val_idx, 0].to(eval_device)).item()
@@ -119,7 +163,8 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
             global_train_idx = np.random.permutation(_train_idx.cpu())
             global_labels_idx = global_train_idx[:int(len(global_train_idx)*args.mask_rate)]
             global_pred_idx = global_train_idx[int(len(global_train_idx)*args.mask_rate):]
-        for subgraph in dataloader:
+
+        def prepare(subgraph):
             batch_nodes = subgraph.ndata[dgl.NID]
             subgraph = subgraph.to(device)
             new_train_idx = torch.tensor(np.random.permutation(len(batch_nodes)), device=device)
@@ -137,11 +182,18 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
 
             train_pred_idx = train_pred_idx[np.isin(batch_nodes[train_pred_idx.cpu()], _train_idx.cpu())]
             # train_pred_idx = train_pred_idx[np.isin(train_pred_idx.cpu(), useful_idx.cpu())]
-            pred = model(subgraph)
-            loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx, 0])
+            return subgraph, train_pred_idx
+
+        for subgraph, train_pred_idx in Prefetcher(dataloader, prepare, args.prefetch_depth):
+            with instrument.stage("forward"):
+                pred = model(subgraph)
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx, 0])
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
@@ -152,6 +204,16 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
     return loss_sum / total, train_score, val_score, test_score, train_loss, val_loss, test_loss
 
 
+def get_inference_engine(args, graph):
+    # chunk blocks and buffers are kept for the final evaluations of later runs
+    global inference_engine
+    if inference_engine is None:
+        inference_engine = LayerwiseInference(
+            graph.cpu(), args.inference_chunk_size, args.inference_threads, args.inference_memmap_dir or None
+        )
+    return inference_engine
+
+
 @torch.no_grad()
 def evaluate(args, graph, model, dataloader, labels, train_idx, val_idx, test_idx, criterion, evaluator, final=False):
     model.eval()
@@ -163,40 +225,47 @@ def evaluate(args, graph, model, dataloader, labels, train_idx, val_idx, test_id
     # Due to the memory capacity constraints, we use sampling for inference and calculate the average of the predictions 'eval_times' times.
     eval_times = args.eval_times
 
-    for _ in range(eval_times):
-
-        if args.sample_type == "neighbor_sample":
-            for input_nodes, output_nodes, subgraphs in dataloader:
-                subgraphs = [b.to(eval_device_) for b in subgraphs]
-                new_train_idx = list(range(len(input_nodes)))
-
-                if args.use_lt:
-                    add_labels(subgraphs[0], new_train_idx, n_classes, eval_device_)
-
-                pred = model(subgraphs)
-                preds[output_nodes] += pred
-
-        if args.sample_type in ["random_cluster", "saint_node", "saint_edge", "saint_rw"]:
-            eval_partition_num = args.eval_partition_num if not final else 1
-            eval_partition_size = graph.number_of_nodes() // eval_partition_num
-            dataloader = DataLoader(graph, 
-                torch.arange(graph.number_of_nodes()), 
-                RandomSampler(), 
-                shuffle=False, 
-                num_workers=min(eval_partition_num, 4),
-                batch_size=eval_partition_size)
-            for batch_nodes, subgraph in random_partition_v2(args.eval_partition_num, graph, shuffle=False):
-            # for batch_nodes, subgraph in dataloader:
-                subgraph = subgraph.to(eval_device_)
-                new_train_idx = list(range(len(batch_nodes)))
-                if args.use_lt:
-                    add_labels(subgraph, new_train_idx, n_classes, eval_device_)
-
-                pred = model(subgraph)
-                preds[batch_nodes] += pred
-
-
-    preds /= eval_times
+    if final and args.layerwise_inference:
+        feat = graph.ndata["feat"]
+        if args.use_lt:
+            feat = torch.cat([feat, graph.ndata["train_labels_onehot"]], dim=-1)
+        preds = layerwise_inference(model, get_inference_engine(args, graph), feat)
+    else:
+        for _ in range(eval_times):
+
+            if args.sample_type == "neighbor_sample":
+                for input_nodes, output_nodes, subgraphs in dataloader:
+                    subgraphs = [b.to(eval_device_) for b in subgraphs]
+                    new_train_idx = list(range(len(input_nodes)))
+
+                    if args.use_lt:
+                        add_labels(subgraphs[0], new_train_idx, n_classes, eval_device_)
+
+                    pred = model(subgraphs)
+                    preds[output_nodes] += pred
+
+            if args.sample_type in ["random_cluster", "saint_node", "saint_edge", "saint_rw"]:
+                eval_partition_num = args.eval_partition_num if not final else 1
+                eval_partition_size = graph.number_of_nodes() // eval_partition_num
+                dataloader = DataLoader(graph, 
+                    torch.arange(graph.number_of_nodes()), 
+                    RandomSampler(), 
+                    shuffle=False, 
+                    num_workers=resource_plan.num_workers(min(eval_partition_num, 4)),
+                    worker_init_fn=resource_plan.worker_init_fn,
+                    batch_size=eval_partition_size)
+                for batch_nodes, subgraph in random_partition_v2(args.eval_partition_num, graph, shuffle=False):
+                # for batch_nodes, subgraph in dataloader:
+                    subgraph = subgraph.to(eval_device_)
+                    new_train_idx = list(range(len(batch_nodes)))
+                    if args.use_lt:
+                        add_labels(subgraph, new_train_idx, n_classes, eval_device_)
+
+                    pred = model(subgraph)
+                    preds[batch_nodes] += pred
+
+
+        preds /= eval_times
 
     train_loss = criterion(preds[train_idx], labels[train_idx, 0].to(eval_device_)).item()
     val_loss = criterion(preds[val_idx], labels[val_idx, 0].to(eval_device_)).item()
@@ -213,37 +282,104 @@ def evaluate(args, graph, model, dataloader, labels, train_idx, val_idx, test_id
     )
 
 
+def plan_memory(args, graph, model):
+    """Sets the train (and, if evaluation runs on the same device, eval) partition numbers to the smallest ones
+    whose step fits into --memory-budget."""
+    memory_model = AGDNMemoryModel(
+        args.n_layers,
+        args.n_hidden,
+        n_heads=args.n_heads,
+        K=args.K if args.model == "agdn" else 1,
+        weight_style="HA" if args.model == "agdn" else "sum",
+        n_node_feats=n_node_feats + (n_classes if args.use_lt else 0),
+        n_edge_feats=n_edge_feats,
+        value_bytes=2 if args.precision == "bf16" else 4,
+    )
+    print(f"Planning partitions for {args.memory_budget} GB, {memory_model}")
+
+    def probe(n_partitions, training):
+        # one forward (and backward) on a random partition, the optimizer is not stepped
+        batch_nodes, subgraph = next(random_partition_v2(n_partitions, graph, shuffle=True))
+        subgraph = subgraph.to(device)
+        if args.use_lt:
+            add_labels(subgraph, torch.arange(len(batch_nodes)), n_classes, device)
+        model.train(training)
+        with torch.set_grad_enabled(training):
+            pred = model(subgraph)
+            if training:
+                pred.float().sum().backward()
+        del pred, subgraph
+        model.zero_grad(set_to_none=True)
+
+    budget, cuda = args.memory_budget * GB, device.type == "cuda"
+    n_nodes, n_edges = graph.number_of_nodes(), graph.number_of_edges()
+    reserve = optimizer_state_bytes(model.parameters())
+    args.train_partition_num = plan_partitions(
+        memory_model, n_nodes, n_edges, budget, lambda n: probe(n, True), reserve=reserve, cuda=cuda
+    )
+    if eval_device == device:
+        args.eval_partition_num = plan_partitions(
+            memory_model, n_nodes, n_edges, budget, lambda n: probe(n, False), training=False, reserve=reserve, cuda=cuda
+        )
+    print(f"Train partitions: {args.train_partition_num}, eval partitions: {args.eval_partition_num}")
+
+
+def tune_step(args, model, batch):
+    """One forward and backward of model on a training batch while tuning the sampler workers, so that sampling and
+    compute compete for the cores as during training. The optimizer is not stepped (as in plan_memory's probe)."""
+    if args.sample_type == "neighbor_sample":
+        input_nodes, output_nodes, subgraphs = batch
+        inputs = [b.to(device) for b in subgraphs]
+        first = inputs[0]
+        concat = not args.label_emb
+    else:
+        inputs = first = batch.to(device)
+        concat = True
+    if args.use_lt:
+        add_labels(first, torch.arange(first.number_of_src_nodes(), device=device), n_classes, device, concat=concat)
+    model.to(device)
+    model.train()
+    pred = model(inputs)
+    pred.float().sum().backward()
+    del pred, inputs, first
+    model.zero_grad(set_to_none=True)
+
+
 def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running):
+    global resource_plan
     evaluator_wrapper = lambda pred, labels: evaluator.eval(
         {"y_pred": pred.argmax(dim=-1, keepdim=True), "y_true": labels}
     )["acc"]
+    make_train_dataloader, make_eval_dataloader = None, None
     
     if args.sample_type == "neighbor_sample":
         train_batch_size = (len(train_idx) + args.train_partition_num - 1) // args.train_partition_num
         # train_batch_size = 100
         # batch_size = len(train_idx)
         train_sampler = NeighborSampler([32] * args.n_layers)
-        train_dataloader = DataLoader(
+        make_train_dataloader = lambda plan: DataLoader(
             graph.cpu(),
             train_idx.cpu(),
             train_sampler,
             batch_size=train_batch_size,
             shuffle=True,
             drop_last=False,
-            num_workers=10,
+            num_workers=plan.num_workers(10),
+            worker_init_fn=plan.worker_init_fn,
         )
 
         eval_batch_size = (len(train_idx) + args.eval_partition_num - 1) // args.eval_partition_num
         eval_sampler = NeighborSampler([100 for _ in range(args.n_layers)])
         # sampler = MultiLayerFullNeighborSampler(args.n_layers)
-        eval_dataloader = DataLoader(
+        make_eval_dataloader = lambda plan: DataLoader(
             graph.cpu(),
             torch.cat([train_idx.cpu(), val_idx.cpu(), test_idx.cpu()]),
             eval_sampler,
             batch_size=eval_batch_size,
             shuffle=False,
             drop_last=False,
-            num_workers=10,
+            num_workers=plan.num_workers(10),
+            worker_init_fn=plan.worker_init_fn,
         )
     
     if args.sample_type == "random_cluster":
@@ -267,13 +403,14 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
             budget = args.rw_budget
         
         train_sampler = SAINTSampler(mode, budget)
-        train_dataloader = DataLoader(
+        make_train_dataloader = lambda plan: DataLoader(
             graph, torch.arange(args.n_subgraphs), train_sampler,
             batch_size=args.saint_batch_size,
             shuffle=True,
             drop_last=False,
             pin_memory=True,
-            num_workers=8)
+            num_workers=plan.num_workers(8),
+            worker_init_fn=plan.worker_init_fn)
         eval_batch_size = (len(labels) + args.eval_partition_num - 1) // args.eval_partition_num
         eval_dataloader = None
 
@@ -284,6 +421,27 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
 
     model = gen_model(args, n_node_feats, n_edge_feats, n_classes).to(device)
+    distributed.broadcast_parameters(model)
+
+    if make_train_dataloader is not None:
+        # tune once per process, the selected plan is reused by later runs
+        if args.tune_workers and n_running == 1:
+            resource_plan, _ = tune_resources(
+                make_train_dataloader, n_batches=args.tune_batches, step=lambda batch: tune_step(args, model, batch)
+            )
+        train_dataloader = make_train_dataloader(resource_plan)
+        if make_eval_dataloader is not None:
+            eval_dataloader = make_eval_dataloader(resource_plan)
+    elif args.tune_workers and n_running == 1:
+        print(f"No sampler workers are used by {args.sample_type}, keeping resource plan: {resource_plan}")
+
+    if args.checkpoint_path:
+        os.makedirs(args.checkpoint_path, exist_ok=True)
+    best_model = ModelSnapshot(
+        model,
+        pin_memory=args.pin_snapshot,
+        path=os.path.join(args.checkpoint_path, f"best_model_run{n_running}.pt") if args.checkpoint_path else None,
+    )
 
     if args.advanced_optimizer:
         optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
@@ -292,9 +450,13 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
         )
     else:
         optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
+
+    # plan once per process, the partition numbers are reused by later runs
+    if args.memory_budget > 0 and n_running == 1:
+        plan_memory(args, graph, model)
     
 
-    total_time = 0
+    total_time = total_stall = 0
     val_score, best_val_score, final_test_score = 0, 0, 0
 
     train_scores, val_scores, test_scores = [], [], []
@@ -309,12 +471,16 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
         toc = time.time()
         total_time += toc - tic
+        stall_time, _ = pop_stats()
+        total_stall += stall_time
 
-        if log_flag:
+        # in distributed mode the models are identical and only the coordinator evaluates
+        if log_flag and distributed.is_coordinator():
             if not (args.estimation_mode and args.sample_type in ["random_cluster"]):
-                train_score, val_score, test_score, train_loss, val_loss, test_loss, pred = evaluate(
-                    args, graph, model, eval_dataloader, labels, train_idx, val_idx, test_idx_during_training, criterion, evaluator_wrapper
-                )
+                with instrument.stage("evaluation"):
+                    train_score, val_score, test_score, train_loss, val_loss, test_loss, pred = evaluate(
+                        args, graph, model, eval_dataloader, labels, train_idx, val_idx, test_idx_during_training, criterion, evaluator_wrapper
+                    )
             
             eval_time = time.time() - toc
 
@@ -322,11 +488,11 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
                 best_val_score = val_score
                 final_test_score = test_score
                 # final_pred = pred
-                best_model = deepcopy(model)
+                best_model.save(model)
 
             if epoch % args.log_every == 0:
                 print(
-                    f"Run: {n_running}/{args.n_runs}, Epoch: {epoch}/{args.n_epochs}, Average epoch time: {total_time / epoch:.2f}s, Evaluate time: {eval_time:.2f}s"
+                    f"Run: {n_running}/{args.n_runs}, Epoch: {epoch}/{args.n_epochs}, Average epoch time: {total_time / epoch:.2f}s, batch stall: {total_stall / epoch:.2f}s, Evaluate time: {eval_time:.2f}s"
                 )
                 print(
                     f"Loss: {loss:.4f}\n"
@@ -341,13 +507,21 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
                 l.append(e)
 
         if args.advanced_optimizer:
-            lr_scheduler.step(val_score)
+            lr_scheduler.step(distributed.broadcast_value(val_score))
+        instrument.epoch_end(epoch, run=n_running, epoch_time=toc - tic, stall_time=stall_time)
+
+    if not distributed.is_coordinator():
+        return best_val_score, final_test_score
 
     tic = time.time()
-    final_train_score, best_val_score, final_test_score, _, _, _, final_pred = evaluate(
-                args, graph, best_model, eval_dataloader, labels, train_idx, val_idx, test_idx, criterion, evaluator_wrapper, final=True
-            )
+    if best_model.saved:
+        best_model.restore(model)
+    with instrument.stage("evaluation"):
+        final_train_score, best_val_score, final_test_score, _, _, _, final_pred = evaluate(
+                    args, graph, model, eval_dataloader, labels, train_idx, val_idx, test_idx, criterion, evaluator_wrapper, final=True
+                )
     toc = time.time()
+    instrument.epoch_end("final", run=n_running)
     print("*" * 50)
     print(f"Best val score: {best_val_score}, Final test score: {final_test_score}, Full evaluation time: {(toc-tic):.4f}s")
     print("*" * 50)
@@ -362,13 +536,53 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
     return best_val_score, final_test_score
 
 
+# globals main() sets, which spawned workers have to restore
+WORKER_GLOBALS = ["device", "eval_device", "n_node_feats", "n_edge_feats", "n_classes", "resource_plan"]
+
+
+def run_worker(state, args, graph, labels, train_idx, val_idx, test_idx, evaluator):
+    globals().update(state)
+    if args.trace and distributed.is_coordinator():
+        instrument.enable(args.trace, args.chrome_trace or None)
+    run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator)
+
+
+def run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator):
+    val_scores, test_scores = [], []
+
+    for i in range(args.n_runs):
+        print("Running", i)
+        seed(args.seed + i)
+        distributed.seed(args.seed + i)
+        val_score, test_score = run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, i + 1)
+        val_scores.append(val_score)
+        test_scores.append(test_score)
+    instrument.close()
+    if not distributed.is_coordinator():
+        return
+
+    print(" ".join(sys.argv))
+    print(args)
+    print(f"Runned {args.n_runs} times")
+    print("Val scores:", val_scores)
+    print("Test scores:", test_scores)
+    print(f"Average val score: {np.mean(val_scores)} ± {np.std(val_scores)}")
+    print(f"Average test score: {np.mean(test_scores)} ± {np.std(test_scores)}")
+    print(f"Number of params: {count_parameters(args, n_node_feats, n_edge_feats, n_classes)}")
+
+
 def main():
-    global device, eval_device, n_node_feats, n_edge_feats, n_classes
+    global device, eval_device, n_node_feats, n_edge_feats, n_classes, resource_plan
 
     argparser = argparse.ArgumentParser(
         "GAT & AGDN implementation on ogbn-products", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     argparser.add_argument("--root", type=str, default="/mnt/ssd/ssd/dataset")
+    argparser.add_argument(
+        "--dataset", type=str, default=dataset, choices=[dataset, f"synthetic-{dataset}"],
+        help="synthetic-* generates a random graph with the same schema instead of loading the real dataset",
+    )
+    argparser.add_argument("--synthetic-scale", type=float, default=1.0, help="size of the synthetic graph relative to the real one")
     argparser.add_argument("--gpu", type=int, default=0, help="GPU device ID")
     argparser.add_argument("--seed", type=int, default=0, help="random seed")
     argparser.add_argument("--n-runs", type=int, default=10, help="running times")
@@ -415,44 +629,96 @@ def main():
     argparser.add_argument("--wd", type=float, default=0, help="weight decay")
     argparser.add_argument("--eval-every", type=int, default=10, help="evaluate every EVAL_EVERY epochs")
     argparser.add_argument("--log-every", type=int, default=10, help="log every LOG_EVERY epochs")
+    argparser.add_argument("--n-workers", type=int, default=-1,
+        help="number of sampler workers, -1 to use the defaults of each loader")
+    argparser.add_argument("--worker-threads", type=int, default=1, help="intra-op threads of each sampler worker")
+    argparser.add_argument("--n-threads", type=int, default=0, help="intra-op threads of the main process, 0 to keep the default")
+    argparser.add_argument("--pin-cores", action="store_true",
+        help="Pin the main process and every sampler worker to disjoint sets of cores.")
+    argparser.add_argument("--tune-workers", action="store_true",
+        help="Benchmark several worker/thread/affinity plans on the training loader and use the fastest one.")
+    argparser.add_argument("--tune-batches", type=int, default=20, help="number of batches to time each plan on, after two warm-up batches")
+    argparser.add_argument("--layerwise-inference", action="store_true",
+        help="Final full-graph evaluation layer by layer in chunks of destination nodes instead of one forward.")
+    argparser.add_argument("--inference-chunk-size", type=int, default=65536, help="destination nodes per chunk in layer-wise inference")
+    argparser.add_argument("--inference-threads", type=int, default=1, help="chunks computed in parallel in layer-wise inference")
+    argparser.add_argument("--inference-memmap-dir", type=str, default="",
+        help="Keep layer-wise inference buffers in memory-mapped files under this directory.")
+    argparser.add_argument("--pin-snapshot", action="store_true",
+        help="Keep the best-model snapshot in pinned memory for asynchronous copies from GPU.")
+    argparser.add_argument("--checkpoint-path", type=str, default="",
+        help="Also write the best model to this directory (in a background thread) on every improvement.")
     argparser.add_argument("--plot", action="store_true", help="plot learning curves")
     argparser.add_argument("--save-pred", action="store_true", help="save final predictions")
+    argparser.add_argument("--dist-procs", type=int, default=0,
+        help="if > 0, train random_cluster partitions data-parallel in this many CPU worker processes on this host (gloo)")
+    argparser.add_argument("--dist-hosts", type=int, default=1, help="number of hosts taking part, each runs this script with --dist-procs")
+    argparser.add_argument("--dist-host-rank", type=int, default=0, help="rank of this host among --dist-hosts")
+    argparser.add_argument("--dist-init-method", type=str, default="tcp://127.0.0.1:29500",
+        help="torch.distributed init method, the address of host 0 when there are several hosts")
+    argparser.add_argument("--prefetch-depth", type=int, default=0,
+        help="if > 0, prepare this many training batches (sampling, labels, device placement) ahead in a background thread")
+    argparser.add_argument("--memory-budget", type=float, default=0,
+        help="device memory in GB; if > 0, pick the train / eval partition numbers from it with a probe step at startup")
+    argparser.add_argument("--legacy-agdn", action="store_true",
+        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    argparser.add_argument("--precision", type=str, default="fp32", choices=precision.PRECISIONS,
+        help="bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32")
+    argparser.add_argument("--trace", type=str, default="", help="write per-epoch time and memory of the training stages to this JSONL file")
+    argparser.add_argument("--chrome-trace", type=str, default="", help="with --trace, also dump every stage in Chrome trace format here")
 
     args = argparser.parse_args()
     print(args)
+    assert args.precision == "fp32" or args.model == "agdn", "--precision bf16 is implemented for AGDN"
+    # layer-wise inference reads the parameters of the legacy AGDNConv
+    assert args.legacy_agdn or args.model != "agdn" or not args.layerwise_inference, "--layerwise-inference needs --legacy-agdn"
+    assert args.memory_budget <= 0 or args.sample_type == "random_cluster", "--memory-budget plans random_cluster partitions"
+    if args.dist_procs > 0:
+        assert args.gpu < 0 and args.sample_type == "random_cluster", "distributed training runs random_cluster on CPU"
+        # estimated scores would only cover the coordinator's partitions
+        assert not args.estimation_mode
+        # the workers would all probe / benchmark at the same time on shared cores
+        assert args.memory_budget <= 0 and not args.tune_workers
 
     print(f"Estimation mode during training: {args.estimation_mode} (Estimated val/test scores may be lower than final ones)")
     device = torch.device(f"cuda:{args.gpu}") if args.gpu >= 0 else torch.device("cpu")
 
     eval_device = torch.device(f"cuda:{args.eval_gpu}") if args.eval_gpu >= 0 else torch.device("cpu")
     print(device, eval_device)
+    assert all(precision.supported(args.precision, d) for d in [device, eval_device]), "--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels"
+
+    resource_plan = ResourcePlan(args.n_workers, args.worker_threads, args.n_threads, pin=args.pin_cores)
+    resource_plan.apply()
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda="cuda" in (device.type, eval_device.type))
     # load data & preprocess
     print("Loading data")
-    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(dataset, args)
+    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(args.dataset, args)
     print("Preprocessing")
     graph, labels = preprocess(graph, labels, train_idx, n_classes, args)
     n_node_feats = graph.ndata["feat"].shape[-1]
     n_classes = (labels.max() + 1).item()
-    labels, train_idx, val_idx, test_idx = map(lambda x: x.to(device), (labels, train_idx, val_idx, test_idx))
+    with instrument.stage("h2d"):
+        labels, train_idx, val_idx, test_idx = map(lambda x: x.to(device), (labels, train_idx, val_idx, test_idx))
+    # setup stages go to an epoch 0 record
+    instrument.epoch_end(0)
 
     # run
-    val_scores, test_scores = [], []
-
-    for i in range(args.n_runs):
-        print("Running", i)
-        seed(args.seed + i)
-        val_score, test_score = run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, i + 1)
-        val_scores.append(val_score)
-        test_scores.append(test_score)
-
-    print(" ".join(sys.argv))
-    print(args)
-    print(f"Runned {args.n_runs} times")
-    print("Val scores:", val_scores)
-    print("Test scores:", test_scores)
-    print(f"Average val score: {np.mean(val_scores)} ± {np.std(val_scores)}")
-    print(f"Average test score: {np.mean(test_scores)} ± {np.std(test_scores)}")
-    print(f"Number of params: {count_parameters(args, n_node_feats, n_edge_feats, n_classes)}")
+    if args.dist_procs > 0:
+        # the coordinator worker traces to the same file again, without the setup record
+        instrument.close()
+        state = {name: globals()[name] for name in WORKER_GLOBALS}
+        distributed.launch(
+            run_worker,
+            (state, args, distributed.share_graph(graph), labels, train_idx, val_idx, test_idx, evaluator),
+            args.dist_procs,
+            n_hosts=args.dist_hosts,
+            host_rank=args.dist_host_rank,
+            init_method=args.dist_init_method,
+            n_threads=args.n_threads,
+        )
+    else:
+        run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator)
 
 
 if __name__ == "__main__":
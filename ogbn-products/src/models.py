@@ -10,11 +10,13 @@ from dgl import function as fn
 from dgl._ffi.base import DGLError
 from dgl.base import ALL
 from dgl.nn.pytorch.utils import Identity
-from dgl.ops import edge_softmax
 from dgl.utils import expand_as_pair
 from torch.nn import init
 from torch.utils.checkpoint import checkpoint
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax
+
 
 class GATConv(nn.Module):
     def __init__(
@@ -352,6 +354,7 @@ class AGDNConv(nn.Module):
 
             feat_src_fc = self.src_fc(feat_src).view(-1, self._n_heads, self._out_feats)
             feat_dst_fc = self.dst_fc(feat_dst).view(-1, self._n_heads, self._out_feats)
+            instrument.begin("attention")
             attn_src = self.attn_src_fc(feat_src).view(-1, self._n_heads, 1)
 
             # NOTE: GAT paper uses "first concatenation then linear projection"
@@ -384,7 +387,7 @@ class AGDNConv(nn.Module):
                 
             else:
                 eids = torch.arange(graph.number_of_edges(), device=e.device)
-            graph.edata["a"] = torch.zeros_like(e)
+            graph.edata["a"] = torch.zeros_like(e, dtype=feat_src_fc.dtype)
             graph.edata["a"][eids] = self.attn_drop(
                                         torch.sqrt(edge_softmax(graph, e[eids], eids=eids, norm_by='dst').clamp(min=1e-9) \
                                                  * edge_softmax(graph, e[eids], eids=eids, norm_by='src').clamp(min=1e-9)))
@@ -392,22 +395,27 @@ class AGDNConv(nn.Module):
                 graph.edata["a"][eids] = graph.edata["a"][eids] * graph.edata["sub_gcn_norm_adjust"][eids].view(-1, 1, 1) 
             if self._norm == "avg":
                 graph.edata["a"][eids] = (graph.edata["a"][eids] + graph.edata["sub_gcn_norm"][eids].view(-1, 1, 1)) / 2
+            instrument.end()
 
             # message passing
             hstack = []
             for k in range(self._K):
+                instrument.begin("hop", k + 1)
                 graph.update_all(fn.u_mul_e("feat_src_fc", "a", "m"), fn.sum("m", "feat_src_fc"))
 
                 hstack.append(graph.dstdata["feat_src_fc"])
+                instrument.end()
 
+            instrument.begin("hop_aggregation")
             hstack = [self.feat_trans(h, k) for k, h in enumerate(hstack)]
             a_l = (hstack[0] * self.hop_attn_l).sum(-1).unsqueeze(-1)
             astack_r = [(hstack[k] * self.hop_attn_r).sum(-1).unsqueeze(-1) for k in range(len(hstack))]
             a = torch.cat([a_r + a_l for a_r in astack_r], dim=-1)
-            a = F.softmax(self.leaky_relu(a), dim=-1)
+            a = F.softmax(self.leaky_relu(a).float(), dim=-1)
             rst = 0
             for k in range(self._K):
                 rst += hstack[k] * a[:, :, [k]]
+            instrument.end()
 
 
             # residual
@@ -1,5 +1,6 @@
 import math
 import random
+import threading
 
 import dgl
 import dgl.function as fn
@@ -60,6 +61,49 @@ def preprocess_lp_local(graph, args):
             for k in range(1, args.declt_K+1):
                 graph.update_all(fn.copy_u("l_local", "m"), fn.mean("m", "l_local"))
 
+class ModelSnapshot(object):
+    """Best-model snapshot kept in one preallocated CPU buffer per parameter / buffer.
+
+    save() copies the model state into the buffers in place (asynchronously from
+    GPU when the buffers are pinned) and, if path is given, writes them to disk
+    in a background thread. restore() loads the snapshot back into a model.
+    """
+
+    def __init__(self, model, pin_memory=False, path=None):
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.state = {
+            k: torch.empty(v.shape, dtype=v.dtype, device="cpu", pin_memory=self.pin_memory)
+            for k, v in model.state_dict().items()
+        }
+        self.path = path
+        self.saved = False
+        self._writer = None
+
+    def wait(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def save(self, model):
+        # the buffers must not change while the previous checkpoint is being written
+        self.wait()
+        on_gpu = False
+        for k, v in model.state_dict().items():
+            self.state[k].copy_(v, non_blocking=self.pin_memory)
+            on_gpu = on_gpu or v.is_cuda
+        if self.pin_memory and on_gpu:
+            torch.cuda.synchronize()
+        self.saved = True
+        if self.path:
+            self._writer = threading.Thread(target=torch.save, args=(self.state, self.path))
+            self._writer.start()
+
+    def restore(self, model):
+        self.wait()
+        model.load_state_dict(self.state)
+        return model
+
+
 def plot_stats(args, train_scores, val_scores, test_scores, losses, train_losses, val_losses, test_losses, n_running):
     fig = plt.figure(figsize=(24, 24))
     ax = fig.gca()
@@ -4,12 +4,17 @@ import numpy as np
 from sklearn import preprocessing
 from ogb.nodeproppred import DglNodePropPredDataset, Evaluator
 
+from agdn_common.synthetic import SyntheticNodePropPredDataset, split_synthetic
 from utils import compute_norm
 
 
 def load_data(dataset, args):
-    data = DglNodePropPredDataset(name=dataset, root=args.root)
-    evaluator = Evaluator(name=dataset)
+    name, synthetic = split_synthetic(dataset)
+    if synthetic:
+        data = SyntheticNodePropPredDataset(name, scale=args.synthetic_scale)
+    else:
+        data = DglNodePropPredDataset(name=dataset, root=args.root)
+    evaluator = Evaluator(name=name)
 
     splitted_idx = data.get_idx_split()
     train_idx, val_idx, test_idx = splitted_idx["train"], splitted_idx["valid"], splitted_idx["test"]
@@ -62,3 +67,27 @@ def preprocess(graph, labels, train_idx, n_classes):
     
 
     return graph, labels
+
+def quantize_edge_feat(graph, dtype="uint8", chunk_size=1 << 22):
+    # Store edge features as uint8 / fp16 codes with per-column scale and offset,
+    # so that feat ~= codes * scale + offset. Models decode them on the fly.
+    feat = graph.edata.pop("feat")
+    if dtype == "uint8":
+        offset = feat.min(dim=0)[0].float()
+        scale = (feat.max(dim=0)[0].float() - offset).clamp(min=1e-12) / 255
+        codes = torch.empty(feat.shape, dtype=torch.uint8)
+    elif dtype == "float16":
+        offset = torch.zeros(feat.shape[-1])
+        scale = feat.abs().max(dim=0)[0].float().clamp(min=1e-12)
+        codes = torch.empty(feat.shape, dtype=torch.float16)
+    else:
+        raise ValueError(f"Unsupported edge feature dtype: {dtype}")
+
+    for start in range(0, feat.shape[0], chunk_size):
+        chunk = (feat[start : start + chunk_size].float() - offset) / scale
+        if dtype == "uint8":
+            chunk = chunk.round_().clamp_(0, 255)
+        codes[start : start + chunk_size] = chunk.to(codes.dtype)
+    graph.edata["feat"] = codes
+
+    return scale, offset
@@ -1,6 +1,8 @@
 import numpy as np
 import torch.nn.functional as F
 
+from agdn_common import agdn_ops
+from agdn_common import precision
 from models import GAT, AGDN
 
 
@@ -28,6 +30,7 @@ def gen_model(args, n_node_feats, n_edge_feats, n_classes):
             norm=args.norm,
             use_one_hot_feature=args.use_one_hot_feature,
             use_labels=args.use_labels,
+            tie_edge_encoders=args.tie_edge_encoders,
         )
 
     if args.model == "agdn":
@@ -51,7 +54,12 @@ def gen_model(args, n_node_feats, n_edge_feats, n_classes):
             use_one_hot=args.use_one_hot_feature,
             use_labels=args.use_labels,
             weight_style=args.weight_style,
+            tie_edge_encoders=args.tie_edge_encoders,
         )
+    if not args.legacy_agdn:
+        # AGDNOp with the parameters as initialized by the AGDNConv
+        model = agdn_ops.convert(model)
+    model = precision.apply(model, args.precision)
 
     return model
 
@@ -18,8 +18,16 @@ from dgl.dataloading import (MultiLayerFullNeighborSampler,
 from dgl.dataloading import NodeDataLoader
 from torch import nn
 
-from data import load_data, preprocess
+import common_path  # noqa: F401, puts agdn_common on sys.path
+from data import load_data, preprocess, quantize_edge_feat
+from agdn_common import distributed
+from agdn_common import instrument
+from agdn_common import precision
 from gen_model import count_parameters, gen_model
+from agdn_common.memory_plan import GB, AGDNMemoryModel, optimizer_state_bytes, plan_partitions
+from models import set_edge_quantization
+from agdn_common.pipeline import Prefetcher, pop_stats
+from agdn_common.resources import ResourcePlan, tune_resources
 from sampler import BatchSampler, DataLoaderWrapper, RandomPartitionSampler, ShaDowKHopSampler, random_partition_v2
 from utils import add_labels, plot_stats, seed, loge_BCE
 
@@ -27,6 +35,8 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 device = None
 dataset = "ogbn-proteins"
 n_node_feats, n_edge_feats, n_classes = 0, 8, 112
+edge_scale, edge_offset = None, None
+resource_plan = None
 
 
 def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx, criterion, optimizer, _evaluator):
@@ -34,7 +44,9 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
 
     loss_sum, total = 0, 0
     if args.sample_type == "neighbor_sample":
-        for input_nodes, output_nodes, subgraphs in dataloader:
+
+        def prepare(batch):
+            input_nodes, output_nodes, subgraphs = batch
             for k in range(len(subgraphs)):
                 subgraphs[k].dstdata["l"] = subgraphs[k].dstdata["l_global"]
             subgraphs = [b.to(device) for b in subgraphs]
@@ -47,12 +59,18 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
                 add_labels(subgraphs[0], train_labels_idx, n_classes, device)
             else:
                 train_pred_idx = new_train_idx
-            
-            pred = model(subgraphs)
-            loss = criterion(pred[train_pred_idx], subgraphs[-1].ndata["labels"]["_N"][train_pred_idx].float())
+            return subgraphs, train_pred_idx
+
+        for subgraphs, train_pred_idx in Prefetcher(dataloader, prepare, args.prefetch_depth):
+            with instrument.stage("forward"):
+                pred = model(subgraphs)
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraphs[-1].ndata["labels"]["_N"][train_pred_idx].float())
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
@@ -64,7 +82,15 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
             np.random.shuffle(global_train_idx[:50125])
             global_labels_idx = global_train_idx[:int(50125*args.mask_rate)]
             global_pred_idx = global_train_idx[int(50125*args.mask_rate):]
-        for batch_nodes, subgraph in random_partition_v2(args.train_partition_num, graph, shuffle=True):
+        if distributed.enabled():
+            partitions = distributed.partitions(random_partition_v2, args.train_partition_num, graph)
+        else:
+            partitions = random_partition_v2(args.train_partition_num, graph, shuffle=True)
+
+        def prepare(partition):
+            if partition is None:
+                return None
+            batch_nodes, subgraph = partition
             subgraph = subgraph.to(device)
             new_train_idx = torch.tensor(np.random.permutation(len(batch_nodes)), device=device)
 
@@ -80,8 +106,20 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
                 train_pred_idx = new_train_idx
             # fine_nodes_mask = ((subgraph.ndata["sub_deg"] > 1) | (subgraph.ndata["sub_deg"] / subgraph.ndata["deg"] > 0.01)).cpu().numpy()
             inner_train_mask = np.isin(batch_nodes[train_pred_idx.cpu()], _train_idx.cpu())
-            train_pred_idx = train_pred_idx[inner_train_mask]
-            pred = model(subgraph)
+            return subgraph, train_pred_idx[inner_train_mask]
+
+        for partition in Prefetcher(partitions, prepare, args.prefetch_depth, "partitioning"):
+            if partition is None:
+                # padding step of a worker without partitions left, it only takes part in the all-reduce
+                optimizer.zero_grad()
+                with instrument.stage("all_reduce"):
+                    distributed.all_reduce_gradients(model.parameters(), 0)
+                with instrument.stage("optimizer"):
+                    optimizer.step()
+                continue
+            subgraph, train_pred_idx = partition
+            with instrument.stage("forward"):
+                pred = model(subgraph)
             # if args.n_label_iters > 0:
             #     unlabel_idx = np.setdiff1d(new_train_idx, train_labels_idx)
             #     for _ in range(args.n_label_iters):
@@ -90,15 +128,22 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
             #         subgraph.ndata['feat'][unlabel_idx, -2*n_classes:-n_classes] = torch.sigmoid(pred[unlabel_idx])
             #         subgraph.ndata['feat'][unlabel_idx, -n_classes:] = 1-torch.sigmoid(pred[unlabel_idx])
             #         pred = model(subgraph)
-            loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx].float())
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx].float())
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            if distributed.enabled():
+                with instrument.stage("all_reduce"):
+                    distributed.all_reduce_gradients(model.parameters(), len(train_pred_idx))
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
             total += count
 
+        loss_sum, total = distributed.all_reduce_sum(loss_sum, total)
         # torch.cuda.empty_cache()
 
     if args.sample_type == "khop_sample":
@@ -108,7 +153,8 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
             global_labels_idx = global_train_idx[:int(len(global_train_idx)*args.mask_rate)]
             global_pred_idx = global_train_idx[int(len(global_train_idx)*args.mask_rate):]
 
-        for nodes, root_nodes, subgraph in dataloader:
+        def prepare(batch):
+            nodes, root_nodes, subgraph = batch
             subgraph = subgraph.to(device)
             new_train_idx = root_nodes
             
@@ -119,12 +165,18 @@ def train(args, graph, model, dataloader, _labels, _train_idx, val_idx, test_idx
                 add_labels(subgraph, train_labels_idx, n_classes, device)
             else:
                 train_pred_idx = new_train_idx
-            
-            pred = model(subgraph)
-            loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx].float())
+            return subgraph, train_pred_idx
+
+        for subgraph, train_pred_idx in Prefetcher(dataloader, prepare, args.prefetch_depth):
+            with instrument.stage("forward"):
+                pred = model(subgraph)
+            with instrument.stage("loss"):
+                loss = criterion(pred[train_pred_idx], subgraph.ndata["labels"][train_pred_idx].float())
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with instrument.stage("backward"):
+                loss.backward()
+            with instrument.stage("optimizer"):
+                optimizer.step()
 
             count = len(train_pred_idx)
             loss_sum += loss.item() * count
@@ -186,9 +238,72 @@ def evaluate(args, graph, model, dataloader, labels, train_idx, val_idx, test_id
     )
 
 
+def plan_memory(args, graph, model):
+    """Sets the train / eval partition numbers to the smallest ones whose step fits into --memory-budget."""
+    memory_model = AGDNMemoryModel(
+        args.n_layers,
+        args.n_hidden,
+        n_heads=args.n_heads,
+        K=args.K if args.model == "agdn" else 1,
+        weight_style=args.weight_style if args.model == "agdn" else "sum",
+        n_node_feats=n_node_feats + (n_classes if args.use_labels else 0),
+        n_edge_feats=n_edge_feats,
+        value_bytes=2 if args.precision == "bf16" else 4,
+    )
+    print(f"Planning partitions for {args.memory_budget} GB, {memory_model}")
+
+    def probe(n_partitions, training):
+        # one forward (and backward) on a random partition, the optimizer is not stepped
+        batch_nodes, subgraph = next(random_partition_v2(n_partitions, graph, shuffle=True))
+        subgraph = subgraph.to(device)
+        if args.use_labels:
+            add_labels(subgraph, torch.arange(len(batch_nodes)), n_classes, device)
+        model.train(training)
+        with torch.set_grad_enabled(training):
+            pred = model(subgraph)
+            if training:
+                pred.float().sum().backward()
+        del pred, subgraph
+        model.zero_grad(set_to_none=True)
+
+    budget, cuda = args.memory_budget * GB, device.type == "cuda"
+    n_nodes, n_edges = graph.number_of_nodes(), graph.number_of_edges()
+    reserve = optimizer_state_bytes(model.parameters())
+    args.train_partition_num = plan_partitions(
+        memory_model, n_nodes, n_edges, budget, lambda n: probe(n, True), reserve=reserve, cuda=cuda
+    )
+    args.eval_partition_num = plan_partitions(
+        memory_model, n_nodes, n_edges, budget, lambda n: probe(n, False), training=False, reserve=reserve, cuda=cuda
+    )
+    print(f"Train partitions: {args.train_partition_num}, eval partitions: {args.eval_partition_num}")
+
+
+def tune_step(args, model, batch):
+    """One forward and backward of model on a training batch while tuning the sampler workers, so that sampling and
+    compute compete for the cores as during training. The optimizer is not stepped (as in plan_memory's probe)."""
+    if args.sample_type == "neighbor_sample":
+        input_nodes, output_nodes, subgraphs = batch
+        for k in range(len(subgraphs)):
+            subgraphs[k].dstdata["l"] = subgraphs[k].dstdata["l_global"]
+        inputs = [b.to(device) for b in subgraphs]
+        first = inputs[0]
+    else:
+        nodes, root_nodes, subgraph = batch
+        inputs = first = subgraph.to(device)
+    if args.use_labels:
+        add_labels(first, torch.arange(first.number_of_src_nodes(), device=device), n_classes, device)
+    model.train()
+    pred = model(inputs)
+    pred.float().sum().backward()
+    del pred, inputs, first
+    model.zero_grad(set_to_none=True)
+
+
 def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running):
+    global resource_plan
     evaluator_wrapper = lambda pred, labels: evaluator.eval({"y_pred": pred, "y_true": labels})["rocauc"]
-    
+    make_train_dataloader, make_eval_dataloader = None, None
+
     if args.sample_type == "neighbor_sample":
         train_batch_size = (len(train_idx) + args.train_partition_num - 1) // args.train_partition_num
         # train_batch_size = 100
@@ -200,13 +315,14 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
         else:
             train_sampler = MultiLayerNeighborSampler([32 for _ in range(args.n_layers)])
         # sampler = MultiLayerFullNeighborSampler(args.n_layers)
-        train_dataloader = DataLoaderWrapper(
+        make_train_dataloader = lambda plan: DataLoaderWrapper(
             NodeDataLoader(
                 graph.cpu(),
                 train_idx.cpu(),
                 train_sampler,
                 batch_sampler=BatchSampler(len(train_idx), batch_size=train_batch_size),
-                num_workers=10,
+                num_workers=plan.num_workers(10),
+                worker_init_fn=plan.worker_init_fn,
             )
         )
 
@@ -218,13 +334,14 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
         else:
             eval_sampler = MultiLayerNeighborSampler([100 for _ in range(args.n_layers)])
         # sampler = MultiLayerFullNeighborSampler(args.n_layers)
-        eval_dataloader = DataLoaderWrapper(
+        make_eval_dataloader = lambda plan: DataLoaderWrapper(
             NodeDataLoader(
                 graph.cpu(),
                 torch.cat([train_idx.cpu(), val_idx.cpu(), test_idx.cpu()]),
                 eval_sampler,
                 batch_sampler=BatchSampler(graph.number_of_nodes(), batch_size=65536),
-                num_workers=10,
+                num_workers=plan.num_workers(10),
+                worker_init_fn=plan.worker_init_fn,
             )
         )
     
@@ -236,36 +353,56 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
     if args.sample_type == "khop_sample":
         train_batch_size = (len(train_idx) + args.train_partition_num - 1) // args.train_partition_num
-        train_dataloader = ShaDowKHopSampler(graph.cpu(), 
+        make_train_dataloader = lambda plan: ShaDowKHopSampler(graph.cpu(), 
                                              args.sampler_K, 
                                              args.sampler_budget, 
                                              train_idx.cpu(), 
                                              replace=False, 
-                                             num_workers=10,
+                                             num_workers=plan.num_workers(10),
+                                             worker_init_fn=plan.worker_init_fn,
                                              batch_size=train_batch_size, 
                                              shuffle=True)
         eval_batch_size = (len(labels) + args.eval_partition_num - 1) // args.eval_partition_num
-        eval_dataloader = ShaDowKHopSampler(graph.cpu(), 
+        make_eval_dataloader = lambda plan: ShaDowKHopSampler(graph.cpu(), 
                                             args.sampler_K, 
                                             args.sampler_budget, 
                                             torch.cat([train_idx.cpu(), val_idx.cpu(), test_idx.cpu()]), 
                                             replace=False, 
-                                            num_workers=10,
+                                            num_workers=plan.num_workers(10),
+                                            worker_init_fn=plan.worker_init_fn,
                                             batch_size=eval_batch_size, 
                                             shuffle=False)
 
     criterion = nn.BCEWithLogitsLoss()
 
     model = gen_model(args, n_node_feats, n_edge_feats, n_classes).to(device)
+    if edge_scale is not None:
+        set_edge_quantization(model, edge_scale.to(device), edge_offset.to(device))
+    distributed.broadcast_parameters(model)
+
+    if make_train_dataloader is not None:
+        # tune once per process, the selected plan is reused by later runs
+        if args.tune_workers and n_running == 1:
+            resource_plan, _ = tune_resources(
+                make_train_dataloader, n_batches=args.tune_batches, step=lambda batch: tune_step(args, model, batch)
+            )
+        train_dataloader = make_train_dataloader(resource_plan)
+        eval_dataloader = make_eval_dataloader(resource_plan)
+    elif args.tune_workers and n_running == 1:
+        print(f"No sampler workers are used by {args.sample_type}, keeping resource plan: {resource_plan}")
 
     if args.advanced_optimizer:
         optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
         lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode="max", factor=0.75, patience=50, verbose=True)
     else:
         optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
+
+    # plan once per process, the partition numbers are reused by later runs
+    if args.memory_budget > 0 and n_running == 1:
+        plan_memory(args, graph, model)
     
 
-    total_time = 0
+    total_time = total_stall = 0
     val_score, best_val_score, final_test_score = 0, 0, 0
 
     train_scores, val_scores, test_scores = [], [], []
@@ -279,11 +416,15 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
         toc = time.time()
         total_time += toc - tic
-
-        if epoch == args.n_epochs or epoch % args.eval_every == 0 or epoch % args.log_every == 0:
-            train_score, val_score, test_score, train_loss, val_loss, test_loss, pred = evaluate(
-                args, graph, model, eval_dataloader, labels, train_idx, val_idx, test_idx, criterion, evaluator_wrapper
-            )
+        stall_time, _ = pop_stats()
+        total_stall += stall_time
+
+        # in distributed mode the models are identical and only the coordinator evaluates
+        if (epoch == args.n_epochs or epoch % args.eval_every == 0 or epoch % args.log_every == 0) and distributed.is_coordinator():
+            with instrument.stage("evaluation"):
+                train_score, val_score, test_score, train_loss, val_loss, test_loss, pred = evaluate(
+                    args, graph, model, eval_dataloader, labels, train_idx, val_idx, test_idx, criterion, evaluator_wrapper
+                )
 
             if val_score > best_val_score:
                 best_val_score = val_score
@@ -292,7 +433,7 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
 
             if epoch % args.log_every == 0:
                 print(
-                    f"Run: {n_running}/{args.n_runs}, Epoch: {epoch}/{args.n_epochs}, Average epoch time: {total_time / epoch:.2f}s"
+                    f"Run: {n_running}/{args.n_runs}, Epoch: {epoch}/{args.n_epochs}, Average epoch time: {total_time / epoch:.2f}s, batch stall: {total_stall / epoch:.2f}s"
                 )
                 print(
                     f"Loss: {loss:.4f}\n"
@@ -305,9 +446,13 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
                 [train_score, val_score, test_score, loss, train_loss, val_loss, test_loss],
             ):
                 l.append(e)
+        instrument.epoch_end(epoch, run=n_running, epoch_time=toc - tic, stall_time=stall_time)
 
         if args.advanced_optimizer:
-            lr_scheduler.step(val_score)
+            lr_scheduler.step(distributed.broadcast_value(val_score))
+
+    if not distributed.is_coordinator():
+        return best_val_score, final_test_score
 
     print("*" * 50)
     print(f"Best val score: {best_val_score}, Final test score: {final_test_score}")
@@ -323,13 +468,54 @@ def run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, n_running)
     return best_val_score, final_test_score
 
 
+# globals main() sets, which spawned workers have to restore
+WORKER_GLOBALS = ["device", "n_node_feats", "n_edge_feats", "n_classes", "edge_scale", "edge_offset", "resource_plan"]
+
+
+def run_worker(state, args, graph, labels, train_idx, val_idx, test_idx, evaluator):
+    globals().update(state)
+    if args.trace and distributed.is_coordinator():
+        instrument.enable(args.trace, args.chrome_trace or None)
+    run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator)
+
+
+def run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator):
+    val_scores, test_scores = [], []
+
+    for i in range(args.n_runs):
+        print("Running", i)
+        seed(args.seed + i)
+        distributed.seed(args.seed + i)
+        val_score, test_score = run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, i + 1)
+        val_scores.append(val_score)
+        test_scores.append(test_score)
+    instrument.close()
+    if not distributed.is_coordinator():
+        return
+
+    print(" ".join(sys.argv))
+    print(args)
+    print(f"Runned {args.n_runs} times")
+    print("Val scores:", val_scores)
+    print("Test scores:", test_scores)
+    print(f"Average val score: {np.mean(val_scores)} ± {np.std(val_scores)}")
+    print(f"Average test score: {np.mean(test_scores)} ± {np.std(test_scores)}")
+    print(f"Number of params: {count_parameters(args, n_node_feats, n_edge_feats, n_classes)}")
+
+
 def main():
-    global device, n_node_feats, n_edge_feats, n_classes, global_labels_idx, global_pred_idx
+    global device, n_node_feats, n_edge_feats, n_classes, global_labels_idx, global_pred_idx, edge_scale, edge_offset
+    global resource_plan
 
     argparser = argparse.ArgumentParser(
         "GAT implementation on ogbn-proteins", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     argparser.add_argument("--root", type=str, default="/mnt/ssd/ssd/dataset")
+    argparser.add_argument(
+        "--dataset", type=str, default=dataset, choices=[dataset, f"synthetic-{dataset}"],
+        help="synthetic-* generates a random graph with the same schema instead of loading the real dataset",
+    )
+    argparser.add_argument("--synthetic-scale", type=float, default=1.0, help="size of the synthetic graph relative to the real one")
     argparser.add_argument("--cpu", action="store_true", help="CPU mode. This option overrides '--gpu'.")
     argparser.add_argument("--gpu", type=int, default=0, help="GPU device ID")
     argparser.add_argument("--seed", type=int, default=0, help="random seed")
@@ -367,21 +553,64 @@ def main():
     argparser.add_argument("--wd", type=float, default=0, help="weight decay")
     argparser.add_argument("--eval-every", type=int, default=5, help="evaluate every EVAL_EVERY epochs")
     argparser.add_argument("--log-every", type=int, default=5, help="log every LOG_EVERY epochs")
+    argparser.add_argument("--edge-feat-dtype", type=str, default="float32", choices=["float32", "float16", "uint8"],
+        help="Storage dtype of raw edge features. Low-precision features are decoded inside the edge encoders.")
+    argparser.add_argument("--tie-edge-encoders", action="store_true",
+        help="Share one edge encoder across layers and reuse its output when layers share a subgraph.")
+    argparser.add_argument("--n-workers", type=int, default=-1,
+        help="number of sampler workers, -1 to use the defaults of each loader")
+    argparser.add_argument("--worker-threads", type=int, default=1, help="intra-op threads of each sampler worker")
+    argparser.add_argument("--n-threads", type=int, default=0, help="intra-op threads of the main process, 0 to keep the default")
+    argparser.add_argument("--pin-cores", action="store_true",
+        help="Pin the main process and every sampler worker to disjoint sets of cores.")
+    argparser.add_argument("--tune-workers", action="store_true",
+        help="Benchmark several worker/thread/affinity plans on the training loader and use the fastest one.")
+    argparser.add_argument("--tune-batches", type=int, default=20, help="number of batches to time each plan on, after two warm-up batches")
     argparser.add_argument("--plot", action="store_true", help="plot learning curves")
     argparser.add_argument("--save-pred", action="store_true", help="save final predictions")
+    argparser.add_argument("--dist-procs", type=int, default=0,
+        help="if > 0, train random_cluster partitions data-parallel in this many CPU worker processes on this host (gloo)")
+    argparser.add_argument("--dist-hosts", type=int, default=1, help="number of hosts taking part, each runs this script with --dist-procs")
+    argparser.add_argument("--dist-host-rank", type=int, default=0, help="rank of this host among --dist-hosts")
+    argparser.add_argument("--dist-init-method", type=str, default="tcp://127.0.0.1:29500",
+        help="torch.distributed init method, the address of host 0 when there are several hosts")
+    argparser.add_argument("--prefetch-depth", type=int, default=0,
+        help="if > 0, prepare this many training batches (sampling, labels, device placement) ahead in a background thread")
+    argparser.add_argument("--memory-budget", type=float, default=0,
+        help="device memory in GB; if > 0, pick the train / eval partition numbers from it with a probe step at startup")
+    argparser.add_argument("--legacy-agdn", action="store_true",
+        help="run the AGDN layers on this subproject's own AGDNConv instead of the shared agdn_common.agdn_ops.AGDNOp")
+    argparser.add_argument("--precision", type=str, default="fp32", choices=precision.PRECISIONS,
+        help="bf16: run the AGDN forward passes under bfloat16 autocast, with softmax normalizers and hop attention in float32")
+    argparser.add_argument("--trace", type=str, default="", help="write per-epoch time and memory of the training stages to this JSONL file")
+    argparser.add_argument("--chrome-trace", type=str, default="", help="with --trace, also dump every stage in Chrome trace format here")
     args = argparser.parse_args()
     print(args)
+    assert args.precision == "fp32" or args.model == "agdn", "--precision bf16 is implemented for AGDN"
+    assert args.memory_budget <= 0 or args.sample_type == "random_cluster", "--memory-budget plans random_cluster partitions"
+    if args.dist_procs > 0:
+        assert args.cpu and args.sample_type == "random_cluster", "distributed training runs random_cluster on CPU"
+        # the workers would all probe / benchmark at the same time on shared cores
+        assert args.memory_budget <= 0 and not args.tune_workers
 
     if args.cpu:
         device = torch.device("cpu")
     else:
         device = torch.device(f"cuda:{args.gpu}")
+    assert precision.supported(args.precision, device), "--precision bf16 needs torch>=1.10 and a DGL build with bfloat16 kernels"
+
+    resource_plan = ResourcePlan(args.n_workers, args.worker_threads, args.n_threads, pin=args.pin_cores)
+    resource_plan.apply()
+    if args.trace:
+        instrument.enable(args.trace, args.chrome_trace or None, cuda=device.type == "cuda")
 
     # load data & preprocess
     print("Loading data")
-    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(dataset, args)
+    graph, labels, train_idx, val_idx, test_idx, evaluator = load_data(args.dataset, args)
     print("Preprocessing")
     graph, labels = preprocess(graph, labels, train_idx, n_classes)
+    if args.edge_feat_dtype != "float32":
+        edge_scale, edge_offset = quantize_edge_feat(graph, args.edge_feat_dtype)
     if args.use_one_hot_feature:
         n_node_feats = graph.ndata["feat"].shape[-1] + graph.ndata["x"].shape[-1]
     else:
@@ -391,26 +620,27 @@ def main():
     #     n_node_feats += 2 * n_classes
 
 
-    labels, train_idx, val_idx, test_idx = map(lambda x: x.to(device), (labels, train_idx, val_idx, test_idx))
+    with instrument.stage("h2d"):
+        labels, train_idx, val_idx, test_idx = map(lambda x: x.to(device), (labels, train_idx, val_idx, test_idx))
+    # setup stages go to an epoch 0 record
+    instrument.epoch_end(0)
 
     # run
-    val_scores, test_scores = [], []
-
-    for i in range(args.n_runs):
-        print("Running", i)
-        seed(args.seed + i)
-        val_score, test_score = run(args, graph, labels, train_idx, val_idx, test_idx, evaluator, i + 1)
-        val_scores.append(val_score)
-        test_scores.append(test_score)
-
-    print(" ".join(sys.argv))
-    print(args)
-    print(f"Runned {args.n_runs} times")
-    print("Val scores:", val_scores)
-    print("Test scores:", test_scores)
-    print(f"Average val score: {np.mean(val_scores)} ± {np.std(val_scores)}")
-    print(f"Average test score: {np.mean(test_scores)} ± {np.std(test_scores)}")
-    print(f"Number of params: {count_parameters(args, n_node_feats, n_edge_feats, n_classes)}")
+    if args.dist_procs > 0:
+        # the coordinator worker traces to the same file again, without the setup record
+        instrument.close()
+        state = {name: globals()[name] for name in WORKER_GLOBALS}
+        distributed.launch(
+            run_worker,
+            (state, args, distributed.share_graph(graph), labels, train_idx, val_idx, test_idx, evaluator),
+            args.dist_procs,
+            n_hosts=args.dist_hosts,
+            host_rank=args.dist_host_rank,
+            init_method=args.dist_init_method,
+            n_threads=args.n_threads,
+        )
+    else:
+        run_all(args, graph, labels, train_idx, val_idx, test_idx, evaluator)
 
 
 if __name__ == "__main__":
@@ -4,10 +4,92 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from dgl import function as fn
-from dgl.ops import edge_softmax
 from dgl.utils import expand_as_pair
 from torch.nn.modules.dropout import Dropout
 
+from agdn_common import instrument
+from agdn_common.precision import edge_softmax, fp32_matmul
+
+
+class QuantizedLinearFunction(torch.autograd.Function):
+    """Linear layer over low-precision (uint8 / fp16) inputs.
+
+    Inputs are cast to the weight dtype chunk by chunk, so a full float32 copy
+    of the E x edge_feats edge features is never materialized, neither in
+    forward nor in backward (only the low-precision codes are saved).
+    """
+
+    @staticmethod
+    def forward(ctx, codes, weight, bias, chunk_size):
+        out = torch.empty(codes.shape[0], weight.shape[0], dtype=weight.dtype, device=weight.device)
+        for start in range(0, codes.shape[0], chunk_size):
+            end = min(start + chunk_size, codes.shape[0])
+            torch.addmm(bias, codes[start:end].to(weight.dtype), weight.t(), out=out[start:end])
+        ctx.save_for_backward(codes, weight)
+        ctx.chunk_size = chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        codes, weight = ctx.saved_tensors
+        grad_weight = torch.zeros_like(weight)
+        for start in range(0, codes.shape[0], ctx.chunk_size):
+            end = min(start + ctx.chunk_size, codes.shape[0])
+            grad_weight.addmm_(grad_out[start:end].t(), codes[start:end].to(weight.dtype))
+        grad_bias = grad_out.sum(0)
+        return None, grad_weight, grad_bias, None
+
+
+class EdgeEncoder(nn.Linear):
+    """Linear + ReLU edge encoder which also accepts quantized edge features.
+
+    Quantized features are stored as codes q with feat = q * scale + offset
+    (per column, see data.quantize_edge_feat). Decoding is folded into the
+    projection: W feat + b = (W * scale) q + (b + W offset).
+    """
+
+    def __init__(self, in_feats, out_feats, chunk_size=1 << 20):
+        super().__init__(in_feats, out_feats)
+        self.chunk_size = chunk_size
+        self.register_buffer("scale", torch.ones(in_feats))
+        self.register_buffer("offset", torch.zeros(in_feats))
+
+    def forward(self, efeat):
+        h = edge_linear(efeat, self.weight, self.bias, self.scale, self.offset, self.chunk_size)
+        return F.relu(h, inplace=True)
+
+
+def edge_linear(efeat, weight, bias, scale, offset, chunk_size=1 << 20):
+    if efeat.dtype == weight.dtype:
+        return F.linear(efeat, weight, bias)
+    weight, bias = weight * scale, bias + torch.mv(weight, offset)
+    return QuantizedLinearFunction.apply(efeat, weight, bias, chunk_size)
+
+
+def decode_edge_feat(efeat, scale, offset):
+    if efeat.dtype == scale.dtype:
+        return efeat
+    return efeat.to(scale.dtype) * scale + offset
+
+
+def encode_edges(model, subgraphs, i, last_emb=None):
+    # With tied encoders the embedding of a subgraph shared by consecutive
+    # layers (full graph / random_cluster) is only computed once.
+    if model.edge_encoder is None:
+        return None
+    if model.tie_edge_encoders:
+        if i > 0 and subgraphs[i] is subgraphs[i - 1]:
+            return last_emb
+        return model.edge_encoder[0](subgraphs[i].edata["feat"])
+    return model.edge_encoder[i](subgraphs[i].edata["feat"])
+
+
+def set_edge_quantization(model, scale, offset):
+    for module in model.modules():
+        if isinstance(module, (EdgeEncoder, EdgeAttentionLayer)):
+            module.scale.copy_(scale)
+            module.offset.copy_(offset)
+
 
 class GATConv(nn.Module):
     def __init__(
@@ -168,12 +250,14 @@ class GAT(nn.Module):
         norm="none",
         use_one_hot_feature=False,
         use_labels=False,
+        tie_edge_encoders=False,
     ):
         super().__init__()
         self.n_layers = n_layers
         self.n_heads = n_heads
         self.n_hidden = n_hidden
         self.n_classes = n_classes
+        self.tie_edge_encoders = tie_edge_encoders
 
         self.convs = nn.ModuleList()
         self.norms = nn.ModuleList()
@@ -186,14 +270,16 @@ class GAT(nn.Module):
         self.node_encoder = nn.Linear(node_feats, n_hidden)
         if edge_emb > 0:
             self.edge_encoder = nn.ModuleList()
+        else:
+            self.edge_encoder = None
 
         for i in range(n_layers):
             in_hidden = n_heads * n_hidden if i > 0 else n_hidden
             out_hidden = n_hidden
             # bias = i == n_layers - 1
 
-            if edge_emb > 0:
-                self.edge_encoder.append(nn.Linear(edge_feats, edge_emb))
+            if edge_emb > 0 and (i == 0 or not tie_edge_encoders):
+                self.edge_encoder.append(EdgeEncoder(edge_feats, edge_emb))
             self.convs.append(
                 GATConv(
                     in_hidden,
@@ -234,14 +320,10 @@ class GAT(nn.Module):
         h = self.input_drop(h)
 
         h_last = None
+        efeat_emb = None
 
         for i in range(self.n_layers):
-            if self.edge_encoder is not None:
-                efeat = subgraphs[i].edata["feat"]
-                efeat_emb = self.edge_encoder[i](efeat)
-                efeat_emb = F.relu(efeat_emb, inplace=True)
-            else:
-                efeat_emb = None
+            efeat_emb = encode_edges(self, subgraphs, i, efeat_emb)
             
             h = self.convs[i](subgraphs[i], h, efeat_emb).flatten(1, -1)
 
@@ -370,7 +452,7 @@ class AGDNConv(nn.Module):
         h = h + self.position_emb[[idx], :, :]
         return h
 
-    def forward(self, graph, feat_src, feat_edge=None):
+    def forward(self, graph, feat_src, feat_edge=None, attn_edge=None):
         with graph.local_scope():
 
             if graph.is_block:
@@ -383,6 +465,7 @@ class AGDNConv(nn.Module):
                 feat_dst_fc = self.dst_fc(feat_dst).view(-1, self._n_heads, self._out_feats)
             else:
                 feat_dst_fc = feat_src_fc
+            instrument.begin("attention")
             attn_src = self.attn_src_fc(feat_src).view(-1, self._n_heads, 1)
 
             # NOTE: GAT paper uses "first concatenation then linear projection"
@@ -405,10 +488,11 @@ class AGDNConv(nn.Module):
                 graph.apply_edges(fn.copy_u("attn_src", "attn_node"))
 
             e = graph.edata["attn_node"]
-            if feat_edge is not None:
+            # attn_edge may be precomputed by AGDN.edge_attention for all layers at once
+            if attn_edge is None and feat_edge is not None:
                 attn_edge = self.attn_edge_fc(feat_edge).view(-1, self._n_heads, 1)
-                graph.edata.update({"attn_edge": attn_edge})
-                e += graph.edata["attn_edge"]
+            if attn_edge is not None:
+                e += attn_edge
             e = self.leaky_relu(e)
 
             if self.training and self.edge_drop > 0:
@@ -418,7 +502,7 @@ class AGDNConv(nn.Module):
                 
             else:
                 eids = torch.arange(graph.number_of_edges(), device=e.device)
-            graph.edata["a"] = torch.zeros_like(e)
+            graph.edata["a"] = torch.zeros_like(e, dtype=feat_src_fc.dtype)
             # graph.edata["a"][eids] = self.attn_drop((edge_softmax(graph, e[eids], eids=eids, norm_by='dst')))
             graph.edata["a"][eids] = self.attn_drop(
                                         torch.sqrt(edge_softmax(graph, e[eids], eids=eids, norm_by='dst').clamp(min=1e-9) \
@@ -428,15 +512,19 @@ class AGDNConv(nn.Module):
                 graph.edata["a"][eids] = graph.edata["a"][eids] * graph.edata["gcn_norm_adjust"][eids].view(-1, 1, 1) 
             if self._norm == "avg":
                 graph.edata["a"][eids] = (graph.edata["a"][eids] + graph.edata["gcn_norm"][eids].view(-1, 1, 1)) / 2
+            instrument.end()
 
             # message passing
             h_0 = self.feat_trans(graph.dstdata["feat_src_fc"], 0)
             hstack = []
             for k in range(self._K):
+                instrument.begin("hop", k + 1)
                 graph.update_all(fn.u_mul_e("feat_src_fc", "a", "m"), fn.sum("m", "feat_src_fc"))
                 # graph.dstdata["feat_src_fc"] = graph.dstdata["feat_src_fc"] / graph.ndata["sub_deg"].view(-1, 1, 1)
                 hstack.append(graph.dstdata["feat_src_fc"])
+                instrument.end()
 
+            instrument.begin("hop_aggregation")
             hstack = torch.stack([self.feat_trans(h, k+1) for k, h in enumerate(hstack)], dim=2)
             if self._weight_style == "sum":
                 rst = hstack.sum(2)
@@ -455,10 +543,11 @@ class AGDNConv(nn.Module):
                 a = (hstack * self.hop_attn_r.unsqueeze(0).unsqueeze(2)).sum(dim=-1, keepdim=True)
                 a = a + a_l
                 # a = torch.sigmoid(a)
-                a = self.hop_attn_drop(a)
-                a = F.softmax(self.leaky_relu(a), dim=-2)
+                a = F.dropout(a, self.hop_attn_drop, training=self.training)
+                a = F.softmax(self.leaky_relu(a).float(), dim=-2)
                 a = a.transpose(-2, -1)
-                rst = torch.matmul(a, hstack).squeeze(-2)
+                rst = fp32_matmul(a, hstack).squeeze(-2)
+            instrument.end()
            
             # residual
             if self.dst_fc is not None:
@@ -496,12 +585,14 @@ class AGDN(nn.Module):
         use_labels=False,
         edge_attention=False,
         weight_style="HA",
+        tie_edge_encoders=False,
     ):
         super().__init__()
         self.n_layers = n_layers
         self.n_heads = n_heads
         self.n_hidden = n_hidden
         self.n_classes = n_classes
+        self.tie_edge_encoders = tie_edge_encoders
 
         self.convs = nn.ModuleList()
         self.norms = nn.ModuleList()
@@ -519,14 +610,16 @@ class AGDN(nn.Module):
         if edge_emb > 0:
             self.edge_encoder = nn.ModuleList()
             self.edge_norms = nn.ModuleList()
+        else:
+            self.edge_encoder = None
 
         for i in range(n_layers):
             in_hidden = n_heads * n_hidden if i > 0 else n_hidden
             out_hidden = n_hidden
             # bias = i == n_layers - 1
 
-            if edge_emb > 0:
-                self.edge_encoder.append(nn.Linear(edge_feats, edge_emb))
+            if edge_emb > 0 and (i == 0 or not tie_edge_encoders):
+                self.edge_encoder.append(EdgeEncoder(edge_feats, edge_emb))
                 self.edge_norms.append(nn.BatchNorm1d(edge_emb))
             self.convs.append(
                 AGDNConv(
@@ -553,6 +646,28 @@ class AGDN(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.activation = activation
 
+    def edge_attention(self, graph, layers):
+        # Edge attention logits of the given layers in one pass over the edges:
+        # the (stacked) edge encoders and attn_edge_fc of every layer are applied
+        # as batched matmuls, giving E x len(layers) x n_heads x 1. Each layer
+        # then only slices its own block.
+        if self.edge_encoder is None:
+            return None
+        efeat = graph.edata["feat"]
+        attn_weight = torch.stack([self.convs[i].attn_edge_fc.weight for i in layers])
+        if self.tie_edge_encoders:
+            emb = self.edge_encoder[0](efeat)
+            attn = torch.mm(emb, attn_weight.flatten(0, 1).t())
+            return attn.view(-1, len(layers), self.n_heads, 1)
+
+        encoders = [self.edge_encoder[i] for i in layers]
+        weight = torch.cat([encoder.weight for encoder in encoders], dim=0)
+        bias = torch.cat([encoder.bias for encoder in encoders], dim=0)
+        emb = edge_linear(efeat, weight, bias, encoders[0].scale, encoders[0].offset, encoders[0].chunk_size)
+        emb = F.relu(emb, inplace=True).view(-1, len(layers), attn_weight.shape[-1])
+        attn = torch.bmm(emb.transpose(0, 1), attn_weight.transpose(1, 2))
+        return attn.transpose(0, 1).unsqueeze(-1)
+
     def forward(self, g):
         if not isinstance(g, list):
             subgraphs = [g] * self.n_layers
@@ -573,18 +688,18 @@ class AGDN(nn.Module):
         h = self.input_drop(h)
 
         h_last = None
+        if not isinstance(g, list):
+            attn_edge = self.edge_attention(g, range(self.n_layers))
 
         for i in range(self.n_layers):
-
-            if self.edge_encoder is not None:
-                efeat = subgraphs[i].edata["feat"]
-                efeat_emb = self.edge_encoder[i](efeat)
-                # efeat_emb = self.edge_norms[0](efeat_emb)
-                efeat_emb = F.relu(efeat_emb, inplace=True)
+            if isinstance(g, list):
+                layer_attn_edge = self.edge_attention(subgraphs[i], [i])
             else:
-                efeat_emb = None
+                layer_attn_edge = attn_edge
+            if layer_attn_edge is not None:
+                layer_attn_edge = layer_attn_edge[:, 0 if isinstance(g, list) else i]
 
-            h = self.convs[i](subgraphs[i], h, efeat_emb).flatten(1, -1)
+            h = self.convs[i](subgraphs[i], h, attn_edge=layer_attn_edge).flatten(1, -1)
 
             if h_last is not None:
                 h += h_last[: h.shape[0], :]
@@ -607,6 +722,8 @@ class EdgeAttentionLayer(nn.Module):
         self.edge_drop = edge_drop
         # self.fc = nn.Linear(e_feats, e_feats * n_heads, bias=False)
         self.att = nn.Parameter(torch.FloatTensor(size=(1, n_heads, e_feats)))
+        self.register_buffer("scale", torch.ones(e_feats))
+        self.register_buffer("offset", torch.zeros(e_feats))
         # self.att_bias = nn.Parameter(torch.FloatTensor(size=(1, n_heads, e_feats)))
         self.reset_parameters()
 
@@ -617,7 +734,7 @@ class EdgeAttentionLayer(nn.Module):
         # nn.init.zeros_(self.att_bias)
     
     def forward(self, graph):
-        edge_feats = graph.edata["feat"].unsqueeze(1)
+        edge_feats = decode_edge_feat(graph.edata["feat"], self.scale, self.offset).unsqueeze(1)
         # h_e = self.fc(edge_feats).view(-1, self._n_heads, self._e_feats)
         e = (edge_feats * self.att).sum(dim=-1, keepdim=True)
         # if self.training and self.edge_drop > 0:
@@ -113,11 +113,15 @@ def random_partition(num_clusters, graph, shuffle=True):
         # sub_g.edata["feat"] = graph.edata['feat'][eid]
         yield batch_nodes, sub_g
 
-def random_partition_v2(num_clusters, graph, shuffle=True, save_e=[]):
-    """random partition v2"""
-    if shuffle:
+def random_partition_v2(num_clusters, graph, shuffle=True, save_e=[], cluster_id=None, parts=None):
+    """random partition v2
+
+    cluster_id (the cluster of every node) replaces the random assignment, parts restricts the yielded partitions
+    to these cluster numbers.
+    """
+    if cluster_id is None and shuffle:
         cluster_id = np.random.randint(low=0, high=num_clusters, size=graph.num_nodes())
-    else:
+    elif cluster_id is None:
         if not save_e:
             cluster_id = np.random.randint(low=0, high=num_clusters, size=graph.num_nodes())
             save_e.append(cluster_id)
@@ -125,10 +129,8 @@ def random_partition_v2(num_clusters, graph, shuffle=True, save_e=[]):
             cluster_id = save_e[0]
 #         assert cluster_id is not None   
     perm = np.arange(0, graph.num_nodes())
-    batch_no = 0
-    while batch_no < num_clusters:
+    for batch_no in (parts if parts is not None else range(num_clusters)):
         batch_nodes = perm[cluster_id == batch_no]
-        batch_no += 1 
         sub_g = graph.subgraph(batch_nodes)
         # deg_sqrt, deg_isqrt = compute_norm(sub_g)
         # sub_g.ndata["sub_deg"] = sub_g.in_degrees().clamp(min=1)